@@ -1,8 +1,8 @@
 # Copyright (c) 2019 Ultimaker B.V.
 # Cura is released under the terms of the LGPLv3 or higher.
-from copy import deepcopy
 from datetime import datetime, timezone
-from typing import TypeVar, Dict, List, Any, Type, Union
+import inspect
+from typing import TypeVar, Dict, List, Any, Type, Union, Callable, Tuple
 
 
 # Type variable used in the parse methods below, which should be a subclass of BaseModel.
@@ -11,10 +11,22 @@ T = TypeVar("T", bound="BaseModel")
 
 class BaseModel:
 
+    # Subclasses may declare their attributes in __slots__ for a compact
+    # representation without __dict__.  Unknown keyword arguments are then
+    # kept in _extra instead.
+    __slots__ = ("_extra",)
+
     def __init__(self, **kwargs) -> None:
-        self.__dict__.update(kwargs)
+        self._extra = kwargs or None
         self.validate()
 
+    ## Looks up attributes that were passed as unknown keyword arguments.
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return object.__getattribute__(self, "_extra")[name]
+        except (AttributeError, KeyError, TypeError):
+            raise AttributeError(name) from None
+
     # Validates the model, raising an exception if the model is invalid.
     def validate(self) -> None:
         pass
@@ -33,31 +45,39 @@ class BaseModel:
 
     ## Converts the model into a serializable dictionary
     def toDict(self) -> Dict[str, Any]:
-        return self.__dict__
+        dictionary = {name: getattr(self, name) for name, _ in self._getFields()}
+        if hasattr(self, "__dict__"): # Subclasses without __slots__
+            dictionary.update(self.__dict__)
+        if self._extra:
+            dictionary.update(self._extra)
+        return dictionary
 
     ## Convert model and recursively all submodels into a dictionary
+    #  None-values are left out.  The result shares lists and dicts that are
+    #  not models with this object, so it must not be modified.
     def serialize(self) -> Dict[str, Any]:
-        # deepcopy to not mutate the object
-        dictionary = deepcopy(self.toDict())
-        to_remove = [] # None-values that will be removed
-        for k, v in dictionary.items():
-            if v is None:
-                to_remove.append(k)
-            # Serialize recursively if we encounter another Model
-            elif isinstance(v, BaseModel): # Gets all Models
-                dictionary[k] = v.serialize()
-            # It could also be a list of models
-            elif isinstance(v, list):
-                for i, m in enumerate(v):
-                    if isinstance(m, BaseModel):
-                        v[i] = m.serialize()
-            # Some models store datetime objects
-            elif isinstance(v, datetime):
-                # Replace with date string as parsed by self.parseDate()
-                dictionary[k] = v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        for k in to_remove:
-            del dictionary[k]
-        return dictionary
+        serializer = type(self).__dict__.get("_serializer")
+        if serializer is None:
+            serializer = _compileSerializer(type(self))
+            type(self)._serializer = serializer
+        return serializer(self)
+
+    ## Returns (name, annotation) for all constructor arguments of this class and its base classes.
+    #  Models store every constructor argument as an attribute of the same name.
+    @classmethod
+    def _getFields(cls) -> List[Tuple[str, Any]]:
+        fields = cls.__dict__.get("_fields")
+        if fields is None:
+            fields = []
+            for klass in cls.__mro__:
+                if klass is BaseModel or "__init__" not in klass.__dict__:
+                    continue
+                for parameter in list(inspect.signature(klass.__init__).parameters.values())[1:]:
+                    if (parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)
+                            and parameter.name not in (name for name, _ in fields)):
+                        fields.append((parameter.name, parameter.annotation))
+            cls._fields = fields
+        return fields
 
     ## Parses a single model.
     #  \param model_class: The model class.
@@ -85,3 +105,57 @@ class BaseModel:
         if isinstance(date, datetime):
             return date
         return datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+
+
+## Serializes a value of unknown type: models, lists of models and datetimes.
+def _serializeValue(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.serialize()
+    if isinstance(value, list):
+        return [v.serialize() if isinstance(v, BaseModel) else v for v in value]
+    if isinstance(value, datetime):
+        # Date string as parsed by BaseModel.parseDate()
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return value
+
+
+def _isModel(annotation: Any) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, BaseModel)
+
+
+## Returns the expression converting `value` to its serialized form, chosen by the annotation of the field.
+def _valueExpression(annotation: Any) -> str:
+    plain = (str, int, float, bool, type(None))
+    members = annotation.__args__ if getattr(annotation, "__origin__", None) is Union else (annotation,)
+    for member in members:
+        if getattr(member, "__origin__", None) is list and any(_isModel(arg) for arg in member.__args__):
+            return "[v.serialize() if isinstance(v, BaseModel) else v for v in value]"
+    if any(_isModel(member) for member in members):
+        return "value.serialize() if isinstance(value, BaseModel) else value"
+    if all(member in plain or (getattr(member, "__origin__", None) is list
+                               and all(arg in plain for arg in member.__args__))
+           for member in members):
+        return "value"
+    return "_serializeValue(value)"
+
+
+## Generates the serialize function for a model class from its constructor signature.
+#  Instead of copying and inspecting __dict__ on every call, each attribute is read and converted directly.
+def _compileSerializer(model_class: Type[BaseModel]) -> Callable[[BaseModel], Dict[str, Any]]:
+    lines = ["def serialize(self):", "    result = {}"]
+    for name, annotation in model_class._getFields():
+        lines.append("    value = self.{}".format(name))
+        lines.append("    if value is not None:")
+        lines.append("        result[{!r}] = {}".format(name, _valueExpression(annotation)))
+    lines.append("    if hasattr(self, '__dict__'):")
+    lines.append("        for name, value in self.__dict__.items():")
+    lines.append("            if value is not None:")
+    lines.append("                result[name] = _serializeValue(value)")
+    lines.append("    if self._extra:")
+    lines.append("        for name, value in self._extra.items():")
+    lines.append("            if value is not None:")
+    lines.append("                result[name] = _serializeValue(value)")
+    lines.append("    return result")
+    namespace = {"BaseModel": BaseModel, "_serializeValue": _serializeValue}
+    exec("\n".join(lines), namespace)
+    return namespace["serialize"]
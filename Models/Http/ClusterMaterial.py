@@ -4,6 +4,9 @@ from ..BaseModel import BaseModel
 
 
 class ClusterMaterial(BaseModel):
+
+    __slots__ = ("guid", "version")
+
     def __init__(self, guid: str, version: int, **kwargs) -> None:
         self.guid = guid  # type: str
         self.version = version  # type: int
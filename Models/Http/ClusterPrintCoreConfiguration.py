@@ -10,6 +10,8 @@ from ..BaseModel import BaseModel
 #  Also used for representing slots in a Material Station (as from Cura's perspective these are the same).
 class ClusterPrintCoreConfiguration(BaseModel):
 
+    __slots__ = ("extruder_index", "material", "print_core_id")
+
     ## Creates a new cloud cluster printer configuration object
     #  \param extruder_index: The position of the extruder on the machine as list index. Numbered from left to right.
     #  \param material: The material of a configuration object in a cluster printer. May be in a dict or an object.
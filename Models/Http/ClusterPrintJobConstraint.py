@@ -8,6 +8,8 @@ from ..BaseModel import BaseModel
 ## Class representing a cloud cluster print job constraint
 class ClusterPrintJobConstraints(BaseModel):
 
+    __slots__ = ("require_printer_name",)
+
     ## Creates a new print job constraint.
     #  \param require_printer_name: Unique name of the printer that this job should be printed on.
     #       Should be one of the unique_name field values in the cluster, e.g. 'ultimakersystem-ccbdd30044ec'
@@ -6,6 +6,8 @@ from ..BaseModel import BaseModel
 ## Class representing the reasons that prevent this job from being printed on the associated printer
 class ClusterPrintJobImpediment(BaseModel):
 
+    __slots__ = ("translation_key", "severity")
+
     ## Creates a new print job constraint.
     #  \param translation_key: A string indicating a reason the print cannot be printed,
     #  such as 'does_not_fit_in_build_volume'
@@ -13,6 +13,11 @@ from ..BaseModel import BaseModel
 ## Model for the status of a single print job in a cluster.
 class ClusterPrintJobStatus(BaseModel):
 
+    __slots__ = ("created_at", "force", "machine_variant", "name", "started", "status", "time_total", "uuid",
+                 "configuration", "constraints", "last_seen", "network_error_count", "owner", "printer_uuid",
+                 "time_elapsed", "assigned_to", "deleted_at", "printed_on_uuid", "configuration_changes_required",
+                 "build_plate", "compatible_machine_families", "impediments_to_printing")
+
     ## Creates a new cloud print job status model.
     #  \param assigned_to: The name of the printer this job is assigned to while being queued.
     #  \param configuration: The required print core configurations of this print job.
@@ -9,6 +9,8 @@ from ..BaseModel import BaseModel
 ## Class representing a cloud cluster printer configuration
 class ClusterPrinterConfigurationMaterial(BaseModel):
 
+    __slots__ = ("brand", "color", "guid", "material")
+
     ## Creates a new material configuration model.
     #  \param brand: The brand of material in this print core, e.g. 'Ultimaker'.
     #  \param color: The color of material in this print core, e.g. 'Blue'.
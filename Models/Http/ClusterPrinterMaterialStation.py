@@ -9,6 +9,8 @@ from .ClusterPrinterMaterialStationSlot import ClusterPrinterMaterialStationSlot
 ## Class representing the data of a Material Station in the cluster.
 class ClusterPrinterMaterialStation(BaseModel):
 
+    __slots__ = ("status", "supported", "material_slots")
+
     ## Creates a new Material Station status.
     #  \param status: The status of the material station.
     #  \param: supported: Whether the material station is supported on this machine or not.
@@ -8,6 +8,8 @@ from ..BaseModel import BaseModel
 ## Class representing the system status of a printer.
 class PrinterSystemStatus(BaseModel):
 
+    __slots__ = ("guid", "firmware", "hostname", "name", "platform", "variant", "hardware")
+
     def __init__(self, guid: str, firmware: str, hostname: str, name: str, platform: str, variant: str,
                  hardware: Dict[str, Any], **kwargs
                  ) -> None:
@@ -0,0 +1,275 @@
+"""
+Alternative server engine on an asyncio event loop.
+
+All connections are accepted and read from a single event loop running
+in its own thread.  Only the request handlers themselves run in a small
+pool of worker threads, so the number of threads doesn't grow with the
+number of clients like it does for ThreadingHTTPServer.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import socket
+import threading
+
+from .server import BUSY_RESPONSE, DEFAULT_LIMITS, Handler, RequestLimits
+
+logger = logging.getLogger("root.server")
+
+class StreamFile:
+    """
+    Blocking file-like reader for worker threads, reading from an
+    asyncio.StreamReader on the event loop.
+
+    The request head, which has already been read by the loop, is passed
+    as head and returned first.  Every other read is run as coroutine on
+    the loop and waited for, so that a slow upload only blocks its worker
+    thread, never the loop.
+    """
+
+    def __init__(self, reader, loop, head, timeout):
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+        self._head = io.BytesIO(head)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(
+                self.timeout)
+
+    def readline(self, limit=-1):
+        line = self._head.readline(limit)
+        if line:
+            return line
+        line = self._run(self.reader.readline())
+        if limit >= 0:
+            # readline() of the StreamReader doesn't take a limit
+            line = line[:limit]
+        return line
+
+    def read(self, size=-1):
+        data = self._head.read(size)
+        if size < 0:
+            return data + self._run(self.reader.read())
+        if len(data) < size:
+            data += self._run(self._read_up_to(size - len(data)))
+        return data
+
+    def readinto(self, b):
+        n = self._head.readinto(b)
+        if n:
+            return n
+        data = self._run(self.reader.read(len(b)))
+        b[:len(data)] = data
+        return len(data)
+
+    async def _read_up_to(self, size):
+        """Read size bytes, or less only if EOF is reached"""
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    def close(self):
+        pass
+
+
+class AsyncRequest:
+    """
+    Stands in for the socket passed to a request handler.  Responses are
+    written to a buffer and sent by the event loop once the handler
+    returns.
+    """
+
+    def __init__(self, rfile, writer):
+        self.rfile = rfile
+        self.writer = writer
+        self.wfile = io.BytesIO()
+        self.file_to_send = None # Path of a file to send after wfile
+        self.close_connection = True
+
+    def flush(self):
+        """Send what has been written to wfile so far right away"""
+        data = self.wfile.getvalue()
+        self.wfile.seek(0)
+        self.wfile.truncate()
+        async def send():
+            self.writer.write(data)
+            await self.writer.drain()
+        self.rfile._run(send())
+
+
+class AsyncHandler(Handler):
+    """Handler for a request that was read by the AsyncServer"""
+
+    def setup(self):
+        self.connection = self.request
+        self.rfile = self.request.rfile
+        self.wfile = self.request.wfile
+
+    def handle(self):
+        """
+        Handle only a single request.  The server waits for the next one
+        on the event loop, so that idle connections don't block a worker.
+        """
+        self.handle_one_request()
+
+    def finish(self):
+        # The buffers are sent and closed by the server
+        self.request.close_connection = self.close_connection
+
+    def handle_expect_100(self):
+        """Send 100 Continue before the client sends the body"""
+        if not super().handle_expect_100():
+            return False
+        self.request.flush()
+        return True
+
+    def send_file(self, path):
+        """Let the event loop send the file once the response is done"""
+        # Raise OSError now, while the error can still be sent
+        open(path, "rb").close()
+        self.request.file_to_send = path
+
+
+class AsyncServer(threading.Thread):
+    """
+    Drop-in replacement for server.Server, accepting connections on an
+    asyncio event loop and handling requests in a pool of worker threads.
+    Up to queue_size requests wait for a free worker, beyond that they
+    are answered with 503 right away.
+    """
+
+    # Seconds to wait for each read of the request body
+    TIMEOUT = 30
+    # Connections beyond this are closed after their current request
+    MAX_KEEP_ALIVE = 32
+
+    def __init__(self, server_address, RequestHandler, module, workers=8,
+                 queue_size=16, limits=DEFAULT_LIMITS):
+        super().__init__()
+        self.module = module
+        self.RequestHandlerClass = RequestHandler
+        self.last_request = 0 # Time of last request in seconds since epoch
+        self.connections = 0 # Number of currently open connections
+        self.pending = 0 # Requests waiting for or running in a worker
+        self.workers = workers
+        self.queue_size = queue_size
+        self.limits = RequestLimits(limits)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.executor = ThreadPoolExecutor(workers,
+                thread_name_prefix="cura-handler")
+        self.loop = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(
+                    self.handle_connection, sock=self.socket))
+            if not self._stopped.is_set():
+                self.loop.run_forever()
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.loop.close()
+            self.executor.shutdown()
+
+    def shutdown(self):
+        """Stop the event loop.  Can be called from any thread."""
+        self._stopped.set()
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(loop.stop)
+            except RuntimeError: # Loop closed in the meantime
+                pass
+
+    def server_close(self):
+        self.socket.close()
+
+    async def handle_connection(self, reader, writer):
+        """Handle requests on a connection until it is closed"""
+        client_address = writer.get_extra_info("peername")
+        self.connections += 1
+        try:
+            close = False
+            while not close:
+                close = await self.handle_next_request(
+                        reader, writer, client_address)
+        except (ConnectionError, OSError) as e:
+            logger.debug("<%s> Connection error: %s", client_address[0], e)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def handle_next_request(self, reader, writer, client_address):
+        """
+        Wait for the next request on a connection and handle it.  Return
+        True if the connection is to be closed.
+        """
+        try:
+            head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"),
+                    self.RequestHandlerClass.timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            return True
+        if self.pending >= self.workers + self.queue_size:
+            self.limits.reject("queue")
+            writer.write(BUSY_RESPONSE)
+            await writer.drain()
+            return True
+        request = AsyncRequest(
+                StreamFile(reader, self.loop, head, self.TIMEOUT), writer)
+        self.pending += 1
+        try:
+            await self.loop.run_in_executor(self.executor,
+                    self.handle_request, request, client_address)
+        finally:
+            self.pending -= 1
+        writer.write(request.wfile.getvalue())
+        await writer.drain()
+        if request.file_to_send is not None:
+            with open(request.file_to_send, "rb") as fp:
+                await self.loop.sendfile(writer.transport, fp)
+        return request.close_connection
+
+    def keep_alive(self):
+        """Return True if the current connection may be kept open"""
+        return self.connections <= self.MAX_KEEP_ALIVE
+
+    def stats(self):
+        """Return the load of the server and the rejection counters"""
+        return dict(self.limits.stats(), workers=self.workers,
+                    connections=self.connections,
+                    queued=max(0, self.pending - self.workers))
+
+    def handle_request(self, request, client_address):
+        """Run the request handler, called in a worker thread"""
+        try:
+            self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            logger.exception("<%s> Exception while handling request",
+                             client_address[0])
+
+
+def get_server(module):
+    return AsyncServer((module.ADDRESS, 8008), AsyncHandler, module,
+                       workers=module.SERVER_WORKERS,
+                       queue_size=module.SERVER_QUEUE_SIZE,
+                       limits={"poll": module.MAX_POLLS,
+                               "upload": module.MAX_UPLOADS,
+                               "watch": module.MAX_WATCHES})
@@ -0,0 +1,1622 @@
+#!/usr/bin/env python3
+"""
+Execute to run benchmarks of the hot paths outside of klipper.
+
+    ./benchmark.py [name ...]
+
+Without arguments all benchmarks are run, see --help for their names.
+Exits with an error if any benchmark failed, like latency when exceeding
+LATENCY_LIMITS, so that they can be run in CI.
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+import functools
+import http.client
+import io
+import json
+import os
+import queue
+import random
+import re
+import resource
+import select
+import shutil
+import site
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+site.addsitedir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from klipper_cura_connection import asyncserver, server
+from klipper_cura_connection.contentmanager import (
+        CachedResponse, ContentManager)
+from klipper_cura_connection.curaconnection import CuraConnectionModule
+from klipper_cura_connection.custom_exceptions import (
+        QueuesDesynchronizedError)
+from klipper_cura_connection.diskspace import DiskSpace
+from klipper_cura_connection.fileindex import FileIndex
+from klipper_cura_connection.jobregistry import JobRegistry
+from klipper_cura_connection.materialindex import MaterialIndex
+from klipper_cura_connection.metrics import Metrics
+from klipper_cura_connection.mimeparser import MimeParser
+from klipper_cura_connection.nameindex import NameIndex
+from klipper_cura_connection.streamprint import StreamGate
+from klipper_cura_connection.Models.BaseModel import BaseModel
+from klipper_cura_connection.Models.Http.ClusterPrintJobStatus import (
+        ClusterPrintJobStatus)
+from klipper_cura_connection.thumbnails import ThumbnailCache
+from klipper_cura_connection.uploads import ChunkedReader, UploadStore
+
+MiB = 1024 * 1024
+BOUNDARY = "BenchmarkBoundary5f3a"
+# Limits of the latency benchmark in seconds, for CI:  p99 lateness of
+# klippy's timers under load and CPU time of the longest callback that
+# the module runs in the reactor
+LATENCY_LIMITS = {"p99": 0.02, "callback": 0.005}
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register func as a benchmark under its name"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, repeat):
+    """Return the best time in seconds of repeat calls to func"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, if supported (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak RSS in bytes since the last reset_peak_rss()"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak over the lifetime of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_multipart(size, line_length, parts, edge):
+    """
+    Return a multipart body like Cura sends it with a file of size bytes.
+    line_length     Length of the lines in the file.  Lines longer than
+                    100 bytes are filled with random binary-like data.
+    parts           Number of additional non-file parts
+    edge            If True, place the final delimiter across the edge
+                    between two blocks of MimeParser.BLOCK_SIZE.
+    """
+    rng = random.Random(size)
+    if line_length > 100:
+        line = bytes(rng.randrange(32, 256) for _ in range(line_length - 1))
+    else:
+        line = b"G1 X100.125 Y100.125 E0.01234 ;" + b"-" * line_length
+        line = line[:line_length - 1]
+    head = b"".join(
+        b"--%s\r\nContent-Disposition: form-data; name=\"part%d\"\r\n\r\n"
+        b"value %d\r\n" % (BOUNDARY.encode(), i, i) for i in range(parts))
+    head += (b"--%s\r\nContent-Disposition: form-data; name=\"file\"; "
+             b"filename=\"benchmark.gcode\"\r\n"
+             b"Content-Type: application/octet-stream\r\n\r\n"
+             % BOUNDARY.encode())
+    if edge:
+        # Let the delimiter start 4 bytes before the end of a block
+        offset = (len(head) + size + 2) % MimeParser.BLOCK_SIZE
+        size += MimeParser.BLOCK_SIZE - 4 - offset
+    data = (line + b"\n") * (size // (len(line) + 1))
+    data += b";" * (size - len(data))
+    return head + data + b"\r\n--%s--\r\n" % BOUNDARY.encode()
+
+
+class BenchmarkModule:
+    """Stand-in for CuraConnectionModule with what the server needs"""
+
+    testing = True
+    VERSION = "5.2.11"
+    NAME = "benchmark"
+    ADDRESS = "127.0.0.1"
+    UPLOAD_BLOCK_SIZE = MimeParser.BLOCK_SIZE
+    stream_gate = file_index = name_index = uploads = None
+
+    def __init__(self, sdcard_path):
+        self.SDCARD_PATH = sdcard_path
+        self.MATERIAL_PATH = sdcard_path
+        self.filament_manager = BenchmarkFilamentManager(sdcard_path)
+        self.metrics = Metrics()
+        self.content_manager = ContentManager(self)
+        self.thumbnail_cache = ThumbnailCache(
+                os.path.join(sdcard_path, ".thumbnails"))
+        self.disk_space = DiskSpace(sdcard_path, 0)
+        self.printed = []
+
+    def send_print(self, path):
+        self.printed.append(path)
+
+
+def make_print_job(i):
+    """Return a print job model as created by the content manager"""
+    return ClusterPrintJobStatus(
+        created_at="2020-01-01T00:00:00.000000Z",
+        force=False,
+        machine_variant="Ultimaker 3",
+        name="file-{}.gcode".format(i),
+        started=False,
+        status="queued",
+        time_total=3600,
+        time_elapsed=0,
+        uuid="00000000-0000-0000-0000-{:012d}".format(i),
+        configuration=[{
+            "extruder_index": 0,
+            "material": {"guid": "guid", "brand": "Generic",
+                         "color": "Generic", "material": "PLA"},
+        }],
+        constraints=[],
+    )
+
+
+def deepcopy_serialize(model):
+    """The former implementation of BaseModel.serialize(), for comparison"""
+    dictionary = deepcopy(model.toDict())
+    for k, v in list(dictionary.items()):
+        if v is None:
+            del dictionary[k]
+        elif isinstance(v, BaseModel):
+            dictionary[k] = deepcopy_serialize(v)
+        elif isinstance(v, list):
+            for i, m in enumerate(v):
+                if isinstance(m, BaseModel):
+                    v[i] = deepcopy_serialize(m)
+    return dictionary
+
+
+@benchmark
+def serialize():
+    """Serialize time and memory per print job for queues of 10 to 1000"""
+    print("{:>6} {:>14} {:>14} {:>12}".format(
+        "jobs", "serialize", "deepcopy", "bytes/job"))
+    for n in (10, 100, 1000):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        jobs = [make_print_job(i) for i in range(n)]
+        per_job = (tracemalloc.get_traced_memory()[0] - before) / n
+        tracemalloc.stop()
+        compiled = timed(lambda: [m.serialize() for m in jobs], 20)
+        legacy = timed(lambda: [deepcopy_serialize(m) for m in jobs], 5)
+        print("{:>6} {:>12.3f}ms {:>12.3f}ms {:>12.0f}".format(
+            n, compiled * 1000, legacy * 1000, per_job))
+
+
+@benchmark
+def compression():
+    """
+    Size of the print_jobs response with and without compression, the
+    time to compress it once per state and to send a cached one.
+    """
+    print("{:>6} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+        "jobs", "bytes", "gzip", "deflate", "compress", "cached"))
+    for n in (10, 50, 200):
+        content = [make_print_job(i).serialize() for i in range(n)]
+        sizes = []
+        for encoding in CachedResponse.ENCODINGS:
+            response = CachedResponse(content, 1, "benchmark")
+            sizes.append(len(response.encode(encoding)[1]))
+        compress = timed(lambda: CachedResponse(content, 1, "benchmark")
+                         .encode("gzip"), 5)
+        compress -= timed(lambda: CachedResponse(content, 1, "benchmark"), 5)
+        cached = timed(lambda: response.encode("gzip"), 100)
+        print("{:>6} {:>10} {:>10} {:>10} {:>10.3f}ms {:>8.2f}us".format(
+            n, len(response.body), sizes[0], sizes[1], compress * 1000,
+            cached * 1e6))
+
+
+def match_by_name(print_jobs, paths):
+    """The former matching of queue and print jobs, for comparison"""
+    print_jobs = list(print_jobs)
+    new_print_jobs = []
+    for path in paths:
+        for j, print_job in enumerate(print_jobs):
+            if print_job.name == os.path.basename(path):
+                new_print_jobs.append(print_jobs.pop(j))
+                break
+        else:
+            new_print_jobs.append(make_print_job(len(new_print_jobs)))
+    return new_print_jobs
+
+
+@benchmark
+def registry():
+    """
+    Updating the print job registry from a reordered queue, compared to
+    the former matching by name, and UUID lookups compared to a scan.
+    """
+    print("{:>6} {:>12} {:>12} {:>12} {:>12}".format(
+        "jobs", "update", "by name", "lookup", "linear"))
+    for n in (1000, 10000):
+        paths = ["/sdcard/file-{}.gcode".format(i) for i in range(n)]
+        jobs = {path: make_print_job(i) for i, path in enumerate(paths)}
+        queue = list(enumerate(paths)) # Job IDs are the initial indices
+        registry = JobRegistry()
+        registry.update(queue, jobs.get)
+        uuids = [job.uuid for job in registry][::max(1, n // 100)]
+        # Worst case for matching by name: the queue was reversed
+        next_paths = paths[::-1]
+        next_queue = queue[::-1]
+        def update_twice():
+            registry.update(next_queue, jobs.get)
+            registry.update(queue, jobs.get)
+        update = timed(update_twice, 5) / 2
+        by_name = timed(lambda: match_by_name(registry, next_paths), 1)
+        lookup = timed(lambda: [registry.get(u) for u in uuids], 5)
+        linear = timed(lambda: [next((i, pj) for i, pj in enumerate(registry)
+                                     if pj.uuid == u) for u in uuids], 1)
+        print("{:>6} {:>10.3f}ms {:>10.1f}ms {:>10.2f}us {:>10.2f}us".format(
+            n, update * 1000, by_name * 1000, lookup / len(uuids) * 1e6,
+            linear / len(uuids) * 1e6))
+
+
+class BenchmarkFilamentManager:
+    """
+    Stand-in for klipper's filament_manager: Material files are parsed
+    once and queried with XPath through get_info().
+    """
+
+    NAMESPACES = {"m": "http://www.ultimaker.com/material"}
+
+    def __init__(self, material_path):
+        self.guid_to_path = {}
+        self.trees = {}
+        self.material = {"loaded": []}
+        for fname in sorted(os.listdir(material_path)):
+            if fname.endswith(".xml.fdm_material"):
+                path = os.path.join(material_path, fname)
+                tree = ET.parse(path)
+                guid = tree.find("./m:metadata/m:GUID", self.NAMESPACES).text
+                self.guid_to_path[guid] = path
+                self.trees[guid] = tree
+
+    def get_info(self, guid, xpath):
+        node = self.trees[guid].find(xpath, self.NAMESPACES)
+        return None if node is None else node.text
+
+
+def make_materials(material_path, n):
+    """Write n material XML files into material_path"""
+    for i in range(n):
+        with open(os.path.join(material_path,
+                  "material-{}.xml.fdm_material".format(i)), "w") as fp:
+            fp.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<fdmmaterial xmlns="http://www.ultimaker.com/material"'
+                ' version="1.3"><metadata><name><brand>Generic</brand>'
+                '<material>PLA</material><color>Color {0}</color></name>'
+                '<GUID>00000000-0000-0000-0000-{0:012d}</GUID>'
+                '<version>{0}</version></metadata>{1}</fdmmaterial>'
+                .format(i + 1, "<settings/>" * 200))
+
+
+@benchmark
+def materials():
+    """Loading the material index without (cold) and with (warm) index file"""
+    material_path = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        print("{:>10} {:>12} {:>12}".format("materials", "cold", "warm"))
+        for n in (100, 500):
+            make_materials(material_path, n)
+            fm = BenchmarkFilamentManager(material_path)
+            index_path = os.path.join(material_path, MaterialIndex.INDEX_FILE)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            cold = timed(lambda: MaterialIndex(fm, index_path).load(), 1)
+            warm = timed(lambda: MaterialIndex(fm, index_path).load(), 3)
+            print("{:>10} {:>10.1f}ms {:>10.1f}ms".format(
+                n, cold * 1000, warm * 1000))
+    finally:
+        shutil.rmtree(material_path)
+
+
+UPLOAD_CASES = [
+    # (file size, line length, non-file parts, delimiter at block edge)
+    (1 * MiB, 32, 0, False),
+    (16 * MiB, 32, 0, False),
+    (64 * MiB, 32, 0, False),
+    (16 * MiB, 64 * 1024, 0, False),
+    (16 * MiB, 32, 0, True),
+    (16 * MiB, 64 * 1024, 0, True),
+    (1 * MiB, 32, 50, False),
+]
+
+
+def print_upload_header():
+    print("{:>6} {:>6} {:>6} {:>5} {:>10} {:>10} {:>10}".format(
+        "MiB", "line", "parts", "edge", "MB/s", "RSS MiB", "heap KiB"))
+
+
+def print_upload_result(case, body, seconds, rss, heap):
+    size, line_length, parts, edge = case
+    print("{:>6} {:>6} {:>6} {:>5} {:>10.1f} {:>10.1f} {:>10.0f}".format(
+        size // MiB, line_length, parts, "yes" if edge else "no",
+        len(body) / seconds / 1e6, rss / MiB, heap / 1024))
+
+
+@benchmark
+def upload():
+    """
+    Throughput of MimeParser.parse() for different multipart bodies.
+    heap is the peak of memory allocated by Python while parsing, which
+    should stay around one block, regardless of the file size.
+    """
+    out_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        print_upload_header()
+        for case in UPLOAD_CASES:
+            body = make_multipart(*case)
+            def parse():
+                fp = io.BufferedReader(io.BytesIO(body))
+                MimeParser(fp, BOUNDARY, len(body), out_dir).parse()
+            reset_peak_rss()
+            seconds = timed(parse, 3)
+            rss = peak_rss()
+            tracemalloc.start()
+            parse()
+            heap = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print_upload_result(case, body, seconds, rss, heap)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+@benchmark
+def post_print_job():
+    """Throughput of POST /cluster-api/v1/print_jobs/ on both server engines"""
+    out_dir = tempfile.mkdtemp(prefix="benchmark-")
+    module = BenchmarkModule(out_dir)
+    try:
+        for name, (Server, Handler) in ENGINES.items():
+            print(name)
+            srv = Server((module.ADDRESS, 0), Handler, module)
+            srv.start()
+            try:
+                post_uploads(srv, module)
+            finally:
+                srv.shutdown()
+                srv.join()
+                srv.server_close()
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def count_stats(func):
+    """Return the number of os.stat() calls during func()"""
+    stat = os.stat
+    calls = 0
+    def counting_stat(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        return stat(*args, **kwargs)
+    os.stat = counting_stat
+    try:
+        func()
+    finally:
+        os.stat = stat
+    return calls
+
+
+@benchmark
+def unique_path():
+    """
+    Finding a unique name for an upload if there are already n files of
+    the same stem, by probing and with the NameIndex.
+    """
+    print("{:>6} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+        "files", "probing", "stats", "build", "index", "stats"))
+    for n in (100, 1000, 5000):
+        out_dir = tempfile.mkdtemp(prefix="benchmark-")
+        try:
+            path = os.path.join(out_dir, "file.gcode")
+            for i in range(n):
+                open(path if i == 0 else os.path.join(
+                        out_dir, "file-{}.gcode".format(i)), "w").close()
+            probing = timed(lambda: MimeParser._unique_path(path), 3)
+            probing_stats = count_stats(lambda: MimeParser._unique_path(path))
+            name_index = NameIndex(out_dir)
+            build = timed(lambda: name_index.unique_path(path), 1)
+            index = timed(lambda: name_index.unique_path(path), 100)
+            index_stats = count_stats(lambda: name_index.unique_path(path))
+            print("{:>6} {:>8.2f}ms {:>8} {:>8.2f}ms {:>8.1f}us {:>8}".format(
+                n, probing * 1000, probing_stats, build * 1000, index * 1e6,
+                index_stats))
+        finally:
+            shutil.rmtree(out_dir)
+
+
+def send_oversized(address, size, expect):
+    """
+    Start a print job upload of size bytes, sending the body in blocks
+    until the server answers.  Return the status and the bytes sent.
+    """
+    sock = socket.create_connection(address)
+    sock.settimeout(5)
+    head = ("POST {}print_jobs/ HTTP/1.1\r\nContent-Type: multipart/form-data;"
+            " boundary={}\r\nContent-Length: {}\r\n".format(
+                server.CLUSTER_API, BOUNDARY, size))
+    if expect:
+        head += "Expect: 100-continue\r\n"
+    sock.sendall((head + "\r\n").encode())
+    sent = 0
+    block = b";" * (64 * 1024)
+    try:
+        if expect:
+            response = sock.recv(4096)
+        else:
+            sock.setblocking(False)
+            while sent < size:
+                try:
+                    response = sock.recv(4096)
+                    break
+                except BlockingIOError:
+                    pass
+                try:
+                    sent += sock.send(block)
+                except BlockingIOError:
+                    time.sleep(0.001)
+            sock.setblocking(True)
+            response = sock.recv(4096)
+    except OSError:
+        response = b""
+    finally:
+        sock.close()
+    return response.split(b" ", 2)[1].decode() if response else "-", sent
+
+
+@benchmark
+def admission():
+    """
+    Cost of the free space check per upload and how fast an upload that
+    doesn't fit on the SD card is rejected, with and without Expect:
+    100-continue.
+    """
+    out_dir = tempfile.mkdtemp(prefix="benchmark-")
+    module = BenchmarkModule(out_dir)
+    # Leave 16 MiB for uploads
+    module.disk_space.reserve = module.disk_space.free() - 16 * MiB
+    def reserve():
+        module.disk_space.reserve_space(MiB).release()
+    print("reserve_space(): {:.1f}us".format(timed(reserve, 1000) * 1e6))
+    srv = server.Server((module.ADDRESS, 0), server.Handler, module)
+    srv.start()
+    try:
+        print("{:>8} {:>8} {:>10} {:>10}".format(
+                "expect", "status", "MiB sent", "ms"))
+        for expect in (True, False):
+            start = time.perf_counter()
+            status, sent = send_oversized(srv.server_address, 256 * MiB,
+                                          expect)
+            print("{:>8} {:>8} {:>10.2f} {:>10.1f}".format(
+                    "yes" if expect else "no", status, sent / MiB,
+                    (time.perf_counter() - start) * 1000))
+    finally:
+        srv.shutdown()
+        srv.join()
+        srv.server_close()
+        shutil.rmtree(out_dir)
+
+
+def disk_writes():
+    """
+    Return the bytes this process has caused to be written to storage,
+    minus those of files deleted before they were written back (Linux
+    only, None otherwise).
+    """
+    try:
+        with open("/proc/self/io") as fp:
+            io_stats = dict(line.split(": ") for line in fp.read().splitlines())
+    except OSError:
+        return None
+    return (int(io_stats["write_bytes"])
+            - int(io_stats["cancelled_write_bytes"]))
+
+
+@benchmark
+def dedup():
+    """
+    Disk usage and writes of 30 uploads of 2 MiB G-code files where most
+    are repeats of 5 distinct files, with and without deduplication.
+    """
+    bodies = [make_multipart(2 * MiB + i, 40, 0, False) for i in range(5)]
+    rng = random.Random(5)
+    uploads = [rng.randrange(len(bodies)) for _ in range(30)]
+    print("{:>8} {:>8} {:>8} {:>10} {:>12} {:>10}".format(
+        "dedup", "uploads", "files", "disk MiB", "written MiB", "upload ms"))
+    for deduplicate in (False, True):
+        out_dir = tempfile.mkdtemp(prefix="benchmark-", dir=os.getcwd())
+        module = BenchmarkModule(out_dir)
+        if deduplicate:
+            module.file_index = FileIndex(out_dir,
+                    os.path.join(out_dir, FileIndex.INDEX_FILE))
+            module.file_index.load()
+        srv = server.Server((module.ADDRESS, 0), server.Handler, module)
+        srv.start()
+        try:
+            os.sync()
+            written = disk_writes()
+            start = time.perf_counter()
+            for i in uploads:
+                while True:
+                    conn = http.client.HTTPConnection(*srv.server_address)
+                    conn.request("POST", server.CLUSTER_API + "print_jobs/",
+                            bodies[i], {"Content-Type":
+                                        "multipart/form-data; boundary="
+                                        + BOUNDARY})
+                    response = conn.getresponse()
+                    response.read()
+                    conn.close()
+                    # The previous upload's slot may not be free yet
+                    if response.status != 503:
+                        break
+                    time.sleep(0.01)
+                assert response.status == 200, response.status
+            seconds = time.perf_counter() - start
+            os.sync()
+            if written is not None:
+                written = (disk_writes() - written) / MiB
+            files = [os.path.join(out_dir, name) for name in os.listdir(out_dir)
+                     if name.endswith(".gcode")]
+            inodes = {os.stat(path).st_ino: os.path.getsize(path)
+                      for path in files}
+            print("{:>8} {:>8} {:>8} {:>10.1f} {:>12} {:>10.1f}".format(
+                "yes" if deduplicate else "no", len(uploads), len(files),
+                sum(inodes.values()) / MiB,
+                "-" if written is None else "{:.1f}".format(written),
+                seconds / len(uploads) * 1000))
+        finally:
+            srv.shutdown()
+            srv.join()
+            srv.server_close()
+            shutil.rmtree(out_dir)
+
+
+def post_uploads(srv, module):
+    print_upload_header()
+    for case in UPLOAD_CASES:
+        body = make_multipart(*case)
+        def post():
+            conn = http.client.HTTPConnection(*srv.server_address)
+            conn.request("POST", server.CLUSTER_API + "print_jobs/", body,
+                    {"Content-Type": "multipart/form-data; boundary="
+                                     + BOUNDARY})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            assert response.status == 200, response.status
+            os.remove(module.printed.pop())
+        reset_peak_rss()
+        seconds = timed(post, 3)
+        rss = peak_rss()
+        tracemalloc.start()
+        post()
+        heap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print_upload_result(case, body, seconds, rss, heap)
+
+
+def make_chunked(body, chunk_size):
+    """Return body with Transfer-Encoding: chunked"""
+    return b"".join(b"%x\r\n%s\r\n" % (len(chunk), chunk) for chunk in
+                    (body[i:i + chunk_size]
+                     for i in range(0, len(body), chunk_size))) + b"0\r\n\r\n"
+
+
+def send_cut(address, head, body, cut):
+    """Send head and the first cut bytes of body, then drop the connection"""
+    sock = socket.create_connection(address)
+    sock.sendall(head + body[:cut])
+    sock.close()
+    return len(body[:cut])
+
+
+def request(address, method, path, body=b"", headers={}):
+    """Return the status and the body of the response"""
+    conn = http.client.HTTPConnection(*address)
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return response.status, data
+
+
+@benchmark
+def resumable():
+    """
+    Throughput of MimeParser.parse() for chunked bodies, and the bytes
+    sent to upload a file over a connection that drops at 75%, by
+    restarting the upload and by resuming it.
+    """
+    out_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        print("{:>10} {:>10}".format("encoding", "MB/s"))
+        body = make_multipart(16 * MiB, 32, 1, False)
+        chunked = make_chunked(body, 64 * 1024)
+        for name, parse in [
+                ("length", lambda: MimeParser(
+                    io.BufferedReader(io.BytesIO(body)), BOUNDARY,
+                    len(body), out_dir).parse()),
+                ("chunked", lambda: MimeParser(ChunkedReader(
+                    io.BufferedReader(io.BytesIO(chunked))), BOUNDARY,
+                    None, out_dir).parse())]:
+            print("{:>10} {:>10.1f}".format(name,
+                    len(body) / timed(parse, 3) / 1e6))
+
+        module = BenchmarkModule(out_dir)
+        module.uploads = UploadStore(os.path.join(out_dir, ".uploads"))
+        srv = server.Server((module.ADDRESS, 0), server.Handler, module)
+        srv.start()
+        address = srv.server_address
+        body = make_multipart(32 * MiB, 32, 1, False)
+        data = body[body.index(b"\r\n\r\n") + 4:-len(BOUNDARY) - 8]
+        cut = len(body) * 3 // 4
+        try:
+            print("{:>10} {:>10} {:>10}".format("strategy", "MiB sent", "s"))
+            start = time.perf_counter()
+            head = ("POST {}print_jobs/ HTTP/1.1\r\nContent-Type: multipart/"
+                    "form-data; boundary={}\r\nContent-Length: {}\r\n\r\n"
+                    .format(server.CLUSTER_API, BOUNDARY, len(body))).encode()
+            sent = send_cut(address, head, body, cut)
+            status, _ = request(address, "POST",
+                    server.CLUSTER_API + "print_jobs/", body,
+                    {"Content-Type": "multipart/form-data; boundary="
+                                     + BOUNDARY})
+            assert status == 200, status
+            sent += len(body)
+            print("{:>10} {:>10.1f} {:>10.2f}".format(
+                    "restart", sent / MiB, time.perf_counter() - start))
+
+            start = time.perf_counter()
+            status, info = request(address, "POST",
+                    server.CLUSTER_API + "print_jobs/uploads", json.dumps(
+                        {"filename": "resumed.gcode", "size": len(data)}))
+            assert status == 201, status
+            upload = module.uploads.get(json.loads(info)["id"])
+            path = server.CLUSTER_API + "print_jobs/uploads/" + upload.id
+            head = ("PATCH {} HTTP/1.1\r\nUpload-Offset: 0\r\n"
+                    "Content-Length: {}\r\n\r\n".format(path, len(data))
+                    ).encode()
+            sent = send_cut(address, head, data, cut)
+            # Wait for the server to notice
+            while upload.lock.locked():
+                time.sleep(0.01)
+            offset = json.loads(request(address, "GET", path)[1])["offset"]
+            status, info = request(address, "PATCH", path, data[offset:],
+                                   {"Upload-Offset": str(offset)})
+            assert json.loads(info)["complete"], info
+            sent += len(data) - offset
+            print("{:>10} {:>10.1f} {:>10.2f}".format(
+                    "resume", sent / MiB, time.perf_counter() - start))
+        finally:
+            srv.shutdown()
+            srv.join()
+            srv.server_close()
+    finally:
+        shutil.rmtree(out_dir)
+
+
+ENGINES = {
+    "threading": (server.Server, server.Handler),
+    "asyncio": (asyncserver.AsyncServer, asyncserver.AsyncHandler),
+}
+
+
+async def poll_load(address, clients, duration, keep_alive):
+    """
+    Let clients poll GET /printers one request after the other for
+    duration seconds, over a new connection for every request unless
+    keep_alive is set.  Return the number of requests, the latencies
+    of the successful ones and the number of 503 responses.
+    """
+    request = "GET {}printers HTTP/1.1\r\nHost: {}\r\n".format(
+            server.CLUSTER_API, address[0])
+    if not keep_alive:
+        request += "Connection: close\r\n"
+    request = (request + "\r\n").encode()
+    latencies = []
+    failed = busy = 0
+    end = time.monotonic() + duration
+    async def client():
+        nonlocal failed, busy
+        writer = None
+        while time.monotonic() < end:
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(*address)
+                writer.write(request)
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = re.search(rb"Content-Length: (\d+)", head)
+                await reader.readexactly(int(length.group(1)))
+                if not keep_alive or b"Connection: close" in head:
+                    writer.close()
+                    writer = None
+            except (OSError, asyncio.IncompleteReadError, AttributeError):
+                failed += 1
+                writer = None
+                continue
+            if head.startswith(b"HTTP/1.1 200"):
+                latencies.append(time.perf_counter() - start)
+            elif head.startswith(b"HTTP/1.1 503"):
+                busy += 1
+                await asyncio.sleep(0.1)
+            else:
+                failed += 1
+        if writer is not None:
+            writer.close()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return len(latencies) + failed + busy, latencies, busy
+
+
+def run_poll_load(*args):
+    """Entry point of the load generating process"""
+    return asyncio.run(poll_load(*args))
+
+
+@benchmark
+def load():
+    """
+    Requests/s, latency and peak thread count of the server engines with
+    clients polling concurrently, with and without keep-alive.  The load
+    is generated in a separate process, so it doesn't compete for the GIL.
+    """
+    out_dir = tempfile.mkdtemp(prefix="benchmark-")
+    module = BenchmarkModule(out_dir)
+    module.content_manager.start()
+    print("{:>10} {:>8} {:>6} {:>10} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+        "engine", "clients", "alive", "req/s", "p50 ms", "p99 ms", "failed",
+        "503", "threads"))
+    try:
+        with ProcessPoolExecutor(1) as pool:
+            # Start the threads of the pool before counting threads
+            pool.submit(time.sleep, 0).result()
+            for clients in (1, 16, 64):
+                for keep_alive in (False, True):
+                    for name, (Server, Handler) in ENGINES.items():
+                        baseline = threading.active_count()
+                        srv = Server((module.ADDRESS, 0), Handler, module)
+                        srv.start()
+                        peak = baseline
+                        future = pool.submit(run_poll_load,
+                                srv.server_address, clients, 3, keep_alive)
+                        while not future.done():
+                            peak = max(peak, threading.active_count())
+                            time.sleep(0.001)
+                        total, latencies, busy = future.result()
+                        srv.shutdown()
+                        srv.join()
+                        srv.server_close()
+                        latencies.sort()
+                        print("{:>10} {:>8} {:>6} {:>10.0f} {:>9.2f} {:>9.2f}"
+                              " {:>8} {:>8} {:>8}".format(
+                                  name, clients, "yes" if keep_alive else "no",
+                                  len(latencies) / 3,
+                                  latencies[len(latencies) // 2] * 1000,
+                                  latencies[len(latencies) * 99 // 100] * 1000,
+                                  total - len(latencies) - busy, busy,
+                                  peak - baseline))
+    finally:
+        shutil.rmtree(out_dir)
+
+
+class BenchmarkJob:
+    """Stand-in for a print job of klipper's virtual_sdcard"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = "queued"
+        self.thumbnail_path = None
+
+    def get_printed_time(self):
+        return 0
+
+
+class BenchmarkSdcard:
+    """Stand-in for the queue of klipper's virtual_sdcard"""
+
+    def __init__(self, paths):
+        self.jobs = [BenchmarkJob(path) for path in paths]
+        if self.jobs:
+            self.jobs[0].state = "printing"
+
+    def clear_queue(self):
+        del self.jobs[1:]
+
+    def add_printjob(self, path):
+        self.jobs.append(BenchmarkJob(path))
+
+
+class BenchmarkReactor(threading.Thread):
+    """
+    Stand-in for klippy's reactor: Runs async callbacks and timers one
+    after the other, takes snapshots and finishes the current print job
+    every finish_interval seconds (unless None), replacing it with a new
+    one at the end.
+    """
+
+    NOW = 0.
+
+    def __init__(self, module, finish_interval):
+        super().__init__(daemon=True)
+        self.module = module
+        self.finish_interval = finish_interval
+        self.callbacks = queue.Queue()
+        self.running = True
+        self.finished = 0
+        self.finish_times = [] # time.monotonic() of every finished job
+        self.timers = [] # [callback, waketime]
+
+    def register_timer(self, callback, waketime):
+        self.timers.append([callback, waketime])
+
+    def register_async_callback(self, callback):
+        self.callbacks.put(callback)
+
+    def run(self):
+        sdcard = self.module.sdcard
+        next_snapshot = time.monotonic()
+        # Finish print jobs between snapshots, as they would in klipper
+        next_finish = next_snapshot + CuraConnectionModule.SNAPSHOT_INTERVAL / 2
+        while self.running:
+            try:
+                self.callbacks.get(timeout=0.01)(time.monotonic())
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for timer in self.timers:
+                if now >= timer[1]:
+                    timer[1] = timer[0](now)
+            if self.finish_interval is not None and now >= next_finish:
+                self.finished += 1
+                sdcard.jobs.pop(0)
+                sdcard.jobs.append(BenchmarkJob(
+                        "/sdcard/new-{}.gcode".format(self.finished)))
+                sdcard.jobs[0].state = "printing"
+                self.finish_times.append(now)
+                next_finish = now + self.finish_interval
+            if now >= next_snapshot:
+                self.module.content_manager.take_snapshot()
+                next_snapshot = now + CuraConnectionModule.SNAPSHOT_INTERVAL
+
+
+class QueueBenchmarkModule(BenchmarkModule):
+    """BenchmarkModule with the queue editing of CuraConnectionModule"""
+
+    testing = False
+    REACTOR_TIMEOUT = CuraConnectionModule.REACTOR_TIMEOUT
+    run_in_reactor = CuraConnectionModule.run_in_reactor
+    call_in_reactor = CuraConnectionModule.call_in_reactor
+    edit_queue = CuraConnectionModule.edit_queue
+    _edit_queue = CuraConnectionModule._edit_queue
+    _job_action = CuraConnectionModule._job_action
+    replace_queue = CuraConnectionModule.replace_queue
+    apply_queue_edits = CuraConnectionModule.apply_queue_edits
+    queue_move = CuraConnectionModule.queue_move
+    queue_delete = CuraConnectionModule.queue_delete
+
+    def __init__(self, sdcard_path, queue_length, finish_interval):
+        super().__init__(sdcard_path)
+        self.sdcard = BenchmarkSdcard(["/sdcard/job-{}.gcode".format(i)
+                                       for i in range(queue_length)])
+        self.print_stats = self
+        self.reactor = BenchmarkReactor(self, finish_interval)
+
+    def get_print_time_prediction(self):
+        return None, None
+
+    def legacy_queue_move(self, index, new_index, filename):
+        """
+        Move as before queue versioning: Conflict unless the print job
+        is still at the index Cura saw it at.
+        """
+        def move(eventtime):
+            paths = [job.path for job in self.sdcard.jobs]
+            if (index >= len(paths)
+                    or os.path.basename(paths[index]) != filename):
+                raise QueuesDesynchronizedError()
+            if not 0 < new_index < len(paths):
+                raise IndexError()
+            paths.insert(new_index, paths.pop(index))
+            self.sdcard.clear_queue()
+            for path in paths[1:]:
+                self.sdcard.add_printjob(path)
+        self.call_in_reactor("legacy_move", move)
+
+
+@benchmark
+def queue_conflicts():
+    """
+    Conflict rate of concurrent operators moving print jobs while klipper
+    keeps finishing print jobs, by index (legacy) and by JobRef.
+    """
+    duration = 3
+    print("{:>10} {:>10} {:>10} {:>8} {:>10} {:>10}".format(
+        "strategy", "operators", "moves", "409", "conflicts", "rebased"))
+    for operators in (1, 4):
+        for strategy in ("legacy", "ref"):
+            module = QueueBenchmarkModule(tempfile.gettempdir(), 30, 1.0)
+            module.content_manager.start()
+            module.reactor.start()
+            time.sleep(0.05) # First snapshot
+            results = []
+            end = time.monotonic() + duration
+            def operate(seed):
+                rng = random.Random(seed)
+                while time.monotonic() < end:
+                    module.content_manager.get_print_jobs()
+                    jobs = list(module.content_manager.print_jobs)
+                    print_job = rng.choice(jobs[1:])
+                    ref = module.content_manager.uuid_to_job_ref(
+                            print_job.uuid)
+                    # Cura polls every 2s, the view is up to that old
+                    time.sleep(rng.uniform(0, 0.5))
+                    new_index = rng.randrange(1, len(jobs) - 1)
+                    try:
+                        if strategy == "legacy":
+                            module.legacy_queue_move(ref.index, new_index,
+                                                     print_job.name)
+                        else:
+                            module.queue_move(ref, new_index)
+                        results.append(200)
+                    except QueuesDesynchronizedError:
+                        results.append(409)
+                    except IndexError:
+                        results.append(400)
+            threads = [threading.Thread(target=operate, args=(i,))
+                       for i in range(operators)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            module.reactor.running = False
+            module.reactor.join()
+            edits = module.metrics.queue_edits.samples()
+            rebased = sum(value for _, labels, value in edits
+                          if "rebased" in labels)
+            print("{:>10} {:>10} {:>10} {:>8} {:>9.1f}% {:>10}".format(
+                strategy, operators, len(results), results.count(409),
+                100 * results.count(409) / len(results), rebased))
+
+
+class StreamingSdcard(BenchmarkSdcard):
+    """
+    BenchmarkSdcard that prints the current print job by reading it at
+    print_rate bytes/s.  Like virtual_sdcard, it takes the end of the file
+    as the end of the print job, even if the file is still being written.
+    """
+
+    def __init__(self, print_rate, final_size):
+        super().__init__([])
+        self.print_rate = print_rate
+        self.final_size = final_size # Size of the complete files
+        self.file_position = 0
+        self.started = self.finished = None # time.monotonic()
+        self.pauses = 0
+        self.ended_early = 0 # Print jobs that ended before their upload
+
+    def add_printjob(self, path):
+        super().add_printjob(path)
+        if len(self.jobs) == 1:
+            self.jobs[0].state = "printing"
+            self.file_position = 0
+
+    def get_file_position(self):
+        return self.file_position
+
+    def pause_printjob(self, eventtime):
+        self.jobs[0].state = "paused"
+        self.pauses += 1
+
+    def resume_printjob(self, eventtime):
+        self.jobs[0].state = "printing"
+
+    def stop_printjob(self, eventtime):
+        self.jobs.pop(0)
+        self._next_job()
+
+    def _next_job(self):
+        """Start printing the next print job in the queue"""
+        self.file_position = 0
+        if self.jobs:
+            self.jobs[0].state = "printing"
+
+    def work(self, eventtime):
+        """Reactor timer: Read the current print job"""
+        if self.jobs and self.jobs[0].state == "printing":
+            if self.started is None:
+                self.started = time.monotonic()
+            size = os.path.getsize(self.jobs[0].path)
+            self.file_position = min(size,
+                    self.file_position + self.print_rate * 0.01)
+            if self.file_position >= size:
+                self.ended_early += size < self.final_size
+                self.jobs.pop(0)
+                self._next_job()
+                self.finished = time.monotonic()
+        return eventtime + 0.01
+
+
+class StreamBenchmarkModule(QueueBenchmarkModule):
+    """QueueBenchmarkModule printing uploads on a StreamingSdcard"""
+
+    send_print = CuraConnectionModule.send_print
+
+    def __init__(self, sdcard_path, prefix, print_rate, final_size):
+        super().__init__(sdcard_path, 0, None)
+        self.sdcard = StreamingSdcard(print_rate, final_size)
+        self.reactor.register_timer(self.sdcard.work, self.reactor.NOW)
+        if prefix:
+            self.stream_gate = StreamGate(self, prefix)
+            self.reactor.register_timer(self.stream_gate.check,
+                                        self.reactor.NOW)
+
+
+def throttled(body, rate):
+    """Yield body in chunks at rate bytes/s"""
+    chunk = 64 * 1024
+    for i in range(0, len(body), chunk):
+        time.sleep(chunk / rate)
+        yield body[i:i + chunk]
+
+
+@benchmark
+def stream_print():
+    """
+    Time until a 1.5 MiB G-code upload at 384 KiB/s starts and finishes
+    printing, waiting for the whole file or streaming it after 512 KiB,
+    for prints slower and faster than the upload.
+    """
+    size = 3 * MiB // 2
+    body = make_multipart(size, 40, 0, False)
+    print("{:>8} {:>10} {:>8} {:>8} {:>8} {:>8} {:>6}".format(
+        "stream", "print/s", "upload", "start", "done", "pauses", "early"))
+    for print_rate in (MiB // 5, 3 * MiB // 4):
+        for prefix in (0, MiB // 2):
+            out_dir = tempfile.mkdtemp(prefix="benchmark-")
+            module = StreamBenchmarkModule(out_dir, prefix, print_rate, size)
+            module.content_manager.start()
+            module.reactor.start()
+            srv = server.Server((module.ADDRESS, 0), server.Handler, module)
+            srv.start()
+            try:
+                start = time.monotonic()
+                conn = http.client.HTTPConnection(*srv.server_address)
+                conn.request("POST", server.CLUSTER_API + "print_jobs/",
+                        throttled(body, 3 * MiB // 8),
+                        {"Content-Type": "multipart/form-data; boundary="
+                                         + BOUNDARY,
+                         "Content-Length": str(len(body))})
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                assert response.status == 200, response.status
+                uploaded = time.monotonic() - start
+                sdcard = module.sdcard
+                while sdcard.finished is None and time.monotonic() < start + 30:
+                    time.sleep(0.01)
+            finally:
+                module.reactor.running = False
+                module.reactor.join()
+                srv.shutdown()
+                srv.join()
+                srv.server_close()
+                shutil.rmtree(out_dir)
+            print("{:>8} {:>8.0f}Ki {:>7.1f}s {:>7.1f}s {:>7.1f}s {:>8} {:>6}"
+                  .format("yes" if prefix else "no", print_rate / 1024,
+                          uploaded, sdcard.started - start,
+                          sdcard.finished - start, sdcard.pauses,
+                          sdcard.ended_early))
+
+
+def follow_print_jobs(address, strategy, end):
+    """
+    Follow the print jobs until end like a dashboard would, by polling
+    /print_jobs every 2s (with or without ETag) or by long-polling the
+    changes.  Return the number of requests, the bytes of the response
+    bodies and the time.monotonic() of every response showing a change.
+    """
+    conn = http.client.HTTPConnection(*address)
+    requests = received = 0
+    seen = []
+    etag = last = None
+    version = ""
+    while time.monotonic() < end:
+        headers = {}
+        if strategy == "long-poll":
+            path = "{}print_jobs/changes?since={}&timeout={}".format(
+                    server.CLUSTER_API, version, end - time.monotonic())
+        else:
+            path = server.CLUSTER_API + "print_jobs"
+            if strategy == "poll+etag" and etag is not None:
+                headers["If-None-Match"] = etag
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        requests += 1
+        received += len(body)
+        if strategy == "long-poll":
+            changes = json.loads(body)
+            if changes["version"] != version and requests > 1:
+                seen.append(time.monotonic())
+            version = changes["version"]
+        else:
+            etag = response.getheader("ETag")
+            if response.status == 200 and body != last and requests > 1:
+                seen.append(time.monotonic())
+            last = body if response.status == 200 else last
+            time.sleep(max(0, min(2, end - time.monotonic())))
+    conn.close()
+    return requests, received, seen
+
+
+@benchmark
+def watch():
+    """
+    Requests, traffic and update latency of following a queue of 30 print
+    jobs with one finishing every 3s, by polling and by long-polling.
+    """
+    duration = 12
+    print("{:>10} {:>10} {:>12} {:>10} {:>10}".format(
+        "strategy", "requests", "bytes", "updates", "latency ms"))
+    for strategy in ("poll", "poll+etag", "long-poll"):
+        module = QueueBenchmarkModule(tempfile.gettempdir(), 30, 3.0)
+        module.content_manager.start()
+        module.reactor.start()
+        srv = server.Server((module.ADDRESS, 0), server.Handler, module)
+        srv.start()
+        try:
+            time.sleep(0.05) # First snapshot
+            requests, received, seen = follow_print_jobs(
+                    srv.server_address, strategy, time.monotonic() + duration)
+        finally:
+            module.reactor.running = False
+            module.reactor.join()
+            srv.shutdown()
+            srv.join()
+            srv.server_close()
+        # Latency from the last finished print job to each update seen
+        finished = module.reactor.finish_times
+        latencies = [t - max(f for f in finished if f <= t) for t in seen]
+        print("{:>10} {:>10} {:>12} {:>10} {:>10.0f}".format(
+            strategy, requests, received, len(seen),
+            1000 * sum(latencies) / max(1, len(latencies))))
+
+
+class SelectReactor:
+    """
+    Stand-in for klippy's reactor that runs in the calling thread, as it
+    does in klippy:  Timers, fd callbacks and async callbacks from other
+    threads, with select() sleeping until the next timer is due.  How
+    late every timer runs after its waketime is recorded in lateness,
+    the CPU time of every callback in busy by the callback's name.
+    """
+
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.timers = [] # [callback, waketime]
+        self.fds = {} # fd: callback
+        self.callbacks = queue.Queue()
+        self.lateness = [] # Seconds
+        self.busy = {} # "module.qualname": [seconds]
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_write, False)
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = [callback, waketime]
+        self.timers.append(timer)
+        return timer
+
+    def unregister_timer(self, timer):
+        self.timers.remove(timer)
+
+    def register_callback(self, callback, waketime=NOW):
+        def once(eventtime):
+            self.unregister_timer(timer)
+            callback(eventtime)
+            return self.NEVER
+        timer = self.register_timer(once, waketime)
+
+    def register_async_callback(self, callback):
+        self.callbacks.put(callback)
+        try:
+            os.write(self._wake_write, b".")
+        except BlockingIOError: # Already woken up
+            pass
+
+    def register_fd(self, fd, callback):
+        self.fds[fd] = callback
+        return fd
+
+    def unregister_fd(self, fd):
+        del self.fds[fd]
+
+    def _call(self, callback, eventtime):
+        """Run callback, recording the CPU time it took"""
+        if isinstance(callback, functools.partial):
+            callback = callback.func
+        name = "{}.{}".format(callback.__module__, callback.__qualname__)
+        start = time.thread_time()
+        try:
+            return callback(eventtime)
+        finally:
+            self.busy.setdefault(name, []).append(time.thread_time() - start)
+
+    def run(self, duration):
+        """Run the reactor for duration seconds"""
+        end = time.monotonic() + duration
+        while True:
+            now = time.monotonic()
+            waketime = min([timer[1] for timer in self.timers] + [end])
+            if now >= end:
+                return
+            readable = select.select([self._wake_read] + list(self.fds),
+                                     [], [], max(0, waketime - now))[0]
+            eventtime = time.monotonic()
+            for fd in readable:
+                if fd == self._wake_read:
+                    os.read(fd, 4096)
+                    while not self.callbacks.empty():
+                        self._call(self.callbacks.get(), eventtime)
+                elif fd in self.fds:
+                    self._call(self.fds[fd], eventtime)
+            for timer in list(self.timers):
+                if timer[1] <= eventtime:
+                    if timer[1] != self.NOW:
+                        self.lateness.append(time.monotonic() - timer[1])
+                    timer[1] = self._call(timer[0], eventtime)
+
+    def module_busy(self):
+        """Return the CPU times of the callbacks of the module by name"""
+        package = CuraConnectionModule.__module__.rpartition(".")[0] + "."
+        return {name.replace(package, ""): times
+                for name, times in self.busy.items()
+                if name.startswith(package)}
+
+
+class BenchmarkConfig:
+    """Stand-in for klippy's config section and printer object"""
+
+    def __init__(self, reactor, options):
+        self.reactor = reactor
+        self.options = options
+        self.event_handlers = {}
+        self.objects = {}
+
+    def get_printer(self):
+        return self
+
+    def get_reactor(self):
+        return self.reactor
+
+    def getint(self, option, default, minval=None, maxval=None):
+        return self.options.get(option, default)
+
+    def getboolean(self, option, default):
+        return self.options.get(option, default)
+
+    def getchoice(self, option, choices, default):
+        return self.options.get(option, default)
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event):
+        for callback in self.event_handlers.get(event, ()):
+            callback()
+
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+
+class BenchmarkPrintStats:
+    """Stand-in for klipper's print_stats"""
+
+    def get_print_time_prediction(self):
+        return None, None
+
+
+def start_module(reactor, out_dir, options, sdcard):
+    """
+    Create a CuraConnectionModule with options on stand-ins for klippy's
+    objects and files in out_dir, start it through the klippy events like
+    klippy does and return it once its server is running.
+    """
+    make_materials(out_dir, 20)
+    filament_manager = BenchmarkFilamentManager(out_dir)
+    filament_manager.material["loaded"] = [
+            {"guid": next(iter(filament_manager.guid_to_path))}]
+    config = BenchmarkConfig(reactor, options)
+    config.objects = {
+        "virtual_sdcard": sdcard,
+        "print_stats": BenchmarkPrintStats(),
+        "filament_manager": filament_manager,
+    }
+    module = CuraConnectionModule(config)
+    module.SDCARD_PATH = module.MATERIAL_PATH = out_dir
+    config.send_event("klippy:connect")
+    config.send_event("klippy:ready")
+    deadline = time.monotonic() + 10
+    while module.server is None:
+        if time.monotonic() > deadline:
+            raise RuntimeError("No network to start the server on")
+        reactor.run(0.1)
+    reactor.run(1) # Let the server start up
+    reactor.lateness.clear()
+    reactor.busy.clear()
+    return module
+
+
+def stop_module(module):
+    """Shut the module down like klippy does, freeing the server port"""
+    module.printer.send_event("klippy:disconnect")
+    if not module.SERVER_PROCESS:
+        module.server.server_close()
+
+
+def upload_print_job(address, size):
+    """Upload a G-code file of size bytes, return the seconds it took"""
+    body = make_multipart(size, 40, 0, False)
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(*address)
+    conn.request("POST", server.CLUSTER_API + "print_jobs/", body,
+            {"Content-Type": "multipart/form-data; boundary=" + BOUNDARY})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    assert response.status == 200, response.status
+    return time.perf_counter() - start
+
+
+def klippy_work(eventtime):
+    """Timer standing in for klippy's own work, runs every millisecond"""
+    sum(range(200))
+    return eventtime + 0.001
+
+
+def lateness_stats(lateness):
+    """Return the p50, p90, p99, p99.9 and maximum of lateness in ms"""
+    lateness = sorted(lateness)
+    return [lateness[int(len(lateness) * q)] * 1000
+            for q in (0.5, 0.9, 0.99, 0.999)] + [lateness[-1] * 1000]
+
+
+@benchmark
+def jitter():
+    """
+    How late reactor timers run while klippy is idle and during a 100 MB
+    upload, with the server in a thread of the klippy process and in a
+    separate process.  The upload is sent from another process as well.
+    """
+    size = 100 * 1000 * 1000
+    print("{:>8} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "server", "upload", "MB/s", "timers", "p50 ms", "p99 ms", "max ms"))
+    with ProcessPoolExecutor(1) as pool:
+        # Fork the client before any server threads exist
+        pool.submit(time.sleep, 0).result()
+        for server_process in (False, True):
+            for upload in (False, True):
+                out_dir = tempfile.mkdtemp(prefix="benchmark-")
+                reactor = SelectReactor()
+                module = start_module(reactor, out_dir,
+                        {"server_process": server_process},
+                        BenchmarkSdcard([]))
+                reactor.register_timer(klippy_work, reactor.NOW)
+                try:
+                    if upload:
+                        future = pool.submit(upload_print_job,
+                                             (module.ADDRESS, 8008), size)
+                        while not future.done():
+                            reactor.run(0.1)
+                        seconds = future.result()
+                    else:
+                        reactor.run(3)
+                finally:
+                    stop_module(module)
+                    shutil.rmtree(out_dir)
+                p50, _, p99, _, worst = lateness_stats(reactor.lateness)
+                print("{:>8} {:>8} {:>8} {:>10} {:>10.2f} {:>10.2f} {:>10.2f}"
+                      .format("process" if server_process else "thread",
+                              "100 MB" if upload else "none",
+                              "{:.0f}".format(size / seconds / 1e6)
+                              if upload else "-", len(reactor.lateness),
+                              p50, p99, worst))
+
+
+def cura_load(address, duration, upload_size):
+    """
+    Act like two Cura instances and an operator on the server at address
+    for duration seconds, each in its own thread:
+      - Both Cura instances poll the printers and print jobs every 0.5s
+        (Cura does every 2s) over a kept-alive connection.
+      - One of them uploads a G-code file of upload_size bytes every 2s.
+      - The operator moves and deletes random queued print jobs and
+        pauses and resumes the current one, every 0.5s.
+    Return the number of requests by kind and of unexpected responses.
+    Conflicts with the queue changing in between are expected.
+    """
+    counts = {"poll": 0, "upload": 0, "action": 0, "failed": 0}
+    body = make_multipart(upload_size, 40, 0, False)
+    lock = threading.Lock()
+    end = time.monotonic() + duration
+    def send(conn, kind, method, path, body=None, headers={}):
+        conn.request(method, server.CLUSTER_API + path, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        with lock:
+            counts[kind] += 1
+            counts["failed"] += response.status not in (200, 409)
+        return data if response.status == 200 else None
+    def poll():
+        conn = http.client.HTTPConnection(*address)
+        send(conn, "poll", "GET", "materials")
+        while time.monotonic() < end:
+            send(conn, "poll", "GET", "printers")
+            send(conn, "poll", "GET", "print_jobs")
+            time.sleep(0.5)
+        conn.close()
+    def upload():
+        conn = http.client.HTTPConnection(*address)
+        while time.monotonic() < end:
+            send(conn, "upload", "POST", "print_jobs/", body,
+                 {"Content-Type": "multipart/form-data; boundary="
+                                  + BOUNDARY})
+            time.sleep(2)
+        conn.close()
+    def operate():
+        rng = random.Random(0)
+        conn = http.client.HTTPConnection(*address)
+        while time.monotonic() < end:
+            time.sleep(0.5)
+            jobs = json.loads(send(conn, "poll", "GET", "print_jobs"))
+            if len(jobs) < 2:
+                continue
+            action = rng.choice(("move", "delete", "pause"))
+            if action == "pause":
+                state = "print" if jobs[0]["status"] == "paused" else "pause"
+                send(conn, "action", "PUT",
+                     "print_jobs/{}/action".format(jobs[0]["uuid"]),
+                     json.dumps({"action": state}))
+            elif action == "move":
+                send(conn, "action", "POST",
+                     "print_jobs/{}/action/move".format(
+                         rng.choice(jobs[1:])["uuid"]),
+                     json.dumps({"list": "queued",
+                                 "to_position": rng.randrange(1, len(jobs))}))
+            else:
+                send(conn, "action", "DELETE", "print_jobs/"
+                     + rng.choice(jobs[1:])["uuid"])
+        conn.close()
+    threads = [threading.Thread(target=target)
+               for target in (poll, poll, upload, operate)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+@benchmark
+def latency():
+    """
+    How much the module disturbs klippy:  Lateness of the reactor's
+    timers and the CPU time the module takes in the reactor, with klippy
+    idle and with Cura polling, uploading and changing the queue (see
+    cura_load()), both with the server in klippy's process and in its
+    own.  Fails if the limits in LATENCY_LIMITS are exceeded.
+    """
+    duration = 10
+    upload_size = 16 * MiB
+    print("{:>8} {:>6} {:>6} {:>6} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}"
+          " {:>9} {:>9}".format("server", "polls", "upl", "acts", "timers",
+                                "p50 ms", "p90 ms", "p99 ms", "p99.9", "max",
+                                "cpu ms/s", "max cb ms"))
+    failures = []
+    with ProcessPoolExecutor(1) as pool:
+        # Fork the client before any server threads exist
+        pool.submit(time.sleep, 0).result()
+        for server_process, load in ((False, False), (False, True),
+                                     (True, True)):
+            out_dir = tempfile.mkdtemp(prefix="benchmark-")
+            reactor = SelectReactor()
+            sdcard = StreamingSdcard(MiB, upload_size)
+            module = start_module(reactor, out_dir,
+                    {"server_process": server_process}, sdcard)
+            reactor.register_timer(klippy_work, reactor.NOW)
+            reactor.register_timer(sdcard.work, reactor.NOW)
+            counts = {"poll": 0, "upload": 0, "action": 0, "failed": 0}
+            try:
+                if load:
+                    future = pool.submit(cura_load, (module.ADDRESS, 8008),
+                                         duration, upload_size)
+                    while not future.done():
+                        reactor.run(0.1)
+                    counts = future.result()
+                else:
+                    reactor.run(duration)
+            finally:
+                stop_module(module)
+                shutil.rmtree(out_dir)
+            name = "process" if server_process else "thread"
+            if not load:
+                name = "idle"
+            stats = lateness_stats(reactor.lateness)
+            busy = reactor.module_busy()
+            total = sum(sum(times) for times in busy.values())
+            slowest = max(busy, key=lambda n: max(busy[n]), default=None)
+            longest = max(busy[slowest]) if slowest else 0
+            print("{:>8} {:>6} {:>6} {:>6} {:>7} {:>7.2f} {:>7.2f} {:>7.2f}"
+                  " {:>7.2f} {:>7.2f} {:>9.3f} {:>9.3f}".format(
+                      name, counts["poll"],
+                      counts["upload"], counts["action"],
+                      len(reactor.lateness), *stats,
+                      total / duration * 1000, longest * 1000))
+            if counts["failed"]:
+                failures.append("{}: {} unexpected responses".format(
+                        name, counts["failed"]))
+            if load and stats[2] > LATENCY_LIMITS["p99"] * 1000:
+                failures.append("{}: p99 lateness {:.2f} ms".format(
+                        name, stats[2]))
+            if longest > LATENCY_LIMITS["callback"]:
+                failures.append("{}: {} took {:.2f} ms".format(
+                        name, slowest, longest * 1000))
+    assert not failures, "; ".join(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", metavar="name",
+            help="One of: " + ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: " + name)
+    failed = []
+    for name in args.names or BENCHMARKS:
+        print("=== {} ===".format(name))
+        try:
+            BENCHMARKS[name]()
+        except Exception as e:
+            print("FAILED: {}: {}".format(type(e).__name__, e))
+            failed.append(name)
+        print()
+    if failed:
+        sys.exit("Failed benchmarks: " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
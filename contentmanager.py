@@ -1,19 +1,99 @@
+from collections import namedtuple, OrderedDict
 from datetime import datetime
+import itertools
+import json
+import logging
 import os
+import threading
+import time
 import uuid as uuid_lib
+import zlib
 
+from .custom_exceptions import NotReadyError
+from .jobregistry import find_job, JobRegistry
+from .materialindex import MaterialIndex
 from .Models.Http.ClusterMaterial import ClusterMaterial
 from .Models.Http.ClusterPrintCoreConfiguration import (
         ClusterPrintCoreConfiguration)
 from .Models.Http.ClusterPrinterStatus import ClusterPrinterStatus
 from .Models.Http.ClusterPrintJobStatus import ClusterPrintJobStatus
 
+logger = logging.getLogger("root.server")
+
+
+# Immutable copy of the klippy state that is relevant to Cura.  A new one
+# is published by take_snapshot() from within the reactor, server threads
+# only ever read the latest one.
+#   loaded      Tuple of (extruder index, material guid) for loaded materials
+#   jobs        Tuple of JobSnapshot for the queue, current print job first
+#   remaining   Predicted remaining print time in seconds or None
+#   queue_version   Incremented every time the print jobs in the queue change
+Snapshot = namedtuple("Snapshot",
+                      ["loaded", "jobs", "remaining", "queue_version"])
+# job_id identifies the klippy print job for as long as it is queued, even
+# if the same file is queued more than once (see get_job_ids()).
+JobSnapshot = namedtuple("JobSnapshot", ["job_id", "path", "state",
+                                         "printed_time", "thumbnail_path"])
+
+
+class CachedResponse:
+    """
+    A JSON response body, encoded once for a given state of the content.
+    Instances are only ever replaced, never modified, so they can be
+    handed to server threads without further locking.  Only compressed
+    bodies are added once they are first requested.
+    """
+
+    # Content codings that can be sent, in order of preference
+    ENCODINGS = ("gzip", "deflate")
+    # Bodies smaller than this are always sent uncompressed
+    MIN_COMPRESS_SIZE = 1024
+
+    def __init__(self, content, generation, etag_prefix):
+        self.content = content # Serialized content, used to detect changes
+        self.generation = generation
+        # Like generation, but distinct across restarts
+        self.version = "{}-{}".format(etag_prefix, generation)
+        self.body = json.dumps(content).encode()
+        self.etag = '"{}"'.format(self.version)
+        self._compressed = {} # type: {str: bytes} by encoding
+
+    def encode(self, encoding):
+        """
+        Return a tuple (encoding, body, etag) of the body in encoding, one
+        of ENCODINGS.  encoding is None if the body is sent uncompressed,
+        because encoding was None or the body is too small.
+        """
+        if encoding is None or len(self.body) < self.MIN_COMPRESS_SIZE:
+            return None, self.body, self.etag
+        body = self._compressed.get(encoding)
+        if body is None:
+            # At worst two threads compress the same body at once
+            compressor = zlib.compressobj(
+                    wbits=31 if encoding == "gzip" else zlib.MAX_WBITS)
+            body = compressor.compress(self.body) + compressor.flush()
+            self._compressed[encoding] = body
+        return encoding, body, self.etag[:-1] + "-" + encoding + '"'
+
 
 class ContentManager:
 
+    # Number of print job states kept for get_print_job_changes()
+    JOB_HISTORY_SIZE = 64
+    # Seconds a request for the materials waits for them to be loaded
+    MATERIALS_TIMEOUT = 5
+
     def __init__(self, module):
         self.module = module
 
+        # Incremented every time the content of any endpoint changes
+        self.generation = 0
+        self._responses = {} # type: {str: CachedResponse}
+        self._built_from = {} # type: {str: Snapshot} per endpoint
+        self._lock = threading.Lock()
+        # Distinguishes ETags across restarts, when generation starts over
+        self._etag_prefix = uuid_lib.uuid4().hex[:8]
+
         self.printer_status = ClusterPrinterStatus(
             enabled=True,
             firmware_version=self.module.VERSION,
@@ -26,25 +106,110 @@ class ContentManager:
             uuid=self.new_uuid(),
             configuration=[],
         )
-        self.print_jobs = [] # type: [ClusterPrintJobStatus]
+        self.print_jobs = JobRegistry() # of ClusterPrintJobStatus
         self.materials = [] # type: [ClusterMaterial]
+        self.material_index = None # type: MaterialIndex
+        self._materials_loaded = threading.Event()
+        self._loaded = () # Loaded materials of the last update_printers()
+        # G-code metadata (see GcodeMetadata) of uploaded files by path,
+        # until a print job is created for them.  Then by print job UUID.
+        self.file_metadata = {}
+        self.job_metadata = {}
+
+        self.snapshot = Snapshot(loaded=(), jobs=(), remaining=None,
+                                 queue_version=0)
+        # Notified whenever a new snapshot is published
+        self._snapshot_changed = threading.Condition()
+        # Generation of the print_jobs response: {uuid: serialized job}
+        self._job_history = OrderedDict()
+        # Job IDs of the queued klippy print jobs: {id(job): (job, job ID)}.
+        # Holding on to the job keeps its id() from being reused.
+        self._job_ids = {}
+        self._next_job_id = itertools.count()
+        # Testing only: (job ID, path, start time) of fake prints
+        self._test_jobs = []
 
     def start(self):
         """
         Add to the list of local materials.
         Must be called later so that filament_manager is available.
+        The material index is loaded in the background, so that the
+        server can start right away.  Only requests for the materials
+        wait for it.
         """
-        for guid in self.module.filament_manager.guid_to_path:
-            version = int(self.module.filament_manager.get_info(guid,
-                    "./m:metadata/m:version"))
-            self.materials.append(ClusterMaterial(
-                guid=guid,
-                version=version,
-            ))
+        self.material_index = MaterialIndex(self.module.filament_manager,
+                os.path.join(self.module.MATERIAL_PATH,
+                             MaterialIndex.INDEX_FILE))
+        threading.Thread(target=self._load_materials,
+                         name="material-index", daemon=True).start()
+
+    def _load_materials(self):
+        try:
+            self.material_index.load()
+            self.update_materials()
+        except Exception:
+            # Rather serve no materials than none of the requests for them
+            logger.exception("Failed to load the materials")
+        finally:
+            self._materials_loaded.set()
+
+    def update_materials(self):
+        """
+        Rebuild the list of local materials from the material index,
+        leaving out those without a version, which Cura requires
+        """
+        versions = ((guid, self.material_index.get(guid)["version"])
+                    for guid in self.material_index.guids())
+        self.materials = [ClusterMaterial(guid=guid, version=version)
+                          for guid, version in versions if version is not None]
+
+    def materials_changed(self):
+        """Call after a material file has been added or changed"""
+        self.material_index.invalidate()
+        self.update_materials()
+        self.material_index.save()
+
+    def add_file_metadata(self, path, metadata):
+        """
+        Store the metadata of an uploaded file for its print job.  If a
+        print job without metadata already exists for the file, because
+        it was streamed to print, its metadata is set instead.
+        """
+        with self._lock:
+            print_job = self.print_jobs.get_by_path(path)
+            if print_job is None or self.job_metadata.get(print_job.uuid):
+                self.file_metadata[path] = metadata
+                return
+            self.job_metadata[print_job.uuid] = metadata
+            print_job.time_total = max(print_job.time_total,
+                                       metadata.get("time", 0))
+            # Rebuild the response even if the snapshot is the same
+            self._built_from.pop("print_jobs", None)
+
+    def get_thumbnail_path(self, uuid):
+        """
+        Return the path of the thumbnail klipper has for the print job
+        with uuid, otherwise of the one extracted while uploading or None.
+        """
+        ref = self.print_jobs.get_ref(uuid)
+        if ref is not None:
+            snapshot = self.snapshot
+            index = find_job([job.job_id for job in snapshot.jobs], ref,
+                             snapshot.queue_version)
+            if index is not None and snapshot.jobs[index].thumbnail_path:
+                return snapshot.jobs[index].thumbnail_path
+        return self.job_metadata.get(uuid, {}).get("thumbnail")
 
     def get_print_job_status(self, path):
         """Return a print job model for the given path"""
-        return ClusterPrintJobStatus(
+        # Removed in update_print_jobs(), the same file can be queued
+        # more than once at the same time
+        metadata = self.file_metadata.get(path)
+        if metadata is None:
+            queued = self.print_jobs.get_by_path(path)
+            metadata = ({} if queued is None
+                        else self.job_metadata.get(queued.uuid, {}))
+        print_job = ClusterPrintJobStatus(
             created_at=self.get_time_str(),
             force=False,
             machine_variant="Ultimaker 3",
@@ -54,83 +219,163 @@ class ContentManager:
             # pausing, paused, resuming, queued, printing, post_print
             # (possibly also aborted and aborting)
             status="queued",
-            time_total=0, #TODO set from the beginning
+            time_total=metadata.get("time", 0),
             time_elapsed=0,
             uuid=self.new_uuid(),
             configuration=self.printer_status.configuration, #TODO
             constraints=[],
         )
+        self.job_metadata[print_job.uuid] = metadata
+        return print_job
 
     def add_test_print(self, path):
         """
         Testing only: add a print job outside of klipper and pretend
         we're printing.
         """
-        self.print_jobs.append(self.get_print_job_status(path))
-        self.print_jobs[0].status = "printing"
-        self.print_jobs[0].started = True
-        self.print_jobs[0].time_total = 10000
-        self.print_jobs[0].time_elapsed += 2
-        self.print_jobs[0].assigned_to = self.printer_status.uuid
+        self._test_jobs.append((next(self._next_job_id), path, time.time()))
 
-        self.printer_status.status = "printing"
+    def get_test_queue(self):
+        """Testing only: return (job ID, path) of the test print jobs"""
+        return [(job_id, path) for job_id, path, _ in self._test_jobs]
 
-    def update_printers(self):
+    def set_test_queue(self, queue):
+        """
+        Testing only: set the test print jobs to queue, a list of
+        (job ID, path).  Print jobs with job ID None are new ones.
+        """
+        started = {job_id: start for job_id, _, start in self._test_jobs}
+        self._test_jobs = [
+            (next(self._next_job_id), path, time.time()) if job_id is None
+            else (job_id, path, started.get(job_id, time.time()))
+            for job_id, path in queue]
+
+    def get_job_ids(self, jobs):
+        """
+        Return the job IDs of the klippy print jobs, in the same order.
+        Print jobs that weren't queued before get a new job ID, those of
+        print jobs that aren't queued anymore are forgotten.  This must
+        be called from within the reactor, with all of the queued jobs.
+        """
+        known = self._job_ids
+        self._job_ids = {}
+        job_ids = []
+        for job in jobs:
+            entry = known.get(id(job))
+            if entry is None or entry[0] is not job:
+                entry = (job, next(self._next_job_id))
+            self._job_ids[id(job)] = entry
+            job_ids.append(entry[1])
+        return job_ids
+
+    def keep_job_id(self, job, job_id):
+        """
+        Give the klippy print job the job ID of the print job it replaces
+        in the queue.  Reactor only.
+        """
+        self._job_ids[id(job)] = (job, job_id)
+
+    def take_snapshot(self):
+        """
+        Publish a new Snapshot of the klippy state if it has changed.
+        This reads the klippy objects and must therefore be called from
+        within the reactor (or in testing mode, where there is none).
+        """
+        start = time.perf_counter()
+        loaded = tuple((i, material["guid"]) for i, material
+                in enumerate(self.module.filament_manager.material["loaded"])
+                if material["guid"] is not None)
+        if self.module.testing:
+            jobs = tuple(JobSnapshot(job_id, path,
+                                     "printing" if i == 0 else "queued",
+                                     int(time.time() - start) if i == 0 else 0,
+                                     None)
+                         for i, (job_id, path, start)
+                         in enumerate(self._test_jobs))
+            remaining = 10000
+        else:
+            sdcard_jobs = self.module.sdcard.jobs
+            jobs = tuple(JobSnapshot(job_id, job.path, job.state,
+                                     int(job.get_printed_time()),
+                                     job.thumbnail_path)
+                         for job_id, job in zip(self.get_job_ids(sdcard_jobs),
+                                                sdcard_jobs))
+            remaining = self.module.print_stats.get_print_time_prediction()[0]
+        queue_version = self.snapshot.queue_version
+        if ([job.job_id for job in jobs]
+                != [job.job_id for job in self.snapshot.jobs]):
+            queue_version += 1
+        self.publish_snapshot(
+                Snapshot(loaded, jobs, remaining, queue_version))
+        self.module.metrics.snapshot_duration.observe(
+                time.perf_counter() - start)
+
+    def publish_snapshot(self, snapshot):
+        """
+        Make snapshot the current Snapshot and wake up the requests
+        waiting for changes, unless it equals the current one.  Return
+        True if it was published.
+        """
+        if snapshot == self.snapshot:
+            return False
+        # Replacing the reference is atomic, no lock needed
+        self.snapshot = snapshot
+        with self._snapshot_changed:
+            self._snapshot_changed.notify_all()
+        return True
+
+    def update_printers(self, snapshot):
         """Update currently loaded material and state"""
+        if snapshot.loaded != self._loaded:
+            # Newly loaded materials might come from a changed file
+            self.material_index.invalidate(
+                    guid for _, guid in set(snapshot.loaded) - set(self._loaded))
+            self._loaded = snapshot.loaded
         configuration = []
-        fm = self.module.filament_manager
-        loaded_materials = fm.material["loaded"]
-        for i, material in enumerate(loaded_materials):
-            if material['guid'] is None:
-                continue
-            guid = material['guid']
-            brand = fm.get_info(guid, "./m:metadata/m:name/m:brand")
-            color = fm.get_info(guid, "./m:metadata/m:name/m:color")
-            material = fm.get_info(guid, "./m:metadata/m:name/m:material")
+        for i, guid in snapshot.loaded:
+            info = self.material_index.get(guid)
             configuration.append(ClusterPrintCoreConfiguration(
                 extruder_index=i,
                 material={
                     "guid": guid,
-                    "brand": brand,
-                    "color": color,
-                    "material": material,
+                    "brand": info["brand"],
+                    "color": info["color"],
+                    "material": info["material"],
                 },
             ))
         self.printer_status.configuration = configuration
-        if self.module.testing:
-            return
-        jobs = self.module.sdcard.jobs
+        jobs = snapshot.jobs
         if jobs and jobs[0].state in {"printing", "paused", "pausing", "stopping"}:
             self.printer_status.status = "printing"
         else:
             self.printer_status.status = "idle"
 
-    def update_print_jobs(self):
+    def update_print_jobs(self, snapshot):
         """Read queue, Update status, elapsed time"""
-        s = self.module.sdcard.get_status()
-
         # Update self.print_jobs with the queue
-        new_print_jobs = []
-        for klippy_pj in s["printjobs"]:
-            print_job = None
-            # Find first cura print job with the same name
-            for j, cura_pj in enumerate(self.print_jobs):
-                if cura_pj.name == os.path.basename(klippy_pj.path):
-                    print_job = self.print_jobs.pop(j)
-                    break
-            if print_job is None: # Newly added print job
-                new_print_jobs.append(self.get_print_job_status(klippy_pj.path))
-            else:
-                new_print_jobs.append(print_job)
-        self.print_jobs = new_print_jobs
+        queue = [(klippy_pj.job_id, klippy_pj.path)
+                 for klippy_pj in snapshot.jobs]
+        paths = [path for _, path in queue]
+        removed = self.print_jobs.update(queue, self.get_print_job_status,
+                                         snapshot.queue_version)
+        for print_job in removed:
+            self.job_metadata.pop(print_job.uuid, None)
+        for path in set(paths).intersection(self.file_metadata):
+            del self.file_metadata[path]
 
         if self.print_jobs: # Update first print job if there is one
-            current = s["printjobs"][0]
-            elapsed = current.get_printed_time()
-            remaining = self.module.print_stats.get_print_time_prediction()[0]
-            self.print_jobs[0].time_elapsed = int(elapsed)
+            current = snapshot.jobs[0]
+            elapsed = current.printed_time
+            remaining = snapshot.remaining
+            self.print_jobs[0].time_elapsed = elapsed
             self.print_jobs[0].assigned_to = self.printer_status.uuid
-            self.print_jobs[0].time_total = int(elapsed + (1 if remaining is None else remaining))
+            if remaining is None:
+                # No prediction yet, use the estimate from the G-code file
+                metadata = self.job_metadata[self.print_jobs[0].uuid]
+                self.print_jobs[0].time_total = max(elapsed + 1,
+                                                    metadata.get("time", 0))
+            else:
+                self.print_jobs[0].time_total = int(elapsed + remaining)
 
             # State
             if current.state == "stopping":
@@ -167,20 +412,145 @@ class ContentManager:
             raw = raw >> 8
         return ":".join([i.lstrip("0x").zfill(2) for i in hex_])
 
+    def uuid_to_job_ref(self, uuid):
+        """Return the JobRef for the print job with uuid or None"""
+        return self.print_jobs.get_ref(uuid)
+
     def uuid_to_print_job(self, uuid):
         """
         Return a tuple (index, print job) for the print job with the given
         UUID.  Return (None, None) if the UUID could not be found.
         """
-        return next(iter((i, pj) for i, pj in enumerate(self.print_jobs)
-            if pj.uuid == uuid), (None, None))
+        return self.print_jobs.get(uuid)
+
+    def _get_response(self, endpoint, content, snapshot=None):
+        """
+        Return the cached response for endpoint.  The body is only encoded
+        again and the generation increased if content has changed.
+        snapshot is remembered as the state the content was built from.
+        """
+        cached = self._responses.get(endpoint)
+        if cached is None or cached.content != content:
+            self.generation += 1
+            cached = CachedResponse(content, self.generation, self._etag_prefix)
+            self._responses[endpoint] = cached
+        self._built_from[endpoint] = snapshot
+        return cached
+
+    def _get_cached(self, endpoint, snapshot):
+        """Return the cached response if it was built from snapshot"""
+        if self._built_from.get(endpoint) is snapshot:
+            return self._responses[endpoint]
+        return None
+
+    def _get_snapshot(self):
+        """Return the latest snapshot, taking it directly in testing mode"""
+        if self.module.testing:
+            self.take_snapshot()
+        return self.snapshot
 
     def get_printer_status(self):
-        self.update_printers()
-        return [self.printer_status.serialize()]
+        snapshot = self._get_snapshot()
+        with self._lock:
+            cached = self._get_cached("printers", snapshot)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            self.update_printers(snapshot)
+            response = self._get_response("printers",
+                    [self.printer_status.serialize()], snapshot)
+            self._record_refresh("printers", start)
+            return response
+
     def get_print_jobs(self):
-        if not self.module.testing:
-            self.update_print_jobs()
-        return [m.serialize() for m in self.print_jobs]
+        snapshot = self._get_snapshot()
+        with self._lock:
+            cached = self._get_cached("print_jobs", snapshot)
+            if cached is not None:
+                return cached
+            start = time.perf_counter()
+            # Configuration of the print jobs is taken from the printer
+            self.update_printers(snapshot)
+            self.update_print_jobs(snapshot)
+            response = self._get_response("print_jobs",
+                    [m.serialize() for m in self.print_jobs], snapshot)
+            if response.generation not in self._job_history:
+                self._job_history[response.generation] = {
+                        job["uuid"]: job for job in response.content}
+                if len(self._job_history) > self.JOB_HISTORY_SIZE:
+                    self._job_history.popitem(last=False)
+            self._record_refresh("print_jobs", start)
+            return response
+
+    def get_print_job_changes(self, since, timeout):
+        """
+        Return the changes of the print jobs since version since (the
+        version of a print_jobs response, a string) as dict:
+            version     Version of the print jobs now
+            full        True if since is unknown, too old or from before
+                        a restart.  Then all print jobs are in added.
+            queue       UUIDs of all print jobs in queue order
+            added, modified     Serialized print jobs
+            removed     UUIDs of print jobs no longer queued
+        If nothing has changed, block up to timeout seconds until
+        something does.
+        """
+        since = self._version_generation(since)
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.snapshot
+            response = self.get_print_jobs()
+            remaining = deadline - time.monotonic()
+            if response.generation != since or remaining <= 0:
+                break
+            with self._snapshot_changed:
+                if self.snapshot is snapshot:
+                    # Without reactor snapshots are only taken on request
+                    self._snapshot_changed.wait(min(remaining, 1)
+                            if self.module.testing else remaining)
+        with self._lock:
+            old = self._job_history.get(since)
+            new = self._job_history.get(response.generation, {})
+        changes = {
+            "version": response.version,
+            "full": old is None,
+            "queue": [job["uuid"] for job in response.content],
+        }
+        if old is None:
+            changes.update(added=response.content, modified=[], removed=[])
+        else:
+            changes.update(
+                added=[job for uuid, job in new.items() if uuid not in old],
+                modified=[job for uuid, job in new.items()
+                          if uuid in old and old[uuid] != job],
+                removed=[uuid for uuid in old if uuid not in new])
+        return changes
+
+    def _version_generation(self, version):
+        """
+        Return the generation of a response version, or None if it isn't
+        one from this run
+        """
+        prefix, _, generation = version.rpartition("-")
+        if prefix != self._etag_prefix:
+            return None
+        try:
+            return int(generation)
+        except ValueError:
+            return None
+
     def get_materials(self):
-        return [m.serialize() for m in self.materials]
+        """Raise NotReadyError if the materials are still loading"""
+        if not self._materials_loaded.wait(self.MATERIALS_TIMEOUT):
+            raise NotReadyError("Materials are still loading")
+        with self._lock:
+            start = time.perf_counter()
+            response = self._get_response("materials",
+                    [m.serialize() for m in self.materials])
+            self._record_refresh("materials", start)
+            return response
+
+    def _record_refresh(self, endpoint, start):
+        """Record the time since start of rebuilding a response"""
+        self.module.metrics.refresh_duration.observe(
+                time.perf_counter() - start, (endpoint,))
@@ -7,16 +7,27 @@ does,  which is doing most of the work  outside of initializing and
 shutting down,  which is handled in the CuraConnectionModule class.
 """
 
+from concurrent.futures import Future, TimeoutError
 import logging
 import logging.handlers
 import os
 import platform
 import socket
+import threading
 import time
 
+from . import asyncserver
 from .contentmanager import ContentManager
-from .custom_exceptions import QueuesDesynchronizedError
+from .custom_exceptions import QueuesDesynchronizedError, ReactorTimeoutError
+from .diskspace import DiskSpace
+from .fileindex import FileIndex
+from .jobregistry import find_job
+from .metrics import Metrics
+from .nameindex import NameIndex
 from . import server
+from .streamprint import StreamGate
+from .thumbnails import ThumbnailCache
+from .uploads import UploadStore
 from .zeroconfhandler import ZeroConfHandler
 
 
@@ -25,6 +36,28 @@ class CuraConnectionModule:
     # How many seconds after the last request to consider disconnected
     # 4.2 allows missing just one update cycle (every 2sec)
     CONNECTION_TIMEOUT = 4.2
+    # Seconds between snapshots of the klippy state taken for the server
+    SNAPSHOT_INTERVAL = 1.0
+    # Seconds to wait for the reactor to apply changes to the queue
+    REACTOR_TIMEOUT = 5.0
+
+    # Defaults for the options in the config section
+    UPLOAD_BLOCK_SIZE = 256 * 1024 # Bytes read at once from uploads
+    SERVER_ENGINE = "threading" # One of "threading" or "asyncio"
+    SERVER_WORKERS = 8 # Threads handling requests
+    SERVER_QUEUE_SIZE = 16 # Requests waiting for a worker before 503
+    MAX_POLLS = 4 # Concurrent GET requests
+    MAX_UPLOADS = 2 # Concurrent uploads of print jobs and materials
+    MAX_WATCHES = 2 # Concurrent long-polls for print job changes
+    # Bytes of a G-code upload on disk before it may start printing,
+    # 0 to wait for the whole file
+    STREAM_PRINT_PREFIX = 0
+    # Replace uploads of files that already exist with the existing file
+    DEDUPLICATE_UPLOADS = True
+    # Bytes on the SD card that uploads must leave free
+    DISK_RESERVE = 64 * 1024 * 1024
+    # Run the server in a separate process, see serverprocess.py
+    SERVER_PROCESS = False
 
     def __init__(self, config):
         self.testing = config is None
@@ -39,6 +72,10 @@ class CuraConnectionModule:
         self.ADDRESS = None
 
         self.content_manager = self.zeroconf_handler = self.server = None
+        self.thumbnail_cache = self.file_index = self.name_index = None
+        self.snapshot_timer = self.stream_timer = None
+        self.stream_gate = self.uploads = self.disk_space = None
+        self.metrics = Metrics()
 
         self.configure_logging()
         self.klippy_logger.info("Cura Connection Module initializing...")
@@ -50,6 +87,29 @@ class CuraConnectionModule:
             self.filament_manager = filament_manager.load_config(None)
             return
         self.config = config
+        self.UPLOAD_BLOCK_SIZE = config.getint("upload_block_size",
+                self.UPLOAD_BLOCK_SIZE, minval=65536, maxval=1048576)
+        self.SERVER_ENGINE = config.getchoice("server_engine",
+                {"threading": "threading", "asyncio": "asyncio"},
+                self.SERVER_ENGINE)
+        self.SERVER_WORKERS = config.getint("server_workers",
+                self.SERVER_WORKERS, minval=2, maxval=32)
+        self.SERVER_QUEUE_SIZE = config.getint("server_queue_size",
+                self.SERVER_QUEUE_SIZE, minval=1)
+        self.MAX_POLLS = config.getint("max_polls",
+                self.MAX_POLLS, minval=1)
+        self.MAX_UPLOADS = config.getint("max_uploads",
+                self.MAX_UPLOADS, minval=1)
+        self.MAX_WATCHES = config.getint("max_watches",
+                self.MAX_WATCHES, minval=0)
+        self.STREAM_PRINT_PREFIX = config.getint("stream_print_prefix",
+                self.STREAM_PRINT_PREFIX, minval=0)
+        self.DEDUPLICATE_UPLOADS = config.getboolean("deduplicate_uploads",
+                self.DEDUPLICATE_UPLOADS)
+        self.DISK_RESERVE = config.getint("disk_reserve",
+                self.DISK_RESERVE, minval=0)
+        self.SERVER_PROCESS = config.getboolean("server_process",
+                self.SERVER_PROCESS)
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
         self.printer.register_event_handler("klippy:connect", self.handle_connect)
@@ -113,15 +173,51 @@ class CuraConnectionModule:
     def start(self):
         """Start the zeroconf service, and the server in a seperate thread"""
         self.content_manager = ContentManager(self)
-        self.zeroconf_handler = ZeroConfHandler(self)
-        self.server = server.get_server(self)
+        if self.STREAM_PRINT_PREFIX:
+            self.stream_gate = StreamGate(self, self.STREAM_PRINT_PREFIX)
+        if self.SERVER_PROCESS:
+            # Imported here because it builds on this module
+            from .serverprocess import ServerProcess
+            # Everything else is set up in the server process
+            self.server = ServerProcess(self)
+        else:
+            self.setup_server()
 
-        self.content_manager.start()
-        self.zeroconf_handler.start() # Non-blocking
-        self.klippy_logger.debug("Cura Connection Zeroconf service started")
+        if not self.testing:
+            self.snapshot_timer = self.reactor.register_timer(
+                    self.update_snapshot, self.reactor.NOW)
+            if self.stream_gate is not None:
+                self.stream_timer = self.reactor.register_timer(
+                        self.stream_gate.check, self.reactor.NOW)
+        if self.zeroconf_handler is not None:
+            self.zeroconf_handler.start() # Non-blocking
+            self.klippy_logger.debug("Cura Connection Zeroconf service started")
         self.server.start() # Starts server thread
         self.klippy_logger.debug("Cura Connection Server started")
 
+    def setup_server(self):
+        """
+        Create the server with the zeroconf service and the file indexes
+        it uses, and start loading the materials.
+        """
+        self.thumbnail_cache = ThumbnailCache(
+                os.path.join(self.SDCARD_PATH, ".thumbnails"))
+        self.name_index = NameIndex(self.SDCARD_PATH)
+        self.uploads = UploadStore(os.path.join(self.SDCARD_PATH, ".uploads"))
+        self.disk_space = DiskSpace(self.SDCARD_PATH, self.DISK_RESERVE)
+        if self.DEDUPLICATE_UPLOADS:
+            self.file_index = FileIndex(self.SDCARD_PATH,
+                    os.path.join(self.SDCARD_PATH, FileIndex.INDEX_FILE))
+            # Hashing new files can take a while, don't wait for it
+            threading.Thread(target=self.file_index.load,
+                             name="file-index", daemon=True).start()
+        self.zeroconf_handler = ZeroConfHandler(self)
+        if self.SERVER_ENGINE == "asyncio":
+            self.server = asyncserver.get_server(self)
+        else:
+            self.server = server.get_server(self)
+        self.content_manager.start()
+
     def stop(self, *args):
         """
         This might take a little while, be patient
@@ -131,13 +227,32 @@ class CuraConnectionModule:
             # stop() is called before start()
             return
         self.klippy_logger.debug("Cura Connection shutting down server...")
-        self.zeroconf_handler.stop()
-        self.klippy_logger.debug("Cura Connection Zeroconf shut down")
+        if self.snapshot_timer is not None:
+            self.reactor.unregister_timer(self.snapshot_timer)
+            self.snapshot_timer = None
+        if self.stream_timer is not None:
+            self.reactor.unregister_timer(self.stream_timer)
+            self.stream_timer = None
+        if self.zeroconf_handler is not None:
+            self.zeroconf_handler.stop()
+            self.klippy_logger.debug("Cura Connection Zeroconf shut down")
         if self.server.is_alive():
             self.server.shutdown()
             self.server.join()
             self.klippy_logger.debug("Cura Connection Server shut down")
 
+    def update_snapshot(self, eventtime):
+        """
+        Reactor timer: Let the content manager take a snapshot of the
+        klippy state, so that server threads never access klippy objects
+        directly.  This happens once per SNAPSHOT_INTERVAL, regardless of
+        how many clients are polling.
+        """
+        self.content_manager.take_snapshot()
+        if self.SERVER_PROCESS:
+            self.server.send_snapshot()
+        return eventtime + self.SNAPSHOT_INTERVAL
+
     def is_connected(self):
         """
         Return true if there currently is an active connection.
@@ -152,64 +267,172 @@ class CuraConnectionModule:
             self.klippy_logger.info("Start printing %s", path)
             self.content_manager.add_test_print(path)
             return
-        self.reactor.register_async_callback(
+        self.run_in_reactor("add_printjob",
                 lambda e: self.sdcard.add_printjob(path))
 
-    def resume_print(self, filename):
-        self._verify_queue(0, filename)
-        self.reactor.register_async_callback(self.sdcard.resume_printjob)
+    def run_in_reactor(self, name, callback):
+        """
+        Let the reactor call callback(eventtime) from any thread and
+        record how long that took to happen under name in the metrics.
+        """
+        queued = time.perf_counter()
+        def run(eventtime):
+            self.metrics.reactor_handoff.observe(
+                    time.perf_counter() - queued, (name,))
+            return callback(eventtime)
+        self.reactor.register_async_callback(run)
+
+    def call_in_reactor(self, name, func):
+        """
+        Call func(eventtime) in the reactor and wait for it to return.
+        Its return value is returned and its exceptions are raised here.
+        Raise ReactorTimeoutError if the reactor doesn't get to it within
+        REACTOR_TIMEOUT, func is then never called.
+        """
+        future = Future()
+        def call(eventtime):
+            if not future.set_running_or_notify_cancel():
+                return # The calling thread gave up waiting
+            try:
+                result = func(eventtime)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        self.run_in_reactor(name, call)
+        try:
+            return future.result(self.REACTOR_TIMEOUT)
+        except TimeoutError:
+            if future.cancel():
+                raise ReactorTimeoutError()
+            # func started running just now, wait for it to finish
+            return future.result()
 
-    def pause_print(self, filename):
-        self._verify_queue(0, filename)
-        self.reactor.register_async_callback(self.sdcard.pause_printjob)
+    def resume_print(self, ref):
+        self._current_job_action("resume_printjob", ref)
 
-    def stop_print(self, filename):
-        self._verify_queue(0, filename)
-        self.reactor.register_async_callback(self.sdcard.stop_printjob)
+    def pause_print(self, ref):
+        self._current_job_action("pause_printjob", ref)
 
-    def send_queue(self, queue):
-        self.sdcard.clear_queue()
-        for q in queue[1:]:
-            self.reactor.register_async_callback(
-                    lambda e: self.sdcard.add_printjob(*q))
+    def stop_print(self, ref):
+        self._current_job_action("stop_printjob", ref)
 
-    def queue_delete(self, index, filename):
+    def _current_job_action(self, action, ref):
         """
-        Delete the print job from the queue.
+        Call the virtual_sdcard method action if the print job ref is
+        (still) the current one, otherwise raise QueuesDesynchronizedError.
         """
-        self._verify_queue(index, filename)
-        queue = self.sdcard.jobs
-        queue.pop(index)
-        self.send_queue(queue)
-
-    def queue_move(self, old_index, new_index, filename):
-        self._verify_queue(old_index, filename)
-        queue = self.sdcard.jobs
-        if not 0 < new_index < len(queue):
-            raise IndexError(
-                "Can't move print job to index {}".format(new_index))
-        to_move = queue.pop(old_index)
-        queue.insert(new_index, to_move)
-        self.send_queue(queue)
-
-    def get_thumbnail_path(self, index, filename):
-        """Return the thumbnail path for the specified printjob"""
-        self._verify_queue(index, filename)
-        return (self.sdcard.jobs[index].thumbnail_path or
-                os.path.join(self.PATH, "default.png"))
-
-    def _verify_queue(self, index, filename):
-        """
-        Raise QueuesDesynchronizedError if filename is not at index in queue.
-        The index is checked as well as the filename in order to detect
-        changes in the queue that have not yet been updated in the
-        content manager.
-        """
-        queue = self.sdcard.jobs
-        try:
-            assert os.path.basename(queue[index].path) == filename
-        except (IndexError, AssertionError):
+        if self.testing:
+            self.klippy_logger.info("%s %s", action, ref.path)
+            return
+        self.call_in_reactor(action,
+                lambda eventtime: self._job_action(action, ref, eventtime))
+
+    def _job_action(self, action, ref, eventtime):
+        """Reactor callback of _current_job_action()"""
+        self.content_manager.take_snapshot()
+        snapshot = self.content_manager.snapshot
+        if find_job([job.job_id for job in snapshot.jobs], ref,
+                    snapshot.queue_version) != 0:
             raise QueuesDesynchronizedError()
+        getattr(self.sdcard, action)(eventtime)
+
+    def edit_queue(self, edits):
+        """
+        Apply a batch of edits to the queue atomically, in a single
+        reactor callback, and wait for it to be done.  Each edit is one
+        of the following tuples:
+            ("delete", ref)
+            ("move", ref, new_index)
+            ("insert", index, path)
+        Print jobs are given as JobRef, so that edits still apply to the
+        right print job if the queue has changed in the meantime.  Only
+        moving a print job that is no longer queued is a conflict and
+        raises QueuesDesynchronizedError.  Deleting it does nothing.
+        The current print job at index 0 can't be changed.  If an edit
+        fails, none are applied.  Return the paths of the new queue.
+        """
+        if self.testing:
+            queue = self.apply_queue_edits(
+                    self.content_manager.get_test_queue(), edits, None)
+            self.content_manager.set_test_queue(queue)
+            return [path for _, path in queue]
+        return self.call_in_reactor("edit_queue",
+                lambda eventtime: self._edit_queue(edits, eventtime))
+
+    def _edit_queue(self, edits, eventtime):
+        """Reactor callback of edit_queue()"""
+        # Make sure the queue version matches the current queue
+        self.content_manager.take_snapshot()
+        snapshot = self.content_manager.snapshot
+        old_queue = [(job.job_id, job.path) for job in snapshot.jobs]
+        queue = self.apply_queue_edits(old_queue, edits,
+                                       snapshot.queue_version)
+        if queue != old_queue:
+            self.replace_queue(queue)
+            self.content_manager.take_snapshot()
+        return [path for _, path in queue]
+
+    def replace_queue(self, queue):
+        """
+        Reactor only: Replace the print jobs after the current one with
+        those in queue[1:], a list of (job ID, path).  Print jobs that are
+        queued again keep their job ID, those with job ID None are new.
+        """
+        self.sdcard.clear_queue() # Keeps the current print job
+        for job_id, path in queue[1:]:
+            queued = len(self.sdcard.jobs)
+            self.sdcard.add_printjob(path)
+            if job_id is not None and len(self.sdcard.jobs) > queued:
+                self.content_manager.keep_job_id(self.sdcard.jobs[-1], job_id)
+
+    def apply_queue_edits(self, queue, edits, version):
+        """
+        Return a new queue with edits (see edit_queue) applied.  The
+        queue is given as list of (job ID, path), inserted print jobs get
+        job ID None.  version is the queue version of queue.
+        """
+        queue = list(queue)
+        for edit in edits:
+            if edit[0] == "insert":
+                _, index, path = edit
+                if not 0 < index <= len(queue):
+                    raise IndexError(
+                        "Can't insert print job at index {}".format(index))
+                queue.insert(index, (None, path))
+                version = None # Indices of JobRefs are no longer valid
+                continue
+            ref = edit[1]
+            index = find_job([job_id for job_id, _ in queue], ref, version)
+            self.metrics.queue_edits.inc((
+                "conflict" if index is None
+                else "current" if ref.version == version else "rebased",))
+            if index == 0:
+                raise IndexError("Can't change the current print job")
+            if edit[0] == "delete":
+                if index is not None:
+                    queue.pop(index)
+            elif edit[0] == "move":
+                new_index = edit[2]
+                if index is None:
+                    raise QueuesDesynchronizedError()
+                if not 0 < new_index < len(queue):
+                    raise IndexError(
+                        "Can't move print job to index {}".format(new_index))
+                queue.insert(new_index, queue.pop(index))
+            else:
+                raise ValueError("Unknown queue edit: " + str(edit[0]))
+            version = None
+        return queue
+
+    def queue_delete(self, ref):
+        """
+        Delete the print job from the queue.
+        """
+        return self.edit_queue([("delete", ref)])
+
+    def queue_move(self, ref, new_index):
+        return self.edit_queue([("move", ref, new_index)])
 
 
 def load_config(config):
@@ -1,2 +1,8 @@
 class QueuesDesynchronizedError(Exception):
     pass
+
+class ReactorTimeoutError(Exception):
+    pass
+
+class NotReadyError(Exception):
+    pass
@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger("root.server")
+
+class Reservation:
+    """
+    Disk space set aside for an upload of size bytes, as a stage of
+    MimeParser:  Every byte fed to it is on disk now and no longer
+    reserved.
+    """
+
+    def __init__(self, disk_space, size):
+        self.disk_space = disk_space
+        self.size = size
+        self.written = 0
+
+    def remaining(self):
+        return max(0, self.size - self.written)
+
+    def feed(self, data):
+        self.written += len(data)
+
+    def finish(self):
+        pass
+
+    def release(self):
+        """Give back what is left of the reservation"""
+        self.disk_space.release(self)
+
+
+class DiskSpace:
+    """
+    Admission control for uploads to the file system of directory.  An
+    upload is only admitted if its size fits into the free space minus
+    reserve bytes, which are kept free for klipper and the system, and
+    minus what is still reserved by uploads in progress, so that these
+    can't overcommit the disk together.
+    """
+
+    def __init__(self, directory, reserve):
+        self.directory = directory
+        self.reserve = reserve
+        self._reservations = set()
+        self._lock = threading.Lock()
+
+    def free(self):
+        """Return the bytes available to unprivileged users"""
+        stat = os.statvfs(self.directory)
+        return stat.f_bavail * stat.f_frsize
+
+    def available(self):
+        """Return the bytes that can still be reserved"""
+        with self._lock:
+            return self._available()
+
+    def _available(self):
+        reserved = sum(r.remaining() for r in self._reservations)
+        return self.free() - self.reserve - reserved
+
+    def reserve_space(self, size):
+        """
+        Return a Reservation of size bytes, or None if there isn't enough
+        space.  A size of 0 (unknown) is admitted as long as anything is
+        available.  Raises OSError if the free space can't be determined.
+        """
+        with self._lock:
+            available = self._available()
+            if size > available or available <= 0:
+                logger.warning("Not enough disk space for %d bytes, %d"
+                               " available", size, available)
+                return None
+            reservation = Reservation(self, size)
+            self._reservations.add(reservation)
+            return reservation
+
+    def release(self, reservation):
+        with self._lock:
+            self._reservations.discard(reservation)
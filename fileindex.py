@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger("root.server")
+
+class ContentHash:
+    """
+    Compute the SHA-256 of a file while it is being written, as a stage
+    of MimeParser.  hexdigest is set once finish() is called.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.hexdigest = None
+        self._hash = hashlib.sha256()
+
+    def feed(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.hexdigest = self._hash.hexdigest()
+
+
+class FileIndex:
+    """
+    SHA-256 hashes of the G-code files in directory, so that uploads of
+    files that already exist can be dropped in favour of those.
+
+    Like the MaterialIndex, it is persisted in index_path (if given)
+    together with the modification time and size of every file, and on
+    load() only files that changed since are hashed again.  Entries are
+    checked against their file again before they are used.
+    """
+
+    INDEX_FILE = ".file_index.json"
+    EXTENSIONS = (".gcode", ".gco", ".g")
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, directory, index_path=None):
+        self.directory = directory
+        self.index_path = index_path
+        self._entries = {} # path: {"hash", "mtime", "size"}
+        self._by_hash = {} # hash: path of one file with that content
+        self._dirty = False # Entries changed since the last save()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Hash all G-code files in directory, reusing the persisted index"""
+        start = time.monotonic()
+        if self.index_path is not None:
+            try:
+                with open(self.index_path) as fp:
+                    stored = json.load(fp)
+                with self._lock:
+                    for path, entry in stored.items():
+                        self._entries.setdefault(path, entry)
+            except (OSError, ValueError) as e:
+                logger.info("No valid file index: %s", e)
+        paths = set()
+        hashed = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for dir_entry in it:
+                    name = dir_entry.name.lower()
+                    if dir_entry.is_file() and name.endswith(self.EXTENSIONS):
+                        paths.add(dir_entry.path)
+                        hashed += not self._validate(dir_entry.path)
+        except OSError as e:
+            logger.error("Failed to index %s: %s", self.directory, e)
+        with self._lock:
+            # Forget files that no longer exist, keep ones added meanwhile
+            for path in set(self._entries).difference(paths):
+                if not os.path.exists(path):
+                    del self._entries[path]
+                    self._dirty = True
+            self._by_hash = {}
+            for path, entry in sorted(self._entries.items()):
+                self._by_hash.setdefault(entry["hash"], path)
+        self.save()
+        logger.info("File index loaded: %d files, %d hashed in %.3fs",
+                    len(paths), hashed, time.monotonic() - start)
+
+    def save(self):
+        """Write the index to index_path, if anything has changed"""
+        if self.index_path is None or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self._entries)
+            self._dirty = False
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(self.index_path))
+            with os.fdopen(fd, "w") as fp:
+                fp.write(data)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error("Failed to save file index: %s", e)
+
+    def add(self, path, hexdigest):
+        """Add a file that has just been written with the given hash"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[path] = {"hash": hexdigest, "mtime": stat.st_mtime,
+                                   "size": stat.st_size}
+            self._by_hash.setdefault(hexdigest, path)
+            self._dirty = True
+
+    def find(self, hexdigest, size):
+        """
+        Return the path of an unchanged file with the given hash and size,
+        or None if there is none.
+        """
+        with self._lock:
+            path = self._by_hash.get(hexdigest)
+            entry = self._entries.get(path)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(path)
+            unchanged = (stat.st_mtime == entry["mtime"]
+                         and stat.st_size == entry["size"])
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            self._forget(path)
+            return None
+        return path if entry["size"] == size else None
+
+    def _forget(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                return
+            self._dirty = True
+            if self._by_hash.get(entry["hash"]) == path:
+                del self._by_hash[entry["hash"]]
+                # Fall back to another file with the same content
+                for other, other_entry in self._entries.items():
+                    if other_entry["hash"] == entry["hash"]:
+                        self._by_hash[entry["hash"]] = other
+                        break
+
+    def _validate(self, path):
+        """
+        Make sure the entry for path matches its file, hashing the file if
+        it doesn't.  Return True if the entry was already up to date.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        entry = self._entries.get(path)
+        if (entry is not None and entry["mtime"] == stat.st_mtime
+                and entry["size"] == stat.st_size):
+            return True
+        content_hash = ContentHash(path)
+        try:
+            with open(path, "rb") as fp:
+                for data in iter(lambda: fp.read(self.READ_SIZE), b""):
+                    content_hash.feed(data)
+        except OSError as e:
+            logger.error("Failed to hash %s: %s", path, e)
+            return False
+        content_hash.finish()
+        with self._lock:
+            self._entries[path] = {"hash": content_hash.hexdigest,
+                                   "mtime": stat.st_mtime,
+                                   "size": stat.st_size}
+            self._dirty = True
+        return False
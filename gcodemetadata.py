@@ -0,0 +1,62 @@
+import logging
+import re
+
+logger = logging.getLogger("root.server")
+
+class GcodeMetadata:
+    """
+    Extract the metadata that Cura writes as comments into a G-code file
+    while that file is being written, as a stage of MimeParser.
+
+    Only the first HEAD_SIZE and the last TAIL_SIZE bytes are kept, so
+    the file is never read a second time.  After finish() has been
+    called, metadata holds whatever could be found of:
+
+    time            Estimated print time in seconds (;TIME:)
+    filament_used   List of filament lengths in m per extruder
+                    (;Filament used:)
+    layer_height    Layer height in mm (;Layer height:)
+    layer_count     Number of layers (;LAYER_COUNT:)
+    """
+
+    # Cura places the header at the very top, but LAYER_COUNT only
+    # follows after the start G-code.
+    HEAD_SIZE = 4096
+    TAIL_SIZE = 1024
+
+    PATTERNS = {
+        "time": (re.compile(rb"^;TIME:(\d+)", re.M), int),
+        "filament_used": (re.compile(rb"^;Filament used:(.*)$", re.M),
+            lambda value: [float(f) for f in re.findall(rb"\d+\.?\d*", value)]),
+        "layer_height": (re.compile(rb"^;Layer height:\s*(\d+\.?\d*)", re.M),
+            float),
+        "layer_count": (re.compile(rb"^;LAYER_COUNT:(\d+)", re.M), int),
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.metadata = {}
+        self._head = bytearray()
+        self._tail = b""
+
+    def feed(self, data):
+        """Remember the beginning and the end of the file"""
+        if len(self._head) < self.HEAD_SIZE:
+            self._head += data[:self.HEAD_SIZE - len(self._head)]
+        if len(data) >= self.TAIL_SIZE:
+            self._tail = bytes(data[-self.TAIL_SIZE:])
+        else:
+            self._tail = (self._tail + bytes(data))[-self.TAIL_SIZE:]
+
+    def finish(self):
+        """Search the beginning and the end of the file for metadata"""
+        text = bytes(self._head) + b"\n" + self._tail
+        for key, (pattern, convert) in self.PATTERNS.items():
+            match = pattern.search(text)
+            if match:
+                try:
+                    self.metadata[key] = convert(match.group(1))
+                except ValueError:
+                    logger.warning("Invalid %s in G-code: %s", key,
+                                   match.group(1))
+        logger.debug("Metadata of %s: %s", self.path, self.metadata)
@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+# Identifies a queued print job to klipper, independent of its index: It
+# is the job with job_id, which the content manager gives every klippy
+# print job for as long as it is queued.  index and version tell where it
+# was in the queue of that version.
+JobRef = namedtuple("JobRef", ["path", "job_id", "index", "version"])
+
+
+def find_job(job_ids, ref, version=None):
+    """
+    Return the index of the print job ref in the queue given as list of
+    job IDs, or None if it isn't queued anymore.  If version is the queue
+    version of job_ids and the same as that of ref, ref's index is used
+    without searching.
+    """
+    if (ref.version is not None and ref.version == version
+            and ref.index < len(job_ids) and job_ids[ref.index] == ref.job_id):
+        return ref.index
+    try:
+        return job_ids.index(ref.job_id)
+    except ValueError:
+        return None
+
+
+class JobRegistry:
+    """
+    The Cura print jobs in queue order, indexed by UUID and by path.
+
+    The queue is replaced as a whole by update(), which keeps using the
+    existing print job models for job IDs that are still queued.  Lookups
+    by UUID or path only read a single dict that is swapped out on
+    update, so they don't need to be locked against updates.
+    """
+
+    def __init__(self):
+        self._jobs = [] # [(job ID, path, print job)] in queue order
+        self._by_uuid = {} # UUID: (print job, JobRef)
+        self._by_path = {} # path: [print jobs] in queue order
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, index):
+        return self._jobs[index][2]
+
+    def __iter__(self):
+        return (print_job for _, _, print_job in self._jobs)
+
+    def get(self, uuid):
+        """
+        Return a tuple (index, print job) for the print job with the given
+        UUID.  Return (None, None) if the UUID could not be found.
+        """
+        print_job, ref = self._by_uuid.get(uuid, (None, None))
+        return (None, None) if ref is None else (ref.index, print_job)
+
+    def get_path(self, uuid):
+        """Return the path of the print job with UUID or None"""
+        ref = self.get_ref(uuid)
+        return None if ref is None else ref.path
+
+    def get_by_path(self, path):
+        """Return the first print job queued with path or None"""
+        print_jobs = self._by_path.get(path)
+        return print_jobs[0] if print_jobs else None
+
+    def get_ref(self, uuid):
+        """Return the JobRef of the print job with UUID or None"""
+        return self._by_uuid.get(uuid, (None, None))[1]
+
+    def update(self, queue, create, version=None):
+        """
+        Set the queue to queue, a list of (job ID, path) in queue order.
+        Print jobs are matched by their job ID, for job IDs without a
+        print job create(path) is called to create one.  version is the
+        queue version the queue was taken from, it is put in the JobRefs.
+        Return the list of print jobs that are no longer queued.
+        """
+        available = {job_id: print_job for job_id, _, print_job in self._jobs}
+        jobs = []
+        for job_id, path in queue:
+            print_job = available.pop(job_id, None)
+            if print_job is None:
+                print_job = create(path)
+            jobs.append((job_id, path, print_job))
+        by_uuid = {}
+        by_path = {}
+        for i, (job_id, path, print_job) in enumerate(jobs):
+            by_uuid[print_job.uuid] = (
+                    print_job, JobRef(path, job_id, i, version))
+            by_path.setdefault(path, []).append(print_job)
+        self._jobs = jobs
+        self._by_uuid = by_uuid
+        self._by_path = by_path
+        return list(available.values())
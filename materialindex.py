@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger("root.server")
+
+class MaterialIndex:
+    """
+    Metadata of the materials known to filament_manager by guid, so that
+    the XPath queries on the material XML files only run once per
+    material instead of on every update of the printer status.
+
+    The index is persisted in index_path (if given), together with the
+    modification time and size of every material file.  On load() only
+    the files that changed since are queried again.  Entries are checked
+    against their file again after invalidate().
+    """
+
+    INDEX_FILE = ".material_index.json"
+    XPATHS = {
+        "version": "./m:metadata/m:version",
+        "brand": "./m:metadata/m:name/m:brand",
+        "color": "./m:metadata/m:name/m:color",
+        "material": "./m:metadata/m:name/m:material",
+    }
+
+    def __init__(self, filament_manager, index_path=None):
+        self.filament_manager = filament_manager
+        self.index_path = index_path
+        self._entries = {} # guid: {field: value, "path", "mtime", "size"}
+        self._validated = set() # guids of entries known to be up to date
+        self._dirty = False # Entries changed since the last save()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Fill the index for all materials, reusing the persisted one"""
+        start = time.monotonic()
+        if self.index_path is not None:
+            try:
+                with open(self.index_path) as fp:
+                    stored = json.load(fp)
+                with self._lock:
+                    for guid, entry in stored.items():
+                        self._entries.setdefault(guid, entry)
+            except (OSError, ValueError) as e:
+                logger.info("No valid material index: %s", e)
+        guids = self.guids()
+        queried = 0
+        for guid in guids:
+            queried += not self._validate(guid)
+        with self._lock:
+            # Forget materials that no longer exist
+            for guid in set(self._entries).difference(guids):
+                del self._entries[guid]
+                self._dirty = True
+        self.save()
+        logger.info("Material index loaded: %d materials, %d read from XML"
+                    " in %.3fs", len(guids), queried, time.monotonic() - start)
+
+    def save(self):
+        """Write the index to index_path, if anything has changed"""
+        if self.index_path is None or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self._entries)
+            self._dirty = False
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(self.index_path))
+            with os.fdopen(fd, "w") as fp:
+                fp.write(data)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error("Failed to save material index: %s", e)
+
+    def get(self, guid):
+        """Return the metadata of a material as dict of XPATHS' keys"""
+        if guid not in self._validated:
+            self._validate(guid)
+        return self._entries[guid]
+
+    def guids(self):
+        """Return all guids known to filament_manager"""
+        return list(self.filament_manager.guid_to_path)
+
+    def invalidate(self, guids=None):
+        """
+        Check the entries for guids, or all entries if guids is None,
+        against their files again on next access.
+        """
+        with self._lock:
+            if guids is None:
+                self._validated.clear()
+            else:
+                self._validated.difference_update(guids)
+
+    def _validate(self, guid):
+        """
+        Make sure the entry for guid matches its file, querying the file
+        if it doesn't.  Return True if the entry was already up to date.
+        """
+        path = self.filament_manager.guid_to_path.get(guid)
+        try:
+            stat = os.stat(path)
+            mtime, size = stat.st_mtime, stat.st_size
+        except (OSError, TypeError):
+            mtime = size = None # Can't tell if it changed, always query
+        entry = self._entries.get(guid)
+        up_to_date = (entry is not None and mtime is not None
+                      and entry["path"] == path and entry["mtime"] == mtime
+                      and entry["size"] == size)
+        if not up_to_date:
+            entry = {key: self.filament_manager.get_info(guid, xpath)
+                     for key, xpath in self.XPATHS.items()}
+            try:
+                entry["version"] = int(entry["version"])
+            except (TypeError, ValueError):
+                # Unknown guid or a file without a valid version
+                logger.warning("Material %s has no valid version: %r",
+                               guid, entry["version"])
+                entry["version"] = None
+            entry.update(path=path, mtime=mtime, size=size)
+        with self._lock:
+            if not up_to_date:
+                self._entries[guid] = entry
+                self._dirty = True
+            self._validated.add(guid)
+        return up_to_date
@@ -0,0 +1,199 @@
+"""
+Counters and histograms of the server and the content manager, exposed
+in the Prometheus text exposition format on /metrics.
+"""
+
+from bisect import bisect_left
+import threading
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds in seconds of the buckets for the duration of uploads
+UPLOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def escape_label(value):
+    """Escape a label value for the Prometheus text format"""
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape_label(value))
+                          for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    """
+    Counter with one value per combination of label values.  The lock
+    is only held for the dict update, so updates stay cheap even with
+    many threads.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {} # {label values: value}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """Return a list of (name suffix, label string, value)"""
+        with self._lock:
+            values = sorted(self._values.items())
+        return [("", format_labels(self.labels, labels), value)
+                for labels, value in values]
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        lines.extend("{}{}{} {}".format(self.name, suffix, labels, value)
+                     for suffix, labels, value in self.samples())
+        return lines
+
+
+class Gauge(Counter):
+    """Value that can go up and down, or is set when exposed"""
+
+    TYPE = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    """Cumulative histogram with fixed bucket bounds"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Counts per bucket (+Inf last), sum of values
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1),
+                                                0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self._values.items())
+        samples = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append(("_bucket", format_labels(
+                        self.labels + ("le",), labels + (bound,)), cumulative))
+            label_str = format_labels(self.labels, labels)
+            samples.append(("_sum", label_str, total))
+            samples.append(("_count", label_str, cumulative))
+        return samples
+
+
+class Metrics:
+    """All metrics of the module, see expose() for the output"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.requests = Counter("cura_http_requests_total",
+                "HTTP requests by route, method and status code",
+                ("route", "method", "code"))
+        self.request_duration = Histogram(
+                "cura_http_request_duration_seconds",
+                "Time from reading the request line to the response",
+                ("route",))
+        self.bytes_in = Counter("cura_http_request_bytes_total",
+                "Bytes of request bodies", ("route",))
+        self.bytes_out = Counter("cura_http_response_bytes_total",
+                "Bytes of response bodies", ("route",))
+        self.upload_bytes = Counter("cura_upload_bytes_total",
+                "Bytes of uploaded multipart bodies", ("route",))
+        self.upload_duration = Histogram("cura_upload_duration_seconds",
+                "Time to receive and parse uploads", ("route",),
+                buckets=UPLOAD_BUCKETS)
+        self.refresh_duration = Histogram(
+                "cura_content_refresh_duration_seconds",
+                "Time to rebuild a response of the content manager",
+                ("endpoint",))
+        self.snapshot_duration = Histogram(
+                "cura_snapshot_duration_seconds",
+                "Time to take a snapshot of the klippy state in the reactor")
+        self.reactor_handoff = Histogram(
+                "cura_reactor_handoff_seconds",
+                "Time until a callback passed to the reactor runs",
+                ("callback",))
+        self.queue_edits = Counter("cura_queue_edits_total",
+                "Edits of queued print jobs by whether the queue was still"
+                " current, had to be rebased or the job was gone",
+                ("result",))
+        self._metrics = [self.requests, self.request_duration, self.bytes_in,
+                         self.bytes_out, self.upload_bytes,
+                         self.upload_duration, self.refresh_duration,
+                         self.snapshot_duration, self.reactor_handoff,
+                         self.queue_edits]
+
+    def observe_request(self, route, method, code, seconds,
+                        bytes_in, bytes_out):
+        """Record a request that has been answered"""
+        labels = (route,)
+        self.requests.inc((route, method, code))
+        self.request_duration.observe(seconds, labels)
+        if bytes_in:
+            self.bytes_in.inc(labels, bytes_in)
+        if bytes_out:
+            self.bytes_out.inc(labels, bytes_out)
+
+    def observe_upload(self, route, size, seconds):
+        self.upload_bytes.inc((route,), size)
+        self.upload_duration.observe(seconds, (route,))
+
+    def expose(self, server_stats=None):
+        """
+        Return all metrics in the text exposition format.  server_stats
+        as returned by Server.stats() are added as gauges.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        if server_stats is not None:
+            lines.extend(self._server_gauges(server_stats))
+        return ("\n".join(lines) + "\n").encode()
+
+    @staticmethod
+    def _server_gauges(stats):
+        gauges = []
+        for key in ("workers", "connections", "queued"):
+            gauge = Gauge("cura_server_" + key,
+                          "Server {} at the time of the scrape".format(key))
+            gauge.set(stats[key])
+            gauges.append(gauge)
+        active = Gauge("cura_server_active_requests",
+                       "Requests being handled by kind of traffic", ("kind",))
+        for kind, value in stats["active"].items():
+            active.set(value, (kind,))
+        rejected = Counter("cura_server_rejected_total",
+                           "Requests answered with 503 by kind of traffic",
+                           ("kind",))
+        for kind, value in stats["rejected"].items():
+            rejected.inc((kind,), value)
+        lines = []
+        for metric in gauges + [active, rejected]:
+            lines.extend(metric.expose())
+        return lines
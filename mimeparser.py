@@ -19,25 +19,47 @@ class MimeParser:
     Arguments:
     fp          The file pointer to parse from
     boundary    The MIME boundary, as specified in the main headers
-    length      Length of the body, as specified in the main headers
+    length      Length of the body, as specified in the main headers,
+                or None to read until the end of fp, e.g. of a
+                ChunkedReader
     out_dir     The directory where any files will be written into
     overwrite   In case a file with the same name exists overwrite it
                 if True, write to a unique, indexed name otherwise.
                 Defaults to True.
+    block_size  Size of the blocks read from fp in bytes.
+                Defaults to BLOCK_SIZE.
+    name_index  NameIndex of out_dir, used to find unique names instead
+                of _unique_path() and told about every file written.
+    stages      Callables taking the path of a file that is about to be
+                written and returning an object that processes the file
+                while it streams to disk:  Its feed() method is called
+                with every block of data written and finish() once the
+                file is complete.  The objects are stored in file_stages
+                under the path of the file.  Data passed to feed() has
+                already been flushed to the file.
     """
 
     HEADERS = 0
     BODY = 1
     FILE = 2
 
-    def __init__(self, fp, boundary, length, out_dir, overwrite=True):
+    BLOCK_SIZE = 256 * 1024
+    LINE_BREAKS = b"\r\n"
+
+    def __init__(self, fp, boundary, length, out_dir, overwrite=True,
+                 block_size=BLOCK_SIZE, stages=(), name_index=None):
         self.fp = fp
         self.boundary = boundary.encode()
+        self.delimiter = b"--" + self.boundary
         self.bytes_left = length
+        self.bytes_read = 0
         self.out_dir = out_dir
         self.overwrite = overwrite
         self.submessages = []
         self.written_files = [] # All files that were written
+        self.stages = stages
+        self.name_index = name_index
+        self.file_stages = {} # Path: [stage objects] for every file
 
         # What we are reading right now. One of:
         # self.HEADERS, self.BODY, self.FILE (0, 1, 2)
@@ -46,6 +68,9 @@ class MimeParser:
         self._current_body = b""
         self.fpath = "" # Path to the file to write to
 
+        self._block = memoryview(bytearray(block_size)) # Reused for reading
+        self._pending = bytearray() # Data that has been read but not parsed
+
     def parse(self):
         """
         Parse the entire file, returning a list of all submessages
@@ -53,12 +78,19 @@ class MimeParser:
         which are directly written to disk.
         """
         while True:
-            line = self.fp.readline()
-            self.bytes_left -= len(line)
+            if self._state == self.FILE:
+                self._write_file()
+                continue
+            line = self._readline()
+            if not line:
+                raise ValueError("MIME message ended before final boundary")
             try:
                 self._parse_line(line)
             except StopIteration:
                 break
+        # Discard the epilogue so that nothing of the body is left in fp
+        while self._fill():
+            self._pending.clear()
         return self.submessages, self.written_files
 
     def _parse_line(self, line):
@@ -82,11 +114,6 @@ class MimeParser:
         elif self._state == self.BODY:
             self._parse_body(line)
 
-        # FILE state is set after parsing headers and should be
-        # handled before reading the next line.
-        if self._state == self.FILE:
-            self._write_file()
-
     def _parse_headers(self, line):
         """Add the new line to the headers or parse the full header"""
         if line == b"\r\n": # End of headers
@@ -103,53 +130,111 @@ class MimeParser:
     def _write_file(self):
         """
         Write the file following in fp directly to the disk.
-        This does not happen line by line because with a lot of very
-        short lines that is quite inefficient. Instead the file is copied
-        in blocks with a size of 1024 bytes.
-        Then parse the remaining lines that have been read into the
-        buffer but do not belong to the file (everything past the first
-        occurance of boundary).
+        The file ends at the next line starting with the delimiter
+        (--boundary), without the line break in front of it.
+        Data is read in blocks of block_size and only the new block,
+        together with the end of the previous one in case the delimiter
+        was cut in half, is searched.  Everything before that is written
+        out right away, except for a trailing line break which might
+        still turn out to be the end of the file.
         """
         logger.debug("Writing file: %s", self.fpath)
         self.written_files.append(self.fpath)
+        stages = [stage(self.fpath) for stage in self.stages]
+        self.file_stages[self.fpath] = stages
 
-        # Use two buffers in case the boundary gets cut in half
-        buf1 = self._safe_read()
-        buf2 = self._safe_read()
+        pending = self._pending
+        search_from = 0
         with open(self.fpath, "wb") as write_fp:
-            while self.boundary not in buf1 + buf2:
-                write_fp.write(buf1)
-                buf1 = buf2
-                buf2 = self._safe_read()
-            if self.bytes_left != 0:
-                # Catch the rest of the last line
-                remaining_lines = (
-                        buf1 + buf2 + self.fp.readline()).splitlines(True)
-            else:
-                remaining_lines = (buf1 + buf2).splitlines(True)
-
-            # We need an exception for the last line of the file to strip
-            # the trailing "\r\n" (<CR><LF>)
-            prev_line = b""
-            # We take the index with us so we know where to pick up below
-            for i, line in enumerate(remaining_lines):
-                if self.boundary not in line:
-                    write_fp.write(prev_line)
-                    prev_line = line
-                else:
-                    # Now write the last line, but stripped
-                    write_fp.write(prev_line.rstrip(b"\r\n"))
+            if self.name_index is not None:
+                self.name_index.add(self.fpath)
+            while True:
+                end = self._find_delimiter(search_from)
+                if end != -1:
                     break
-        # Parse all other lines left in the buffer normally
-        # When reaching the end, StopIteration will be propagated up to parse()
-        for line in remaining_lines[i:]:
-            self._parse_line(line)
+                # Keep enough to detect a delimiter at the start of a line
+                # and the up to two bytes of the line break before it
+                keep_from = len(pending) - len(self.delimiter)
+                for _ in range(2):
+                    if keep_from > 0 and pending[keep_from - 1] in self.LINE_BREAKS:
+                        keep_from -= 1
+                if keep_from > 0:
+                    self._write(write_fp, stages, keep_from)
+                    del pending[:keep_from]
+                search_from = max(0, len(pending) - len(self.delimiter) + 1)
+                if not self._fill():
+                    raise ValueError("MIME message ended inside of a file")
+            # Strip the line break belonging to the delimiter
+            if end >= 2 and pending.startswith(b"\r\n", end - 2):
+                end_of_file = end - 2
+            elif end > 0 and pending[end - 1] in self.LINE_BREAKS:
+                end_of_file = end - 1
+            else:
+                end_of_file = end
+            self._write(write_fp, stages, end_of_file)
+        for stage in stages:
+            stage.finish()
+        # Continue parsing at the delimiter
+        del pending[:end]
+        self._state = None
+
+    def _write(self, write_fp, stages, size):
+        """Write size bytes of the pending data and pass them to stages"""
+        with memoryview(self._pending) as view, view[:size] as data:
+            write_fp.write(data)
+            write_fp.flush()
+            for stage in stages:
+                stage.feed(data)
 
-    def _safe_read(self):
-        """Read a chunk that will not go past EOF"""
-        buflen = min(self.bytes_left, 1024)
-        self.bytes_left -= buflen
-        return self.fp.read(buflen)
+    def _find_delimiter(self, start):
+        """
+        Return the position of the first delimiter in the pending data
+        at or after start that begins a line, or -1 if there is none.
+        """
+        pending = self._pending
+        while True:
+            pos = pending.find(self.delimiter, start)
+            if pos <= 0 or pending[pos - 1] in self.LINE_BREAKS:
+                return pos
+            start = pos + 1
+
+    def _readline(self):
+        """
+        Return the next line of the body, including the line break.
+        At the end of the body, return what is left, possibly b"".
+        """
+        pending = self._pending
+        start = 0
+        while True:
+            pos = pending.find(b"\n", start)
+            if pos != -1:
+                line = bytes(pending[:pos + 1])
+                del pending[:pos + 1]
+                return line
+            start = len(pending)
+            if not self._fill():
+                line = bytes(pending)
+                pending.clear()
+                return line
+
+    def _fill(self):
+        """
+        Append the next block to the pending data, never reading past the
+        end of the body.  Return False if there was nothing left to read.
+        """
+        size = len(self._block)
+        if self.bytes_left is not None:
+            size = min(self.bytes_left, size)
+        if size <= 0:
+            return False
+        n = self.fp.readinto(self._block[:size])
+        if not n:
+            return False
+        self.bytes_read += n
+        if self.bytes_left is not None:
+            self.bytes_left -= n
+        self._pending += self._block[:n]
+        return True
 
     def _start_body(self, headers):
         """Initiate reading of the body depending on whether it is a file"""
@@ -157,7 +242,10 @@ class MimeParser:
         if name == "file":
             self.fpath = os.path.join(self.out_dir, headers.get_filename())
             if not self.overwrite:
-                self.fpath = self._unique_path(self.fpath)
+                if self.name_index is not None:
+                    self.fpath = self.name_index.unique_path(self.fpath)
+                else:
+                    self.fpath = self._unique_path(self.fpath)
             self._state = self.FILE
         else:
             self._state = self.BODY
@@ -176,6 +264,6 @@ class MimeParser:
         index = 1
         path = "{}-{}{}".format(root, index, ext)
         while os.path.exists(path):
-            path = "{}-{}{}".format(root, index, ext)
             index += 1
+            path = "{}-{}{}".format(root, index, ext)
         return path
@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger("root.server")
+
+class NameIndex:
+    """
+    The file names in directory by stem and suffix, so that a unique
+    name for an upload is found without probing the file system for
+    file-1.gcode, file-2.gcode and so on.
+
+    Every file file-N.ext is recorded under the stem ("file", ".ext")
+    with suffix N, and under ("file-N", ".ext") with suffix 0.  The
+    index is built on first use and rebuilt whenever the modification
+    time of directory shows that files were added or removed by someone
+    else.  Files written and deleted through add() and discard() update
+    it directly.  Names returned by unique_path() are reserved until the
+    file is added.
+    """
+
+    SUFFIX_REGEX = re.compile(r"^(.*)-(\d+)$")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._suffixes = {} # type: {(str, str): set} by (stem, extension)
+        self._highest = {} # type: {(str, str): int} max() of _suffixes
+        self._reserved = set() # Names returned but not yet added
+        self._mtime = None # Of directory when the index was last synced
+        self._lock = threading.Lock()
+
+    def unique_path(self, path):
+        """
+        Return a path in directory like path that doesn't exist yet and
+        reserve it.  If path exists, the new name has a suffix one higher
+        than the highest one of its stem, e.g. file-3.gcode if there are
+        file.gcode and file-2.gcode.  Unlike probing, gaps in the suffixes
+        are not filled.  Should the index keep missing files, the name is
+        found by probing the file system instead.
+        """
+        directory, name = os.path.split(path)
+        if os.path.abspath(directory) != os.path.abspath(self.directory):
+            raise ValueError("{} is not in {}".format(path, self.directory))
+        root, ext = os.path.splitext(name)
+        for _ in range(2):
+            with self._lock:
+                self._sync()
+                if 0 not in self._suffixes.get((root, ext), ()):
+                    candidate = path
+                else:
+                    candidate = os.path.join(directory, "{}-{}{}".format(
+                            root, self._highest[(root, ext)] + 1, ext))
+                self._add(os.path.basename(candidate))
+                self._reserved.add(os.path.basename(candidate))
+            # One check to be safe against changes the index missed
+            if not os.path.exists(candidate):
+                return candidate
+            with self._lock:
+                self._reserved.discard(os.path.basename(candidate))
+                self._mtime = None # Rebuild
+        logger.error("Name index out of sync for %s, probing", path)
+        with self._lock:
+            # Like MimeParser._unique_path(), but not taking reserved names
+            candidate = path
+            index = 0
+            while (os.path.exists(candidate)
+                    or os.path.basename(candidate) in self._reserved):
+                index += 1
+                candidate = os.path.join(directory, "{}-{}{}".format(
+                        root, index, ext))
+            self._add(os.path.basename(candidate))
+            self._reserved.add(os.path.basename(candidate))
+        return candidate
+
+    def add(self, path):
+        """Record a file that was written to directory"""
+        with self._lock:
+            self._add(os.path.basename(path))
+            self._reserved.discard(os.path.basename(path))
+            self._mtime = self._get_mtime()
+
+    def discard(self, path):
+        """Record that a file in directory was deleted"""
+        with self._lock:
+            self._reserved.discard(os.path.basename(path))
+            for key, suffix in self._keys(os.path.basename(path)):
+                suffixes = self._suffixes.get(key)
+                if suffixes is None:
+                    continue
+                suffixes.discard(suffix)
+                if not suffixes:
+                    del self._suffixes[key]
+                    del self._highest[key]
+                elif suffix == self._highest[key]:
+                    self._highest[key] = max(suffixes)
+            self._mtime = self._get_mtime()
+
+    def _sync(self):
+        """Rebuild the index if directory changed, call with _lock held"""
+        mtime = self._get_mtime()
+        if mtime is not None and mtime == self._mtime:
+            return
+        self._suffixes = {}
+        self._highest = {}
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    self._add(entry.name)
+        except OSError as e:
+            logger.error("Failed to index %s: %s", self.directory, e)
+        for name in self._reserved:
+            self._add(name)
+        self._mtime = mtime
+
+    def _add(self, name):
+        for key, suffix in self._keys(name):
+            self._suffixes.setdefault(key, set()).add(suffix)
+            if suffix >= self._highest.get(key, -1):
+                self._highest[key] = suffix
+
+    def _keys(self, name):
+        """Yield the ((stem, extension), suffix) a file name is known by"""
+        root, ext = os.path.splitext(name)
+        yield (root, ext), 0
+        m = self.SUFFIX_REGEX.match(root)
+        if m:
+            yield (m.group(1), ext), int(m.group(2))
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
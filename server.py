@@ -1,20 +1,52 @@
+from email.utils import parsedate_to_datetime
+import errno
+import functools
 from http import HTTPStatus
 import http.server as srv
 import json
 import logging
+import os
+import queue
 import re
 import threading
 import time
+from urllib.parse import parse_qs, urlsplit
 
-from .custom_exceptions import QueuesDesynchronizedError
+from .custom_exceptions import (NotReadyError, QueuesDesynchronizedError,
+        ReactorTimeoutError)
+from .fileindex import ContentHash
+from .gcodemetadata import GcodeMetadata
 from .mimeparser import MimeParser
+from .thumbnails import ThumbnailExtractor
+from .uploads import ChunkedReader
 
 PRINTER_API = "/api/v1/"
 CLUSTER_API = "/cluster-api/v1/"
 MJPG_STREAMER_PORT = 8080
+# Seconds a client is asked to wait when the server is busy
+RETRY_AFTER = 2
+# Response sent without a handler when there is no room in the queue
+BUSY_RESPONSE = ("HTTP/1.1 503 Service Unavailable\r\n"
+                 "Retry-After: {}\r\n"
+                 "Content-Length: 0\r\n"
+                 "Connection: close\r\n\r\n".format(RETRY_AFTER)).encode()
+# Maximum concurrent requests per kind of traffic
+DEFAULT_LIMITS = {"poll": 4, "upload": 2, "watch": 2}
+# Seconds a request waits for one of the concurrent ones of its kind to
+# finish before it is rejected, longer than a poll takes under load
+ADMISSION_TIMEOUT = 0.5
+# Maximum seconds a request for print job changes is held open
+MAX_WATCH_TIMEOUT = 60
 
 logger = logging.getLogger("root.server")
 
+
+def disk_full(error):
+    """Return True if error was raised because the disk is full"""
+    return isinstance(error, OSError) and error.errno in (
+            errno.ENOSPC, errno.EDQUOT)
+
+
 class Handler(srv.BaseHTTPRequestHandler):
 
     """
@@ -26,35 +58,110 @@ class Handler(srv.BaseHTTPRequestHandler):
     uuid_regex = re.compile(r"^" + CLUSTER_API + r"print_jobs/"
             + r"(?P<uuid>[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})"
             + r"(?P<suffix>.*)$")
+    # /cluster-api/v1/print_jobs/uploads/<ID> of a resumable upload
+    upload_regex = re.compile(r"^" + CLUSTER_API + r"print_jobs/uploads/"
+            + r"(?P<id>[0-9a-f]{32})$")
+
+    # Keep connections open between requests (Cura polls every 2 seconds)
+    protocol_version = "HTTP/1.1"
+    # Seconds after which an idle (or stalled) connection is closed
+    timeout = 10
+    # Send small responses right away instead of waiting for an ACK
+    disable_nagle_algorithm = True
+
+    # Paths that are recorded under their own route in the metrics
+    routes = {CLUSTER_API + "printers", CLUSTER_API + "print_jobs",
+              CLUSTER_API + "materials", CLUSTER_API + "print_jobs/",
+              CLUSTER_API + "materials/", "/?action=stream",
+              "/?action=snapshot", PRINTER_API + "system", "/metrics",
+              CLUSTER_API + "print_jobs/changes",
+              CLUSTER_API + "print_jobs/uploads"}
+    # Suffixes after a print job UUID that are recorded under their own route
+    uuid_suffixes = {"", "/action", "/action/move", "/preview_image"}
 
     def __init__(self, request, client_address, server):
         self.module = server.module
         self.content_manager = self.module.content_manager
         self._size = None # For logging GET requests
+        self._retry_after = False # Send Retry-After with the response
+        self._start = None # When the request line was read
+        self._code = None # Status code of the response
+        self._bytes_out = 0 # Content-Length of the response
         super().__init__(request, client_address, server)
 
+    def handle_one_request(self):
+        # The handler is reused for the whole connection
+        self._size = None
+        self._retry_after = False
+        self._start = self._code = None
+        self._bytes_out = 0
+        super().handle_one_request()
+        if self._code is not None:
+            self.record_request()
+
+    def parse_request(self):
+        self._start = time.perf_counter()
+        return super().parse_request()
+
+    def record_request(self):
+        """Add the request that was just answered to the metrics"""
+        # Missing if the request was invalid
+        path = urlsplit(getattr(self, "path", "")).path
+        m = self.uuid_regex.match(path)
+        if m and m.group("suffix") in self.uuid_suffixes:
+            route = CLUSTER_API + "print_jobs/{uuid}" + m.group("suffix")
+        elif self.upload_regex.match(path):
+            route = CLUSTER_API + "print_jobs/uploads/{id}"
+        elif path in self.routes:
+            route = path
+        else:
+            route = "other"
+        try:
+            bytes_in = int(self.headers.get("Content-Length", 0))
+        except (AttributeError, ValueError): # No or invalid headers
+            bytes_in = 0
+        # No start if the request line was rejected before parse_request()
+        duration = (0 if self._start is None
+                    else time.perf_counter() - self._start)
+        self.module.metrics.observe_request(route, self.command, self._code,
+                duration, bytes_in, self._bytes_out)
+
     def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == CLUSTER_API + "print_jobs/changes":
+            # Long-polls are held open, keep them from blocking Cura's polls
+            self.limited("watch", lambda: self.get_print_job_changes(
+                    parse_qs(url.query)))
+        else:
+            self.limited("poll", self.handle_get)
+
+    def handle_get(self):
         """
         Implement a case-specific response, limited to the requests
         that we can expect from Cura.  For a summary of those see
         README.md
         """
         if self.path == CLUSTER_API + "printers":
-            self.get_json(self.content_manager.get_printer_status())
+            self.get_json(self.content_manager.get_printer_status)
         elif self.path == CLUSTER_API + "print_jobs":
-            self.get_json(self.content_manager.get_print_jobs())
+            self.get_json(self.content_manager.get_print_jobs)
         elif self.path == CLUSTER_API + "materials":
-            self.get_json(self.content_manager.get_materials())
+            self.get_json(self.content_manager.get_materials)
         elif self.path == "/?action=stream":
             self.get_stream()
         elif self.path == "/?action=snapshot":
             self.get_snapshot()
         elif self.path == PRINTER_API + "system":
             self.send_error(HTTPStatus.NOT_IMPLEMENTED)
+        elif self.path == "/metrics":
+            self.get_metrics()
         else:
             m = self.uuid_regex.match(self.path)
+            upload_match = self.upload_regex.match(self.path)
             if m and m.group("suffix") == "/preview_image":
                 self.get_preview_image(m.group("uuid"))
+            elif upload_match:
+                self.get_upload(upload_match.group("id"))
             else:
                 # NOTE: send_error() calls end_headers()
                 self.send_error(HTTPStatus.NOT_FOUND)
@@ -62,9 +169,13 @@ class Handler(srv.BaseHTTPRequestHandler):
     def do_POST(self):
         if self.headers.get_content_maintype() == "multipart":
             if self.path == CLUSTER_API + "print_jobs/":
-                self.post_print_job()
+                self.limited("upload", self.post_print_job)
             elif self.path == CLUSTER_API + "materials/":
-                self.post_material()
+                self.limited("upload", self.post_material)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        elif self.path == CLUSTER_API + "print_jobs/uploads":
+            self.post_upload()
         else:
             m = self.uuid_regex.match(self.path)
             if m and m.group("suffix") == "/action/move":
@@ -83,26 +194,179 @@ class Handler(srv.BaseHTTPRequestHandler):
         else:
             self.send_error(HTTPStatus.NOT_FOUND)
 
+    def do_PATCH(self):
+        m = self.upload_regex.match(self.path)
+        if m:
+            # Continue a resumable upload
+            self.limited("upload", lambda: self.patch_upload(m.group("id")))
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
     def do_DELETE(self):
         m = self.uuid_regex.match(self.path)
+        upload_match = self.upload_regex.match(self.path)
         if m and not m.group("suffix"):
             # Delete print job from queue
             self.delete_print_job(m.group("uuid"))
+        elif upload_match:
+            self.delete_upload(upload_match.group("id"))
         else:
             self.send_error(HTTPStatus.NOT_FOUND)
 
-    def get_json(self, content):
-        """Send an object JSON-formatted"""
+    def handle_expect_100(self):
+        """
+        Reject a print job upload that won't fit on the SD card before
+        the body is sent, if the client waits for 100 Continue.
+        """
+        if (self.command == "POST"
+                and self.path == CLUSTER_API + "print_jobs/"):
+            self.expire_uploads()
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                available = self.module.disk_space.available()
+            except (ValueError, OSError):
+                pass # Left to post_print_job()
+            else:
+                if length > available:
+                    self.close_connection = True
+                    self.send_error(HTTPStatus.INSUFFICIENT_STORAGE,
+                            "Not enough space on the SD card")
+                    return False
+        return super().handle_expect_100()
+
+    def limited(self, kind, handle):
+        """
+        Call handle() if the server admits another request of this kind
+        of traffic ("poll", "upload" or "watch"), otherwise reply with
+        503.
+        """
+        limits = self.server.limits
+        if not limits.acquire(kind):
+            self._retry_after = True
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE,
+                    "Too many concurrent {} requests".format(kind))
+            return
         try:
-            json_content = json.dumps(content)
+            handle()
+        finally:
+            limits.release(kind)
+
+    def get_json(self, get_response):
+        """
+        Send the cached JSON response returned by get_response, a getter
+        of the content manager.  If the client already has this version
+        (If-None-Match matches the ETag) only send 304 Not Modified.
+        """
+        try:
+            response = get_response()
         except TypeError:
             self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
                     "JSON serialization failed")
+            return
+        except NotReadyError as e:
+            self._retry_after = True
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+            return
+        encoding, body, etag = response.encode(
+                self._accepted_encoding(response.ENCODINGS))
+        if self._not_modified(etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
         else:
-            self.send_response(HTTPStatus.OK, size=len(json_content))
+            self.send_response(HTTPStatus.OK, size=len(body))
             self.send_header("Content-Type", "application/json")
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
             self.end_headers()
-            self.wfile.write(json_content.encode())
+            self.wfile.write(body)
+
+    def get_print_job_changes(self, query):
+        """
+        Send the changes of the print jobs since the version given in the
+        since parameter, waiting up to timeout seconds for any to happen.
+        Clients pass the version of the last response to the next request.
+        """
+        since = query.get("since", [""])[0]
+        try:
+            timeout = float(query.get("timeout", ["0"])[0])
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "timeout must be a number")
+            return
+        timeout = min(max(timeout, 0), MAX_WATCH_TIMEOUT)
+        changes = self.content_manager.get_print_job_changes(since, timeout)
+        self.send_json(HTTPStatus.OK, changes)
+
+    def send_json(self, code, data, headers=()):
+        """
+        Send data, which is not cached, as JSON response with the
+        additional headers given as (keyword, value) pairs.
+        """
+        try:
+            body = json.dumps(data).encode()
+        except TypeError:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                    "JSON serialization failed")
+            return
+        self.send_response(code, size=len(body))
+        self.send_header("Content-Type", "application/json")
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_metrics(self):
+        """Send the metrics in the Prometheus text exposition format"""
+        body = self.module.metrics.expose(self.server.stats())
+        self.send_response(HTTPStatus.OK, size=len(body))
+        self.send_header("Content-Type", self.module.metrics.CONTENT_TYPE)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _accepted_encoding(self, encodings):
+        """
+        Return the first of encodings with the highest q-value in the
+        Accept-Encoding header, or None if the client accepts none.
+        """
+        accepted = {}
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            q = 1.0
+            params = params.strip().replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0
+            accepted[name.strip().lower()] = q
+        default = accepted.get("*", 0)
+        q, encoding = max(((accepted.get(encoding, default), -i), encoding)
+                          for i, encoding in enumerate(encodings))
+        return encoding if q[0] > 0 else None
+
+    def _not_modified(self, etag, mtime=None):
+        """
+        Return True if the client's cached version is still valid, that
+        is if etag is listed in the If-None-Match header or, only if that
+        header is missing, mtime is not newer than If-Modified-Since.
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            # The header is a comma separated list, possibly of weak ETags
+            tags = {tag.strip().replace("W/", "", 1)
+                    for tag in if_none_match.split(",")}
+            return etag in tags or "*" in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and mtime is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
 
     def get_preview_image(self, uuid):
         """Send back the preview image for the print job with uuid"""
@@ -111,68 +375,408 @@ class Handler(srv.BaseHTTPRequestHandler):
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
         else:
             try:
-                thumbnail_path = self.module.get_thumbnail_path(
-                        index, print_job.name)
-                with open(thumbnail_path, "rb") as fp:
-                    image_data = fp.read()
-                self.send_response(HTTPStatus.OK, size=len(image_data))
+                default_path = os.path.join(self.module.PATH, "default.png")
+                thumbnail_path = (
+                    self.content_manager.get_thumbnail_path(print_job.uuid)
+                    or default_path)
+                try:
+                    image = self.module.thumbnail_cache.get(thumbnail_path)
+                except FileNotFoundError:
+                    # Deleted from the thumbnail cache in the meantime
+                    thumbnail_path = default_path
+                    image = self.module.thumbnail_cache.get(thumbnail_path)
+                if self._not_modified(image.etag, image.mtime):
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    self.send_image_headers(image)
+                    self.end_headers()
+                    return
+                self.send_response(HTTPStatus.OK, size=image.size)
                 self.send_header("Content-Type", "image/png")
+                self.send_image_headers(image)
                 self.end_headers()
-                self.wfile.write(image_data)
-            except QueuesDesynchronizedError:
-                self.send_error(HTTPStatus.CONFLICT,
-                        "Queue order has changed")
+                if image.data is not None:
+                    self.wfile.write(image.data)
+                else:
+                    self.send_file(thumbnail_path)
             except IOError:
                 self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
                         "Failed to open preview image at " + thumbnail_path)
 
+    def send_file(self, path):
+        """Send the content of the file at path as (rest of the) body"""
+        with open(path, "rb") as fp:
+            self.connection.sendfile(fp)
+
+    def send_image_headers(self, image):
+        """Send the validators of a CachedImage"""
+        self.send_header("ETag", image.etag)
+        self.send_header("Last-Modified", image.last_modified)
+
     def get_stream(self):
         """Redirect to the port on which mjpg-streamer is running"""
-        self.send_response(HTTPStatus.FOUND)
+        self.send_response(HTTPStatus.FOUND, size=0)
         self.send_header("Location", "http://{}:{}/?action=stream".format(
             self.module.ADDRESS, MJPG_STREAMER_PORT))
         self.end_headers()
 
     def get_snapshot(self):
         """Snapshot only sends a single image"""
-        self.send_response(HTTPStatus.FOUND)
+        self.send_response(HTTPStatus.FOUND, size=0)
         self.send_header("Location", "http://{}:{}/?action=snapshot".format(
             self.module.ADDRESS, MJPG_STREAMER_PORT))
         self.end_headers()
 
+    def read_body(self):
+        """
+        Return a file object to read the request body from and its length,
+        which is None if the body is sent with Transfer-Encoding: chunked.
+        If the body can't be read, send an error and return (None, None).
+        """
+        encoding = self.headers.get("Transfer-Encoding", "").strip().lower()
+        if encoding:
+            if encoding == "chunked":
+                return ChunkedReader(self.rfile), None
+            self.close_connection = True
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED,
+                    "Unsupported Transfer-Encoding: " + encoding)
+        else:
+            try:
+                return self.rfile, int(self.headers["Content-Length"])
+            except (TypeError, ValueError):
+                self.close_connection = True
+                self.send_error(HTTPStatus.LENGTH_REQUIRED)
+        return None, None
+
+    def print_job_stages(self, stream=True):
+        """
+        Return the MimeParser stages for an uploaded G-code file, see
+        queue_upload().  Without stream the print can't start before the
+        upload is complete.
+        """
+        stages = [GcodeMetadata, functools.partial(ThumbnailExtractor,
+                  cache=self.module.thumbnail_cache)]
+        if self.module.file_index is not None:
+            stages.append(ContentHash)
+        if stream and self.module.stream_gate is not None:
+            stages.append(self.module.stream_gate.stage)
+        return stages
+
+    def reserve_space(self, size):
+        """
+        Return a Reservation of size bytes on the SD card for an upload.
+        If there isn't enough space, send 507 and return None.
+        """
+        self.expire_uploads()
+        try:
+            reservation = self.module.disk_space.reserve_space(size)
+        except OSError as e:
+            self.close_connection = True
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                    "Failed to check the free space: " + str(e))
+            return None
+        if reservation is None:
+            self.close_connection = True
+            self.send_error(HTTPStatus.INSUFFICIENT_STORAGE,
+                    "Not enough space on the SD card")
+        return reservation
+
+    def expire_uploads(self):
+        """
+        Release the space reserved by abandoned resumable uploads, which
+        would otherwise hold it until the next one is started
+        """
+        if self.module.uploads is not None:
+            self.module.uploads.expire()
+
+    def remove_partial_files(self, paths):
+        """Delete the files of a failed upload, stopping their prints"""
+        gate = self.module.stream_gate
+        name_index = self.module.name_index
+        for path in paths:
+            if gate is not None:
+                gate.abort(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Failed to remove %s: %s", path, e)
+            if name_index is not None:
+                name_index.discard(path)
+
     def post_print_job(self):
         boundary = self.headers.get_boundary()
-        length = int(self.headers.get("Content-Length", 0))
+        fp, length = self.read_body()
+        if fp is None:
+            return
+        # The size of chunked bodies is unknown, they are only admitted
+        # if there is any space left
+        reservation = self.reserve_space(length or 0)
+        if reservation is None:
+            return
+        start = time.perf_counter()
+        parser = None
         try:
-            parser = MimeParser(self.rfile, boundary, length,
-                self.module.SDCARD_PATH, overwrite=False)
+            parser = MimeParser(fp, boundary, length,
+                self.module.SDCARD_PATH, overwrite=False,
+                block_size=self.module.UPLOAD_BLOCK_SIZE,
+                stages=self.print_job_stages() + [lambda path: reservation],
+                name_index=self.module.name_index)
             submessages, paths = parser.parse()
         except Exception as e:
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
-                    "Parser failed: " + str(e))
+            if parser is not None:
+                self.remove_partial_files(parser.written_files)
+            # The rest of the body might still be unread
+            self.close_connection = True
+            try:
+                if disk_full(e):
+                    self.send_error(HTTPStatus.INSUFFICIENT_STORAGE,
+                            "SD card full: " + str(e))
+                else:
+                    self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                            "Parser failed: " + str(e))
+            except OSError: # Usually the connection is gone
+                pass
         else:
+            self.module.metrics.observe_upload(self.path, parser.bytes_read,
+                                               time.perf_counter() - start)
+            path = paths[0]
             #for msg in submessages:
             #    name = msg.get_param("name", header="Content-Disposition")
             #    if name == "owner":
             #        owner = msg.get_payload().strip()
-            self.module.send_print(paths[0])
-            self.send_response(HTTPStatus.OK)
+            filename = next((msg.get_filename() for msg in submessages
+                             if msg.get_filename() is not None), None)
+            self.queue_upload(path, parser.file_stages[path], filename)
+            self.send_response(HTTPStatus.OK, size=0)
             self.end_headers()
+        finally:
+            reservation.release()
+
+    def queue_upload(self, path, file_stages, filename):
+        """
+        Queue the print job of the G-code file uploaded to path, unless
+        it is already streaming to print, and add the metadata found by
+        file_stages, created from print_job_stages().  filename is the
+        name the client sent.
+        """
+        gate = self.module.stream_gate
+        file_index = self.module.file_index
+        name_index = self.module.name_index
+        gcode_metadata, thumbnail = file_stages[:2]
+        metadata = dict(gcode_metadata.metadata,
+                        thumbnail=thumbnail.thumbnail_path)
+        if gate is not None and gate.complete(path):
+            # Already queued, the file must stay where it is
+            self.content_manager.add_file_metadata(path, metadata)
+            return
+        if file_index is not None:
+            uploaded = path
+            path = self.deduplicate(path, file_stages[2], filename)
+            if name_index is not None:
+                # Also takes in the other changes deduplicate() made
+                # to the directory, like saving the file index
+                if path == uploaded:
+                    name_index.add(path)
+                else:
+                    name_index.discard(uploaded)
+        self.content_manager.add_file_metadata(path, metadata)
+        self.module.send_print(path)
+
+    def deduplicate(self, path, content_hash, filename):
+        """
+        Return the path to print the file just uploaded to path from.  If
+        a file with the same content already exists, the upload is
+        dropped:  The existing file is used if it has the name the client
+        sent, otherwise the upload is replaced with a hardlink to it.
+        """
+        file_index = self.module.file_index
+        existing = file_index.find(content_hash.hexdigest, content_hash.size)
+        if existing is None or existing == path:
+            file_index.add(path, content_hash.hexdigest)
+            file_index.save()
+            return path
+        try:
+            if filename is not None and existing == os.path.join(
+                    self.module.SDCARD_PATH, filename):
+                os.remove(path)
+                logger.info("Upload of %s is identical, using it", existing)
+                return existing
+            link_path = path + ".link"
+            os.link(existing, link_path)
+            os.replace(link_path, path)
+        except OSError as e:
+            logger.info("Keeping upload %s as is: %s", path, e)
+        else:
+            logger.info("Upload %s is identical to %s, linked to it",
+                        path, existing)
+        file_index.add(path, content_hash.hexdigest)
+        file_index.save()
+        return path
 
     def post_material(self):
         boundary = self.headers.get_boundary()
-        length = int(self.headers.get("Content-Length", 0))
+        fp, length = self.read_body()
+        if fp is None:
+            return
+        start = time.perf_counter()
         try:
-            parser = MimeParser(self.rfile, boundary, length,
-                    self.module.MATERIAL_PATH)
+            parser = MimeParser(fp, boundary, length,
+                    self.module.MATERIAL_PATH,
+                    block_size=self.module.UPLOAD_BLOCK_SIZE)
             submessages, paths = parser.parse()
         except Exception as e:
+            self.close_connection = True
             self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
                     "Parser failed: " + str(e))
         else:
+            self.module.metrics.observe_upload(self.path, parser.bytes_read,
+                                               time.perf_counter() - start)
             self.module.filament_manager.read_single_file(paths[0])
+            self.content_manager.materials_changed()
             # Reply is checked specifically for 200
-            self.send_response(HTTPStatus.OK)
+            self.send_response(HTTPStatus.OK, size=0)
+            self.end_headers()
+
+    def post_upload(self):
+        """
+        Start a resumable upload of a G-code file, for clients that can't
+        rely on sending it in one request.  The JSON body gives the
+        filename and the size in bytes.  The file is then sent in any
+        number of PATCH requests to the upload, see patch_upload().
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        rdata = self.rfile.read(length)
+        try:
+            data = json.loads(rdata)
+            filename = data["filename"]
+            size = data["size"]
+        except (ValueError, TypeError, KeyError):
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Expected JSON with filename and size")
+            return
+        if (not isinstance(filename, str) or not filename
+                or filename != os.path.basename(filename)
+                or filename.startswith(".")):
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Invalid filename: " + repr(filename))
+        elif not isinstance(size, int) or size <= 0:
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Invalid size: " + repr(size))
+        else:
+            reservation = self.reserve_space(size)
+            if reservation is None:
+                return
+            try:
+                upload = self.module.uploads.create(filename, size,
+                        self.print_job_stages(stream=False), reservation)
+            except OSError as e:
+                reservation.release()
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                        "Failed to create upload: " + str(e))
+                return
+            self.send_json(HTTPStatus.CREATED, upload.status(), [("Location",
+                    CLUSTER_API + "print_jobs/uploads/" + upload.id)])
+
+    def get_upload(self, upload_id):
+        """
+        Send the status of a resumable upload, most importantly its
+        offset, the number of bytes received.  The upload continues from
+        there.
+        """
+        upload = self.module.uploads.get(upload_id)
+        if upload is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "Upload not found")
+        else:
+            self.send_json(HTTPStatus.OK, upload.status())
+
+    def patch_upload(self, upload_id):
+        """
+        Append the body to a resumable upload.  The Upload-Offset header
+        must match the offset of the upload, otherwise 409 is sent with
+        its status.  If the request breaks off, whatever was received is
+        kept.  Once the whole file is there it is queued for printing.
+        """
+        upload = self.module.uploads.get(upload_id)
+        if upload is None:
+            self.close_connection = True
+            self.send_error(HTTPStatus.NOT_FOUND, "Upload not found")
+            return
+        try:
+            offset = int(self.headers["Upload-Offset"])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self.send_error(HTTPStatus.BAD_REQUEST,
+                    "Upload-Offset header required")
+            return
+        fp, length = self.read_body()
+        if fp is None:
+            return
+        if not upload.lock.acquire(blocking=False):
+            self.close_connection = True
+            self.send_error(HTTPStatus.CONFLICT,
+                    "Upload is in progress in another request")
+            return
+        try:
+            if upload.complete or offset != upload.offset:
+                self.close_connection = True
+                self.send_json(HTTPStatus.CONFLICT, upload.status())
+                return
+            try:
+                upload.append(fp, length, self.module.UPLOAD_BLOCK_SIZE)
+            except Exception as e:
+                self.close_connection = True
+                try:
+                    self.send_error(HTTPStatus.INSUFFICIENT_STORAGE
+                            if disk_full(e) else HTTPStatus.BAD_REQUEST,
+                            "Upload interrupted at {} bytes: {}".format(
+                                upload.offset, e))
+                except OSError: # Usually the connection is gone
+                    pass
+                return
+            if upload.offset == upload.size:
+                try:
+                    self.finish_upload(upload)
+                except OSError as e:
+                    self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                            "Failed to finish upload: " + str(e))
+                    return
+        finally:
+            upload.lock.release()
+        self.send_json(HTTPStatus.OK, upload.status())
+
+    def finish_upload(self, upload):
+        """Move a complete resumable upload to the SD card and queue it"""
+        name_index = self.module.name_index
+        path = os.path.join(self.module.SDCARD_PATH, upload.filename)
+        if name_index is not None:
+            path = name_index.unique_path(path)
+        else:
+            path = MimeParser._unique_path(path)
+        try:
+            self.module.uploads.finish(upload, path)
+        except OSError:
+            if name_index is not None:
+                name_index.discard(path)
+            raise
+        if name_index is not None:
+            name_index.add(path)
+        self.queue_upload(path, upload.stages, upload.filename)
+
+    def delete_upload(self, upload_id):
+        """Cancel a resumable upload"""
+        upload = self.module.uploads.get(upload_id)
+        if upload is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "Upload not found")
+        elif not upload.lock.acquire(blocking=False):
+            self.send_error(HTTPStatus.CONFLICT,
+                    "Upload is in progress in another request")
+        else:
+            try:
+                self.module.uploads.remove(upload)
+            finally:
+                upload.lock.release()
+            self.send_response(HTTPStatus.OK, size=0)
             self.end_headers()
 
     def post_move_to_top(self, uuid):
@@ -184,36 +788,44 @@ class Handler(srv.BaseHTTPRequestHandler):
         except ValueError:
             self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
             return
-        old_index, print_job = self.content_manager.uuid_to_print_job(uuid)
+        ref = self.content_manager.uuid_to_job_ref(uuid)
         new_index = data.get("to_position")
-        if not print_job:
+        if not ref:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
         elif data.get("list") != "queued" or not isinstance(new_index, int):
             self.send_error(HTTPStatus.BAD_REQUEST,
                     "Unexpected JSON content: " + rdata)
         else:
             try:
-                self.module.queue_move(old_index, new_index, print_job.name)
+                self.module.queue_move(ref, new_index)
             except IndexError as e:
                 self.send_error(HTTPStatus.BAD_REQUEST, str(e))
             except QueuesDesynchronizedError:
                 self.send_error(HTTPStatus.CONFLICT, "Queue order has changed")
+            except ReactorTimeoutError:
+                self.send_error(HTTPStatus.GATEWAY_TIMEOUT,
+                        "Klipper did not respond")
             else:
-                self.send_response(HTTPStatus.OK)
+                self.send_response(HTTPStatus.OK, size=0)
                 self.end_headers()
 
     def delete_print_job(self, uuid):
         """Delete print job with uuid from the queue"""
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
-        if not print_job:
+        ref = self.content_manager.uuid_to_job_ref(uuid)
+        if not ref:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in queue")
         else:
             try:
-                self.module.queue_delete(index, print_job.name)
+                self.module.queue_delete(ref)
+            except IndexError as e:
+                self.send_error(HTTPStatus.BAD_REQUEST, str(e))
             except QueuesDesynchronizedError:
                 self.send_error(HTTPStatus.CONFLICT, "Queue order has changed")
+            except ReactorTimeoutError:
+                self.send_error(HTTPStatus.GATEWAY_TIMEOUT,
+                        "Klipper did not respond")
             else:
-                self.send_response(HTTPStatus.OK)
+                self.send_response(HTTPStatus.OK, size=0)
                 self.end_headers()
 
     def put_action(self, uuid):
@@ -228,27 +840,35 @@ class Handler(srv.BaseHTTPRequestHandler):
         except ValueError:
             self.send_error(HTTPStatus.BAD_REQUEST, "Failed to read JSON")
             return
-        index, print_job = self.content_manager.uuid_to_print_job(uuid)
+        ref = self.content_manager.uuid_to_job_ref(uuid)
         action = data.get("action")
-        if not print_job:
+        if not ref:
             self.send_error(HTTPStatus.NOT_FOUND, "Print job not in Queue")
-        elif index != 0: # This request is only handled for the current print
+        elif ref.index != 0: # Only handled for the current print
             self.send_error(HTTPStatus.BAD_REQUEST,
-                    "Can only operate on current print job. Got " + str(index))
+                    "Can only operate on current print job. Got "
+                    + str(ref.index))
         else:
             try:
                 if action == "print":
-                    self.module.resume_print(print_job.name)
+                    self.module.resume_print(ref)
                 elif action == "pause":
-                    self.module.pause_print(print_job.name)
+                    self.module.pause_print(ref)
                 elif action == "abort":
-                    self.module.stop_print(print_job.name)
+                    self.module.stop_print(ref)
                 else:
                     self.send_error(HTTPStatus.BAD_REQUEST,
                             "Unknown action: " + str(action))
+                    return
             except QueuesDesynchronizedError:
                 self.send_error(HTTPStatus.CONFLICT,
                         "Queue order has changed")
+            except ReactorTimeoutError:
+                self.send_error(HTTPStatus.GATEWAY_TIMEOUT,
+                        "Klipper did not respond")
+            else:
+                self.send_response(HTTPStatus.OK, size=0)
+                self.end_headers()
 
     def put_force(self, uuid):
         """
@@ -280,6 +900,7 @@ class Handler(srv.BaseHTTPRequestHandler):
         """
         if size is not None:
             self._size = str(size)
+        self._code = int(code)
         srv.BaseHTTPRequestHandler.send_response(self, code, message)
         # Keep track of when the last request was handled
         # send_error() also calls here
@@ -287,6 +908,22 @@ class Handler(srv.BaseHTTPRequestHandler):
         if self._size is not None:
             self.send_header("Content-Length", self._size)
 
+    def send_header(self, keyword, value):
+        if keyword == "Content-Length":
+            self._bytes_out = int(value)
+        srv.BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        """
+        Close the connection after this response if the server can't
+        afford to keep it open.
+        """
+        if self._retry_after:
+            self.send_header("Retry-After", str(RETRY_AFTER))
+        if not self.close_connection and not self.server.keep_alive():
+            self.send_header("Connection", "close")
+        srv.BaseHTTPRequestHandler.end_headers(self)
+
     def log_request(self, code="-", size="-"):
         """Add size to logging"""
         if self._size is not None:
@@ -298,11 +935,18 @@ class Handler(srv.BaseHTTPRequestHandler):
         # Overwrite format string. Default is "code %d, message %s"
         if format == "code %d, message %s":
             format = "Errorcode %d: %s"
+        elif format == "Request timed out: %r":
+            # Idle keep-alive connections end like this
+            logger.debug("<%s> " + format, self.address_string(), *args)
+            return
         logger.error("<%s> " + format, self.address_string(), *args)
 
     def log_message(self, format, *args):
-        if (self.path == CLUSTER_API + "printers" or
-            self.path == CLUSTER_API + "print_jobs"):
+        path = getattr(self, "path", "") # Missing if the request was invalid
+        if (path == CLUSTER_API + "printers" or
+            path == CLUSTER_API + "print_jobs" or
+            path == "/metrics" or
+            path.startswith(CLUSTER_API + "print_jobs/changes?")):
             # Put periodic requests to DEBUG
             level = logging.DEBUG
         else:
@@ -310,16 +954,138 @@ class Handler(srv.BaseHTTPRequestHandler):
         logger.log(level, "<%s> " + format, self.address_string(), *args)
 
 
-class Server(srv.ThreadingHTTPServer, threading.Thread):
-    """Wrapper class to store the module in the server and add threading"""
-    def __init__(self, server_address, RequestHandler, module):
+class RequestLimits:
+    """
+    Limit the number of concurrent requests per kind of traffic and
+    count the requests that were rejected because of that.  A request
+    over the limit waits up to timeout seconds for a slot, so that a
+    burst of requests, like Cura sends them, is queued instead of
+    rejected.
+    """
+
+    def __init__(self, limits, timeout=ADMISSION_TIMEOUT):
+        self.limits = limits # {kind: maximum concurrent requests}
+        self.timeout = timeout
+        self._semaphores = {kind: threading.BoundedSemaphore(limit)
+                            for kind, limit in limits.items()}
+        self.active = dict.fromkeys(limits, 0)
+        # The "queue" counts connections rejected before being read
+        self.rejected = dict.fromkeys(list(limits) + ["queue"], 0)
+        self._lock = threading.Lock()
+
+    def acquire(self, kind):
+        """Return True if the request is admitted, count it otherwise"""
+        admitted = self._semaphores[kind].acquire(timeout=self.timeout)
+        with self._lock:
+            if admitted:
+                self.active[kind] += 1
+            else:
+                self.rejected[kind] += 1
+        if not admitted:
+            logger.info("Server busy: Rejected %s request", kind)
+        return admitted
+
+    def release(self, kind):
+        with self._lock:
+            self.active[kind] -= 1
+        self._semaphores[kind].release()
+
+    def reject(self, kind):
+        """Count a request that was rejected elsewhere"""
+        with self._lock:
+            self.rejected[kind] += 1
+        logger.info("Server busy: Rejected %s request", kind)
+
+    def stats(self):
+        with self._lock:
+            return {"active": dict(self.active),
+                    "rejected": dict(self.rejected)}
+
+
+class Server(srv.HTTPServer, threading.Thread):
+    """
+    Wrapper class to store the module in the server and add threading.
+
+    Connections are handled by a fixed pool of worker threads.  Up to
+    queue_size accepted connections wait for a free worker, beyond that
+    they are answered with 503 right away.  A connection is kept alive
+    only as long as that leaves a worker free for new ones.
+    """
+
+    # Pending connections before new ones are refused (default 5)
+    request_queue_size = 32
+
+    def __init__(self, server_address, RequestHandler, module, workers=8,
+                 queue_size=16, limits=DEFAULT_LIMITS):
         super().__init__(server_address, RequestHandler)
         threading.Thread.__init__(self)
         self.module = module
         self.last_request = 0 # Time of last request in seconds since epoch
+        self.connections = 0 # Number of connections handled by workers
+        self._connections_lock = threading.Lock()
+        self.limits = RequestLimits(limits)
+        self._queue = queue.Queue(queue_size)
+        self._workers = [threading.Thread(target=self.work, daemon=True,
+                                          name="cura-worker-{}".format(i))
+                         for i in range(workers)]
+
+    def run(self):
+        for worker in self._workers:
+            worker.start()
+        try:
+            self.serve_forever()
+        finally:
+            for _ in self._workers:
+                try:
+                    self._queue.put_nowait(None)
+                except queue.Full: # Workers will get stuck, but are daemons
+                    break
+
+    def process_request(self, request, client_address):
+        """Pass the connection on to a worker, or reject it if busy"""
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            self.limits.reject("queue")
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def work(self):
+        """Handle connections from the queue, run in each worker thread"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._connections_lock:
+                self.connections += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._connections_lock:
+                    self.connections -= 1
+                self.shutdown_request(request)
+
+    def keep_alive(self):
+        """Return True if the current connection may be kept open"""
+        return self.connections < len(self._workers) and self._queue.empty()
 
-    run = srv.HTTPServer.serve_forever
+    def stats(self):
+        """Return the load of the server and the rejection counters"""
+        return dict(self.limits.stats(), workers=len(self._workers),
+                    connections=self.connections,
+                    queued=self._queue.qsize())
 
 
 def get_server(module):
-    return Server((module.ADDRESS, 8008), Handler, module)
+    return Server((module.ADDRESS, 8008), Handler, module,
+                  workers=module.SERVER_WORKERS,
+                  queue_size=module.SERVER_QUEUE_SIZE,
+                  limits={"poll": module.MAX_POLLS,
+                          "upload": module.MAX_UPLOADS,
+                          "watch": module.MAX_WATCHES})
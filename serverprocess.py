@@ -0,0 +1,452 @@
+"""
+Optional mode in which the server runs in a separate process, so that
+parsing uploads and building responses doesn't compete with klippy for
+the GIL of its process.
+
+In klippy, ServerProcess takes the place of the server:  It publishes
+the snapshots of the klippy state to the server process and executes
+the commands coming back from it in the reactor.  The server process
+runs a ServerProcessModule, which sets up the server like
+CuraConnectionModule does, but sends everything that has to happen in
+klippy over the pipe instead of calling into the reactor.
+
+Messages on the pipe are tuples, starting with their kind:
+    klippy -> server:  ("snapshot", Snapshot), ("reply", call_id, result,
+                       exception), ("stop",)
+    server -> klippy:  ("call", call_id, name, args), where call_id is
+                       None if no reply is expected
+"""
+
+from concurrent.futures import Future, TimeoutError
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import threading
+import time
+
+from .contentmanager import ContentManager
+from .curaconnection import CuraConnectionModule
+from .custom_exceptions import ReactorTimeoutError
+from .metrics import Metrics
+from .streamprint import StreamGate, StreamingUpload
+
+logger = logging.getLogger("root.server")
+
+
+class ServerProcess:
+    """
+    The klippy side of the server process, with the interface of the
+    server that CuraConnectionModule uses.  All its methods must be
+    called from within the reactor.
+
+    Messages to the server process are sent from a separate thread, so
+    that the reactor never blocks on a full pipe.  Of the snapshots only
+    the latest one waiting to be sent is kept.
+    """
+
+    # Seconds to wait for the server process to shut down
+    JOIN_TIMEOUT = 10
+
+    def __init__(self, module):
+        self.module = module
+        self.reactor = module.reactor
+        context = multiprocessing.get_context("spawn")
+        self.conn, self._child_conn = context.Pipe()
+        # The server process only gets the settings, everything else it
+        # builds itself or asks klippy for
+        settings = {key: value for key, value in vars(module).items()
+                    if key.isupper()}
+        self.process = context.Process(target=run_server_process,
+                args=(self._child_conn, settings),
+                name="cura-connection-server", daemon=True)
+        self.last_request = 0 # As reported by the server process
+        self._fd_handle = None
+        self._streams = {} # type: {str: StreamingUpload} by path
+        # Waiting to be sent:  The latest snapshot (if not sent yet) and
+        # the other messages in order, None stops the sender thread
+        self._sent_snapshot = None
+        self._snapshot = None
+        self._outbox = []
+        self._outbox_changed = threading.Condition()
+        self._sender = threading.Thread(target=self._send_messages,
+                name="cura-connection-sender", daemon=True)
+
+    def start(self):
+        self.process.start()
+        self._child_conn.close()
+        self._fd_handle = self.reactor.register_fd(self.conn.fileno(),
+                                                   self._handle_messages)
+        self._sender.start()
+        self.send_snapshot()
+
+    def shutdown(self):
+        self._send(("stop",))
+
+    def join(self):
+        self.process.join(self.JOIN_TIMEOUT)
+        if self.process.is_alive():
+            logger.error("Server process didn't shut down, terminating it")
+            self.process.terminate()
+            self.process.join()
+        self._close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def send_snapshot(self):
+        """Send the current snapshot, if the server process lacks it"""
+        snapshot = self.module.content_manager.snapshot
+        if snapshot is not self._sent_snapshot and self._fd_handle is not None:
+            with self._outbox_changed:
+                self._snapshot = snapshot
+                self._outbox_changed.notify()
+            self._sent_snapshot = snapshot
+
+    def _send(self, message):
+        """Queue message to be sent to the server process"""
+        if self._fd_handle is None:
+            return # Not started or already gone
+        with self._outbox_changed:
+            self._outbox.append(message)
+            self._outbox_changed.notify()
+
+    def _send_messages(self):
+        """
+        Sender thread:  Send the queued messages.  A waiting snapshot
+        goes first, so a reply is never sent before the snapshot that
+        was current when it was queued.
+        """
+        while True:
+            with self._outbox_changed:
+                while self._snapshot is None and not self._outbox:
+                    self._outbox_changed.wait()
+                messages = self._outbox
+                if self._snapshot is not None:
+                    messages.insert(0, ("snapshot", self._snapshot))
+                self._snapshot = None
+                self._outbox = []
+            for message in messages:
+                if message is None:
+                    return
+                try:
+                    self._send_message(message)
+                except OSError as e:
+                    logger.error("Failed to send to the server process: %s",
+                                 e)
+                    return
+
+    def _send_message(self, message):
+        try:
+            self.conn.send(message)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            if message[0] != "reply":
+                logger.exception("Failed to send %s to the server process",
+                                 message[0])
+                return
+            # Results and exceptions that can't be pickled are sent as
+            # their repr(), the call must not go unanswered
+            self.conn.send(("reply", message[1], None,
+                            RuntimeError(repr(message[3] or message[2]))))
+
+    def _close(self):
+        if self._fd_handle is not None:
+            self.reactor.unregister_fd(self._fd_handle)
+            self._fd_handle = None
+            with self._outbox_changed:
+                self._outbox.append(None)
+                self._outbox_changed.notify()
+            # Only blocks if the server process is still alive
+            self._sender.join(self.JOIN_TIMEOUT)
+        self.conn.close()
+
+    def _handle_messages(self, eventtime):
+        """Reactor callback: Handle everything the server process sent"""
+        try:
+            while self.conn.poll():
+                _, call_id, name, args = self.conn.recv()
+                self._handle_call(call_id, name, args, eventtime)
+        except (EOFError, OSError):
+            logger.error("Lost the connection to the server process")
+            self._close()
+            return
+        self.send_snapshot()
+
+    def _handle_call(self, call_id, name, args, eventtime):
+        result = error = None
+        try:
+            result = getattr(self, "_call_" + name)(eventtime, *args)
+        except Exception as e:
+            if call_id is None:
+                logger.exception("Failed to handle %s from the server"
+                                 " process", name)
+                return
+            error = e
+        if call_id is None:
+            return
+        # Changes from the call must reach the server before its reply
+        self.send_snapshot()
+        self._send(("reply", call_id, result, error))
+
+    def _call_last_request(self, eventtime, last_request):
+        self.last_request = last_request
+
+    def _call_send_print(self, eventtime, path):
+        self.module.sdcard.add_printjob(path)
+
+    def _call_edit_queue(self, eventtime, edits):
+        return self.module._edit_queue(edits, eventtime)
+
+    def _call_job_action(self, eventtime, action, ref):
+        self.module._job_action(action, ref, eventtime)
+
+    def _call_guid_to_path(self, eventtime):
+        return dict(self.module.filament_manager.guid_to_path)
+
+    def _call_get_info(self, eventtime, guid, xpath):
+        return self.module.filament_manager.get_info(guid, xpath)
+
+    def _call_read_single_file(self, eventtime, path):
+        """Read a new material file and return the updated guid_to_path"""
+        self.module.filament_manager.read_single_file(path)
+        return self._call_guid_to_path(eventtime)
+
+    def _call_stream_start(self, eventtime, path, written):
+        stream = StreamingUpload(path, self.module.stream_gate)
+        stream.written = written
+        stream.started = True
+        self._streams[path] = stream
+        self.module.stream_gate.start(stream)
+
+    def _call_stream_written(self, eventtime, path, written):
+        stream = self._streams.get(path)
+        if stream is not None:
+            stream.written = written
+
+    def _call_stream_complete(self, eventtime, path):
+        self._streams.pop(path, None)
+        return self.module.stream_gate.complete(path)
+
+    def _call_stream_abort(self, eventtime, path):
+        self._streams.pop(path, None)
+        self.module.stream_gate.abort(path)
+
+
+class KlippyClient:
+    """
+    The server process side of the pipe to klippy.  Can be used from any
+    thread, replies are passed in by the thread reading the pipe.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._futures = {} # type: {int: Future} by call ID
+        self._ids = itertools.count()
+        self._lock = threading.Lock() # Also for sending
+
+    def call(self, name, args, timeout):
+        """
+        Let klippy handle name with args in the reactor and wait for the
+        result.  Raise ReactorTimeoutError if there is none within
+        timeout.  Unlike with call_in_reactor() the call may still
+        happen after that.
+        """
+        future = Future()
+        with self._lock:
+            call_id = next(self._ids)
+            self._futures[call_id] = future
+            self.conn.send(("call", call_id, name, args))
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            raise ReactorTimeoutError()
+        finally:
+            with self._lock:
+                self._futures.pop(call_id, None)
+
+    def notify(self, name, args):
+        """Let klippy handle name with args, without waiting for it"""
+        with self._lock:
+            self.conn.send(("call", None, name, args))
+
+    def resolve(self, call_id, result, error):
+        """Pass the reply to a call to the thread waiting for it"""
+        with self._lock:
+            future = self._futures.pop(call_id, None)
+        if future is None:
+            return # The call timed out
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+class RemoteFilamentManager:
+    """
+    Stand-in for klippy's filament_manager in the server process, with
+    the parts that the material index and material uploads use.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self._guid_to_path = None
+
+    @property
+    def guid_to_path(self):
+        if self._guid_to_path is None:
+            self._guid_to_path = self.module.call_klippy("guid_to_path")
+        return self._guid_to_path
+
+    def get_info(self, guid, xpath):
+        return self.module.call_klippy("get_info", guid, xpath)
+
+    def read_single_file(self, path):
+        self._guid_to_path = self.module.call_klippy(
+                "read_single_file", path)
+
+
+class RemoteStreamingUpload(StreamingUpload):
+    """
+    StreamingUpload in the server process, which keeps klippy's
+    StreamGate up to date on how much of the file has been written.
+    """
+
+    def feed(self, data):
+        super().feed(data)
+        if self.started:
+            self.gate.module.notify_klippy("stream_written",
+                                           self.path, self.written)
+
+
+class RemoteStreamGate:
+    """
+    Stands in for the StreamGate in the server process, with the parts
+    that the server uses.  The print jobs are gated by the StreamGate in
+    klippy, this only forwards the streaming uploads to it.
+    """
+
+    def __init__(self, module, prefix):
+        self.module = module
+        # Same as in klippy's StreamGate
+        self.prefix = max(prefix, 2 * StreamGate.MARGIN)
+        self._streams = {} # type: {str: RemoteStreamingUpload} by path
+        self._lock = threading.Lock()
+
+    def stage(self, path):
+        return RemoteStreamingUpload(path, self)
+
+    def start(self, stream):
+        with self._lock:
+            self._streams[stream.path] = stream
+        self.module.notify_klippy("stream_start", stream.path, stream.written)
+
+    def complete(self, path):
+        with self._lock:
+            stream = self._streams.pop(path, None)
+        if stream is None:
+            return False
+        return self.module.call_klippy("stream_complete", path)
+
+    def abort(self, path):
+        with self._lock:
+            stream = self._streams.pop(path, None)
+        if stream is not None:
+            self.module.notify_klippy("stream_abort", path)
+
+
+class ServerProcessModule(CuraConnectionModule):
+    """
+    CuraConnectionModule as it runs in the server process, created from
+    the settings of the one in klippy.  The server is used as in the
+    threaded mode, only the methods that have to reach klippy are
+    replaced.
+    """
+
+    def __init__(self, conn, settings):
+        self.testing = False
+        vars(self).update(settings)
+        # Rotating the same log file from two processes would lose logs
+        self.LOGFILE = os.path.join(self.PATH, "logs/server-process.log")
+        self.conn = conn
+        self.klippy = KlippyClient(conn)
+        self.filament_manager = RemoteFilamentManager(self)
+
+        self.content_manager = self.zeroconf_handler = self.server = None
+        self.thumbnail_cache = self.file_index = self.name_index = None
+        self.snapshot_timer = self.stream_timer = None
+        self.stream_gate = self.uploads = self.disk_space = None
+        self.metrics = Metrics()
+        self.configure_logging()
+
+    def start(self):
+        self.content_manager = ContentManager(self)
+        if self.STREAM_PRINT_PREFIX:
+            self.stream_gate = RemoteStreamGate(self, self.STREAM_PRINT_PREFIX)
+        self.setup_server()
+        self.zeroconf_handler.start()
+        self.server.start()
+        logger.info("Server process started")
+
+    def run(self):
+        """
+        Handle the messages from klippy until it asks to stop or goes
+        away, and report the time of the last request to it.
+        """
+        last_request = 0
+        while True:
+            try:
+                if self.conn.poll(self.SNAPSHOT_INTERVAL):
+                    message = self.conn.recv()
+                else:
+                    message = ("idle",)
+            except (EOFError, OSError):
+                logger.error("Lost the connection to klippy")
+                return
+            if message[0] == "snapshot":
+                self.content_manager.publish_snapshot(message[1])
+            elif message[0] == "reply":
+                self.klippy.resolve(*message[1:])
+            elif message[0] == "stop":
+                return
+            if self.server.last_request != last_request:
+                last_request = self.server.last_request
+                self.notify_klippy("last_request", last_request)
+
+    def call_klippy(self, name, *args):
+        """
+        Call name with args in klippy and return the result, see
+        KlippyClient.call().  The round trip is recorded under name in
+        the metrics.
+        """
+        start = time.perf_counter()
+        try:
+            return self.klippy.call(name, args, self.REACTOR_TIMEOUT)
+        finally:
+            self.metrics.reactor_handoff.observe(
+                    time.perf_counter() - start, (name,))
+
+    def notify_klippy(self, name, *args):
+        self.klippy.notify(name, args)
+
+    def send_print(self, path):
+        self.notify_klippy("send_print", path)
+
+    def edit_queue(self, edits):
+        return self.call_klippy("edit_queue", edits)
+
+    def _current_job_action(self, action, ref):
+        self.call_klippy("job_action", action, ref)
+
+
+def run_server_process(conn, settings):
+    """Entry point of the server process"""
+    # Interrupts from the terminal are for klippy, which stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    module = ServerProcessModule(conn, settings)
+    module.start()
+    try:
+        module.run()
+    finally:
+        module.stop()
@@ -0,0 +1,150 @@
+import logging
+import threading
+
+logger = logging.getLogger("root.server")
+
+class StreamingUpload:
+    """
+    Stage of MimeParser that queues a G-code file for printing as soon
+    as the first prefix bytes of it are on disk, while the rest is still
+    being uploaded.  See StreamGate for how the print is kept from
+    overtaking the upload.
+    """
+
+    def __init__(self, path, gate):
+        self.path = path
+        self.gate = gate
+        self.written = 0 # Bytes of the file that are on disk
+        self.started = False # The print job has been queued
+        self.complete = False # The upload has finished
+        self.gated = False # The print job was paused by the gate
+
+    def feed(self, data):
+        # MimeParser has already flushed data to the file
+        self.written += len(data)
+        if not self.started and self.written >= self.gate.prefix:
+            self.started = True
+            self.gate.start(self)
+
+    def finish(self):
+        # The upload is only complete once the parser returns without error
+        pass
+
+
+class StreamGate:
+    """
+    Keeps print jobs of files that are still being uploaded from reading
+    past the end of what has been written.  virtual_sdcard takes the end
+    of the file as the end of the print, so check() pauses the current
+    print job whenever it comes within MARGIN bytes of the end of its
+    upload and resumes it once twice that is available again, or the
+    upload is complete.  If an upload fails, its print job is stopped or
+    removed from the queue.
+    """
+
+    # Must be more than virtual_sdcard reads in INTERVAL, which is a few
+    # kB for usual G-code
+    MARGIN = 256 * 1024
+    # Seconds between checks in the reactor
+    INTERVAL = 0.25
+
+    def __init__(self, module, prefix):
+        self.module = module
+        # Starting any earlier would only get the print paused right away
+        self.prefix = max(prefix, 2 * self.MARGIN)
+        self._streams = {} # type: {str: StreamingUpload} by path
+        self._lock = threading.Lock()
+
+    def stage(self, path):
+        """Return the MimeParser stage for an uploaded file"""
+        return StreamingUpload(path, self)
+
+    def start(self, stream):
+        """Queue the print job of stream, called from the server thread"""
+        with self._lock:
+            self._streams[stream.path] = stream
+        logger.info("Streaming %s to print after %d bytes",
+                    stream.path, stream.written)
+        self.module.send_print(stream.path)
+
+    def complete(self, path):
+        """
+        Mark the upload of path as complete.  Return True if its print
+        job has already been queued by start().
+        """
+        with self._lock:
+            stream = self._streams.get(path)
+            if stream is None:
+                return False
+            stream.complete = True
+            if self.module.testing:
+                del self._streams[path]
+        return True
+
+    def abort(self, path):
+        """Cancel the print job of a failed upload, if it was queued"""
+        with self._lock:
+            stream = self._streams.pop(path, None)
+        if stream is None:
+            return
+        logger.error("Upload of %s failed while streaming to print", path)
+        if self.module.testing:
+            self.module.content_manager.set_test_queue(
+                    [(job_id, p) for job_id, p
+                     in self.module.content_manager.get_test_queue()
+                     if p != path])
+        else:
+            self.module.run_in_reactor("cancel_stream",
+                    lambda eventtime: self._cancel(path, eventtime))
+
+    def _cancel(self, path, eventtime):
+        """Reactor callback: Stop or dequeue the print job of path"""
+        sdcard = self.module.sdcard
+        content_manager = self.module.content_manager
+        paths = [job.path for job in sdcard.jobs]
+        if paths and paths[0] == path:
+            sdcard.stop_printjob(eventtime)
+        elif path in paths:
+            queue = list(zip(content_manager.get_job_ids(sdcard.jobs), paths))
+            del queue[paths.index(path)]
+            self.module.replace_queue(queue)
+        content_manager.take_snapshot()
+
+    def check(self, eventtime):
+        """
+        Reactor timer: Pause or resume the current print job depending
+        on how far ahead of it its upload is.
+        """
+        with self._lock:
+            streams = dict(self._streams)
+        sdcard = self.module.sdcard
+        current = None
+        if streams and sdcard.jobs:
+            job = sdcard.jobs[0]
+            stream = current = streams.get(job.path)
+            if stream is not None and job.state in ("printing", "paused"):
+                if stream.gated and job.state == "printing":
+                    # Resumed by someone else, e.g. from Cura.  Gate it
+                    # again if it is still too close to the upload.
+                    stream.gated = False
+                    logger.info("%s was resumed while waiting for its"
+                                " upload", job.path)
+                ahead = stream.written - sdcard.get_file_position()
+                if stream.complete or ahead >= 2 * self.MARGIN:
+                    if stream.gated:
+                        stream.gated = False
+                        sdcard.resume_printjob(eventtime)
+                        logger.info("Resumed %s, %d bytes ahead",
+                                    job.path, ahead)
+                elif (ahead < self.MARGIN and job.state == "printing"
+                        and not stream.gated):
+                    stream.gated = True
+                    sdcard.pause_printjob(eventtime)
+                    logger.info("Paused %s to wait for its upload, %d bytes"
+                                " ahead", job.path, ahead)
+        with self._lock:
+            for path, stream in list(self._streams.items()):
+                # Also forget gated ones that were stopped in the meantime
+                if stream.complete and not (stream.gated and stream is current):
+                    del self._streams[path]
+        return eventtime + self.INTERVAL
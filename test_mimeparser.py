@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Regression tests of MimeParser's part outputs.
+
+    ./test_mimeparser.py
+
+Most expectations were recorded from the parser before it read in blocks
+(fp.readline() and 1024 byte reads) and must hold for every block size,
+in particular with the delimiter cut in half between two blocks.  That
+includes trailing line breaks:  Of a file only the line break in front
+of the delimiter is stripped, of other parts all of them.
+
+The expectations that encode new behaviour are in the tests named
+test_new_*.  On all of these messages the old parser looped forever:
+- Messages without final boundary or ending inside of a file, which now
+  raise ValueError.
+- The boundary occurring inside of a line of a file, which is now part
+  of the file.
+"""
+
+import io
+import os
+import shutil
+import site
+import tempfile
+import threading
+import unittest
+site.addsitedir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from klipper_cura_connection.mimeparser import MimeParser
+
+BOUNDARY = "TestBoundary"
+# Time after which a parser that hasn't returned counts as looping forever
+PARSE_TIMEOUT = 5
+
+# Headers and payloads of the parts, as recorded from the old parser
+RECORDED_PARTS = [
+    ({"Content-Disposition": 'form-data; name="owner"'}, "Cura"),
+    ({"Content-Disposition":
+        'form-data; name="file"; filename="part.gcode"',
+      "Content-Type": "application/octet-stream"}, ""),
+]
+GCODE = b"".join(b"G1 X%d\r\n" % i for i in range(300))
+
+
+def make_message(data, ending=b"\r\n--" + BOUNDARY.encode() + b"--\r\n"):
+    """Return a MIME body like Cura's uploads with data as file"""
+    return (b"--" + BOUNDARY.encode() + b"\r\n"
+            b'Content-Disposition: form-data; name="owner"\r\n'
+            b"\r\n"
+            b"Cura\r\n"
+            b"--" + BOUNDARY.encode() + b"\r\n"
+            b'Content-Disposition: form-data; name="file"; '
+            b'filename="part.gcode"\r\n'
+            b"Content-Type: application/octet-stream\r\n"
+            b"\r\n" + data + ending)
+
+
+class MimeParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir)
+
+    def parse(self, body, **kwargs):
+        """
+        Parse body and return the parts as (headers, payload) and the
+        written files as (name, content).  Fail if parsing doesn't end.
+        """
+        parser = MimeParser(io.BytesIO(body), BOUNDARY, len(body),
+                            self.out_dir, **kwargs)
+        result = []
+        def parse():
+            try:
+                result.append(parser.parse())
+            except Exception as e:
+                result.append(e)
+        thread = threading.Thread(target=parse, daemon=True)
+        thread.start()
+        thread.join(PARSE_TIMEOUT)
+        if thread.is_alive():
+            self.fail("MimeParser did not return within {}s".format(
+                PARSE_TIMEOUT))
+        if isinstance(result[0], Exception):
+            raise result[0]
+        submessages, paths = result[0]
+        self.assertEqual(parser.bytes_read, len(body))
+        parts = [(dict(message.items()), message.get_payload())
+                 for message in submessages]
+        files = []
+        for path in paths:
+            with open(path, "rb") as fp:
+                files.append((os.path.basename(path), fp.read()))
+        return parts, files
+
+    def assert_recorded(self, data, **kwargs):
+        """
+        Assert that the message with data as file parses to RECORDED_PARTS
+        and a file with exactly data
+        """
+        parts, files = self.parse(make_message(data), **kwargs)
+        self.assertEqual(parts, RECORDED_PARTS)
+        self.assertEqual(files, [("part.gcode", data)])
+
+    def test_delimiter_across_blocks(self):
+        # Every position of the delimiter relative to the block boundaries
+        for block_size in range(1, 40):
+            for size in range(60, 60 + block_size):
+                with self.subTest(block_size=block_size, size=size):
+                    self.assert_recorded(GCODE[:size], block_size=block_size)
+
+    def test_delimiter_across_old_reads(self):
+        # Around the 1024 byte reads of the old parser
+        for size in range(1000, 1040):
+            with self.subTest(size=size):
+                self.assert_recorded(GCODE[:size], block_size=1024)
+
+    def test_trailing_line_break(self):
+        # Only the line break in front of the delimiter is not the file's
+        for ending in (b"\r\n", b"\r\n\r\n", b"\r\n\r\n\r\n", b"\n", b"\n\n",
+                       b"\r"):
+            for block_size in (1, 2, 3, 1024):
+                with self.subTest(ending=ending, block_size=block_size):
+                    self.assert_recorded(b"G1 X1\r\nG1 X2" + ending,
+                                         block_size=block_size)
+
+    def test_trailing_line_breaks_of_field(self):
+        # Unlike files, all trailing line breaks are stripped from fields
+        body = make_message(b"G1 X1").replace(b"Cura\r\n", b"Cura\r\n\r\n\r\n")
+        for block_size in (1, 5, 1024):
+            with self.subTest(block_size=block_size):
+                parts, files = self.parse(body, block_size=block_size)
+                self.assertEqual(parts, RECORDED_PARTS)
+                self.assertEqual(files, [("part.gcode", b"G1 X1")])
+
+    def test_trailing_line_break_after_final_boundary(self):
+        # The epilogue is read but not part of any part
+        body = make_message(b"G1 X1", b"\r\n--" + BOUNDARY.encode()
+                            + b"--\r\n\r\n")
+        parts, files = self.parse(body, block_size=7)
+        self.assertEqual(parts, RECORDED_PARTS)
+        self.assertEqual(files, [("part.gcode", b"G1 X1")])
+
+    def test_new_missing_final_boundary(self):
+        unterminated = make_message(b"G1 X1", b"\r\n--"
+                                    + BOUNDARY.encode() + b"\r\n")
+        with self.assertRaisesRegex(ValueError, "before final boundary"):
+            self.parse(unterminated, block_size=8)
+        truncated = make_message(b"G1 X1", b"")
+        with self.assertRaisesRegex(ValueError, "inside of a file"):
+            self.parse(truncated, block_size=8)
+
+    def test_new_boundary_inside_line(self):
+        # Only a delimiter at the start of a line ends the file
+        for data in (b"G1 X1 ; " + BOUNDARY.encode() + b"\r\nG1 X2",
+                     b"G1 X1 ; --" + BOUNDARY.encode() + b"\r\nG1 X2"):
+            for block_size in (1, 7, 1024):
+                with self.subTest(data=data, block_size=block_size):
+                    self.assert_recorded(data, block_size=block_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Tests of resumable uploads.
+
+    ./test_uploads.py
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import site
+import tempfile
+import unittest
+site.addsitedir(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from klipper_cura_connection.fileindex import ContentHash
+from klipper_cura_connection.uploads import UploadStore
+
+
+class FailingStage:
+    """Stage that raises on the first feed() after fail was set"""
+
+    def __init__(self, path):
+        self.fail = False
+        self.data = b""
+
+    def feed(self, data):
+        if self.fail:
+            self.fail = False
+            raise OSError("Stage failed")
+        self.data += data
+
+    def finish(self):
+        pass
+
+
+class ResumableUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = UploadStore(os.path.join(self.directory, "uploads"))
+
+    def read(self, upload):
+        with open(upload.path, "rb") as fp:
+            return fp.read()
+
+    def test_resume_after_failed_stage(self):
+        upload = self.store.create("part.gcode", 12,
+                                   [ContentHash, FailingStage])
+        content_hash, failing = upload.stages
+        upload.append(io.BytesIO(b"AAAA"), 4, 4)
+        failing.fail = True
+        # Written to the file and fed to ContentHash, but not counted
+        with self.assertRaises(OSError):
+            upload.append(io.BytesIO(b"BBBB"), 4, 4)
+        self.assertEqual(upload.offset, 4)
+        # The client resumes at offset
+        upload.append(io.BytesIO(b"BBBBCCCC"), 8, 3)
+        self.assertEqual(upload.offset, 12)
+        self.assertEqual(self.read(upload), b"AAAABBBBCCCC")
+        self.assertEqual(failing.data, b"AAAABBBBCCCC")
+        path = self.store.finish(upload, os.path.join(self.directory,
+                                                      "part.gcode"))
+        self.assertEqual(content_hash.size, 12)
+        self.assertEqual(content_hash.hexdigest,
+                         hashlib.sha256(b"AAAABBBBCCCC").hexdigest())
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), b"AAAABBBBCCCC")
+
+    def test_resume_after_partial_write(self):
+        upload = self.store.create("part.gcode", 8, [])
+        upload.append(io.BytesIO(b"AAAA"), 4, 4)
+        # Like a flush that failed after part of the block reached disk
+        with open(upload.path, "ab") as fp:
+            fp.write(b"BB")
+        upload.append(io.BytesIO(b"BBBB"), 4, 4)
+        self.assertEqual(self.read(upload), b"AAAABBBB")
+
+    def test_append_beyond_size(self):
+        upload = self.store.create("part.gcode", 4, [])
+        with self.assertRaises(ValueError):
+            upload.append(io.BytesIO(b"AAAABBBB"), 8, 8)
+        self.assertEqual(upload.offset, 0)
+        upload.append(io.BytesIO(b"AAAA"), 4, 4)
+        self.assertEqual(self.read(upload), b"AAAA")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+import base64
+import binascii
+from collections import OrderedDict
+from email.utils import formatdate
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+logger = logging.getLogger("root.server")
+
+class ThumbnailExtractor:
+    """
+    Decode the thumbnails embedded in a G-code file while that file is
+    being written, as a stage of MimeParser.
+
+    Thumbnails are base64 encoded PNG images in comment blocks:
+        ; thumbnail begin 300x300 12345
+        ; iVBORw0KGgo...
+        ; thumbnail end
+    Only the first SEARCH_SIZE bytes are searched, because that is
+    where slicers put them.  The largest image found is stored in cache
+    and its path set as thumbnail_path once finish() is called.
+    """
+
+    SEARCH_SIZE = 1024 * 1024
+    MAX_THUMBNAIL_SIZE = 1024 * 1024 # Maximum length of the base64 data
+    BEGIN = b"; thumbnail begin"
+    END = b"; thumbnail end"
+    SIZE_REGEX = re.compile(rb"(\d+)x(\d+)")
+
+    def __init__(self, path, cache):
+        self.path = path
+        self.cache = cache
+        self.thumbnail_path = None
+        self._buffer = bytearray() # Data that has not yet been searched
+        self._fed = 0 # Number of bytes passed to feed()
+        self._pixels = None # Pixel count of the thumbnail being read
+        self._images = [] # List of (pixel count, png data)
+        self._done = False
+
+    def feed(self, data):
+        if self._done:
+            return
+        self._fed += len(data)
+        self._buffer += data
+        self._process()
+
+    def _process(self):
+        """Extract thumbnails from the buffer as far as possible"""
+        buf = self._buffer
+        while True:
+            if self._pixels is None: # Looking for the next thumbnail
+                pos = buf.find(self.BEGIN)
+                line_end = buf.find(b"\n", pos) if pos != -1 else -1
+                if line_end == -1:
+                    if pos == -1:
+                        # Keep what might be the start of BEGIN
+                        del buf[:-len(self.BEGIN)]
+                    self._done = self._fed > self.SEARCH_SIZE
+                    return
+                m = self.SIZE_REGEX.search(buf, pos, line_end)
+                self._pixels = int(m.group(1)) * int(m.group(2)) if m else 0
+                del buf[:line_end + 1]
+            else: # Reading the base64 data of a thumbnail
+                pos = buf.find(self.END)
+                if pos == -1:
+                    if len(buf) > self.MAX_THUMBNAIL_SIZE:
+                        logger.warning("Thumbnail in %s is too large",
+                                       self.path)
+                        self._done = True
+                    return
+                try:
+                    image = base64.b64decode(
+                            bytes(buf[:pos]).translate(None, b"; \t\r\n"))
+                except binascii.Error as e:
+                    logger.warning("Invalid thumbnail in %s: %s", self.path, e)
+                else:
+                    self._images.append((self._pixels, image))
+                self._pixels = None
+                del buf[:pos + len(self.END)]
+
+    def finish(self):
+        """Store the largest thumbnail in the cache"""
+        self._buffer = None
+        if self._images:
+            pixels, image = max(self._images, key=lambda i: i[0])
+            try:
+                self.thumbnail_path = self.cache.store(image)
+            except OSError as e:
+                logger.error("Failed to store thumbnail of %s: %s",
+                             self.path, e)
+
+
+class CachedImage:
+    """An image file with its HTTP validators and its data once it is hot"""
+
+    def __init__(self, path, etag, stat):
+        self.path = path
+        self.etag = etag
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.data = None # Only read into memory after the first request
+        self.requests = 0
+
+
+class ThumbnailCache:
+    """
+    Content-addressed store for thumbnails in directory, which are
+    named after the SHA-256 hash of their data and therefore never change.
+
+    For every image requested through get() the validators are kept in
+    an LRU of MAX_ENTRIES.  From the second request on, the image data is
+    kept as well, so that hot images are served without touching the
+    disk.  Other images (e.g. default.png) are checked for changes with
+    a stat() on every request.
+
+    The directory itself is limited to MAX_FILES thumbnails, the ones
+    stored least recently are deleted first.
+    """
+
+    MAX_ENTRIES = 64
+    MAX_IMAGE_SIZE = 256 * 1024 # Larger images are never kept in memory
+    MAX_FILES = 256
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._images = OrderedDict() # type: {str: CachedImage}
+        self._lock = threading.Lock()
+
+    def store(self, data):
+        """Write image data to the cache if it isn't there yet"""
+        name = hashlib.sha256(data).hexdigest() + ".png"
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+            logger.debug("Stored thumbnail %s", name)
+            self.prune()
+        else:
+            os.utime(path) # Stored again, so it is kept the longest
+        return path
+
+    def prune(self):
+        """Delete the least recently stored files beyond MAX_FILES"""
+        try:
+            with os.scandir(self.directory) as it:
+                files = sorted((entry.stat().st_mtime, entry.path)
+                               for entry in it if entry.is_file())
+        except OSError as e:
+            logger.error("Failed to list thumbnails: %s", e)
+            return
+        for _, path in files[:-self.MAX_FILES]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error("Failed to delete thumbnail %s: %s", path, e)
+                continue
+            with self._lock:
+                self._images.pop(path, None)
+            logger.debug("Deleted thumbnail %s", os.path.basename(path))
+
+    def get(self, path):
+        """
+        Return the CachedImage for path.  Raises OSError if the file
+        can't be accessed.
+        """
+        immutable = os.path.dirname(path) == self.directory
+        with self._lock:
+            image = self._images.get(path)
+            if image is not None:
+                self._images.move_to_end(path)
+        if image is None or not immutable:
+            stat = os.stat(path)
+            if (image is None or image.mtime != stat.st_mtime
+                    or image.size != stat.st_size):
+                if immutable:
+                    etag = '"{}"'.format(os.path.basename(path)[:16])
+                else:
+                    etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns,
+                                                stat.st_size)
+                image = CachedImage(path, etag, stat)
+        image.requests += 1
+        if (image.data is None and image.requests > 1
+                and image.size <= self.MAX_IMAGE_SIZE):
+            with open(path, "rb") as fp:
+                image.data = fp.read()
+        with self._lock:
+            self._images[path] = image
+            self._images.move_to_end(path)
+            while len(self._images) > self.MAX_ENTRIES:
+                self._images.popitem(last=False)
+        return image
@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger("root.server")
+
+class ChunkedReader:
+    """
+    File-like reader for a request body sent with Transfer-Encoding:
+    chunked, reading from fp.  Like the buffered fp, readinto() fills the
+    whole buffer with decoded data, across chunks, except at the end of
+    the body.  It returns 0 once the last chunk and the trailer have
+    been read, so nothing of the body is left in fp.  Raises ValueError
+    if the encoding is broken.
+    """
+
+    MAX_LINE = 1024
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.chunk_left = 0 # Bytes left to read of the current chunk
+        self.done = False
+
+    def readinto(self, b):
+        n = 0
+        with memoryview(b) as view:
+            while n < len(view) and not self.done:
+                if self.chunk_left == 0:
+                    self._next_chunk()
+                    continue
+                size = min(len(view) - n, self.chunk_left)
+                read = self.fp.readinto(view[n:n + size])
+                if not read:
+                    raise ValueError("Chunked body ended inside of a chunk")
+                n += read
+                self.chunk_left -= read
+                if (self.chunk_left == 0
+                        and self._readline() not in (b"\r\n", b"\n")):
+                    raise ValueError("Missing line break after chunk")
+        return n
+
+    def _next_chunk(self):
+        """Read the size of the next chunk, or the trailer after the last"""
+        line = self._readline()
+        try:
+            # Ignore chunk extensions after ";"
+            self.chunk_left = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Invalid chunk size: {!r}".format(line))
+        if self.chunk_left < 0:
+            raise ValueError("Invalid chunk size: {!r}".format(line))
+        if self.chunk_left == 0:
+            # Discard the trailer up to the empty line ending the body
+            while self._readline() not in (b"\r\n", b"\n"):
+                pass
+            self.done = True
+
+    def _readline(self):
+        line = self.fp.readline(self.MAX_LINE + 1)
+        if not line.endswith(b"\n"):
+            raise ValueError("Chunked body ended or line too long")
+        return line
+
+
+class ResumableUpload:
+    """
+    A file that is uploaded in any number of requests, each appending to
+    what has been received so far.  Its stages (see MimeParser) are fed
+    with the data as it is appended and finished once size bytes are
+    there.  reservation is the Reservation of its disk space, if any.
+    lock is held by the request that is appending.
+    """
+
+    def __init__(self, upload_id, path, filename, size, stages,
+                 reservation=None):
+        self.id = upload_id
+        self.path = path # Of the partial file
+        self.filename = filename # Name the client wants for the file
+        self.size = size
+        self.offset = 0 # Bytes received and written to path
+        self.complete = False # The file has been moved out of path
+        self.stages = [stage(path) for stage in stages]
+        self.reservation = reservation
+        if reservation is not None:
+            # Counts the data written like a stage
+            self.stages.append(reservation)
+        # Bytes of the file each stage was fed, ahead of offset for those
+        # that got a block before another stage raised
+        self._fed = [0] * len(self.stages)
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    def status(self):
+        return {"id": self.id, "filename": self.filename, "size": self.size,
+                "offset": self.offset, "complete": self.complete}
+
+    def append(self, fp, length, block_size):
+        """
+        Append the data read from fp, which is length bytes or, if length
+        is None, everything until the end of fp.  Whatever was received
+        before an error is kept and counted in offset.  Raises ValueError
+        if the data ends early or goes past size.
+        Data written past offset by a failed append, e.g. when a stage
+        raised or a flush only partially succeeded, is cut off first, so
+        that the file always ends at offset.  Stages are never fed the same
+        part of the file twice.
+        """
+        block = memoryview(bytearray(block_size))
+        received = 0
+        try:
+            with open(self.path, "r+b") as write_fp:
+                write_fp.seek(self.offset)
+                write_fp.truncate()
+                while length is None or received < length:
+                    size = len(block) if length is None else min(
+                            len(block), length - received)
+                    n = fp.readinto(block[:size])
+                    if not n:
+                        if length is None:
+                            break
+                        raise ValueError("Body ended after {} of {} bytes"
+                                         .format(received, length))
+                    if self.offset + n > self.size:
+                        raise ValueError("Data beyond the upload size of {}"
+                                         .format(self.size))
+                    with block[:n] as data:
+                        write_fp.write(data)
+                        write_fp.flush()
+                        for i, stage in enumerate(self.stages):
+                            skip = self._fed[i] - self.offset
+                            if skip < n:
+                                with data[max(skip, 0):] as new:
+                                    stage.feed(new)
+                                self._fed[i] = self.offset + n
+                    self.offset += n
+                    received += n
+        finally:
+            self.last_active = time.monotonic()
+
+
+class UploadStore:
+    """
+    The ResumableUploads in progress, with their partial files in
+    directory.  Uploads are forgotten EXPIRY seconds after their last
+    request, which also keeps completed ones around long enough for a
+    client that missed the last response to ask for their status.
+
+    Partial files left over from before a restart are deleted, because
+    the state of their stages is lost.
+    """
+
+    EXPIRY = 3600
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._uploads = {} # type: {str: ResumableUpload} by ID
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError as e:
+                logger.error("Failed to remove stale upload %s: %s", name, e)
+
+    def create(self, filename, size, stages, reservation=None):
+        """
+        Start a new upload and return it.  reservation is released once
+        the upload is finished or removed.
+        """
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, upload_id)
+        open(path, "wb").close()
+        upload = ResumableUpload(upload_id, path, filename, size, stages,
+                                 reservation)
+        with self._lock:
+            self._uploads[upload_id] = upload
+        logger.info("Started resumable upload %s of %s (%d bytes)",
+                    upload_id, filename, size)
+        return upload
+
+    def get(self, upload_id):
+        """Return the upload with upload_id or None"""
+        with self._lock:
+            return self._uploads.get(upload_id)
+
+    def finish(self, upload, path):
+        """
+        Finish the stages of a complete upload and move its file to path,
+        which is returned.
+        """
+        for stage in upload.stages:
+            stage.finish()
+        os.replace(upload.path, path)
+        upload.path = path
+        upload.complete = True
+        if upload.reservation is not None:
+            upload.reservation.release()
+        logger.info("Resumable upload %s complete: %s", upload.id, path)
+        return path
+
+    def remove(self, upload):
+        """Forget an upload, deleting its partial file"""
+        with self._lock:
+            self._uploads.pop(upload.id, None)
+        if upload.reservation is not None:
+            upload.reservation.release()
+        if not upload.complete:
+            try:
+                os.remove(upload.path)
+            except OSError as e:
+                logger.error("Failed to remove %s: %s", upload.path, e)
+
+    def expire(self):
+        """Remove the uploads that have been inactive for EXPIRY"""
+        deadline = time.monotonic() - self.EXPIRY
+        with self._lock:
+            expired = [upload for upload in self._uploads.values()
+                       if upload.last_active < deadline
+                       and not upload.lock.locked()]
+        for upload in expired:
+            if not upload.complete:
+                logger.info("Resumable upload %s of %s expired at %d of %d"
+                            " bytes", upload.id, upload.filename,
+                            upload.offset, upload.size)
+            self.remove(upload)